@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: admission.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: admission control of the requests to an ai provider, at most
+# max_in_flight requests at once, the next ones wait in a bounded queue
+# (first come first served) and the overflow is rejected at once
+#
+#   controller = AdmissionController(max_in_flight=10, max_queue=50)
+#   ticket = Ticket()  # ticket.position is its place in the queue
+#   async with controller.slot(ticket):
+#       answer = await service.ask(...)
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+
+class Overloaded(Exception):
+    """The queue of the provider is full"""
+
+
+class Ticket:
+    """A request to admit, tells its place in the queue"""
+
+    def __init__(self):
+        self.controller: Optional['AdmissionController'] = None
+
+    @property
+    def position(self) -> int:
+        """1 for the next request admitted, 0 when not waiting"""
+        controller = self.controller
+        return controller.position(self) if controller is not None else 0
+
+
+class AdmissionController:
+
+    def __init__(self, max_in_flight: int, max_queue: int = 0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        # (ticket, future set when the ticket is admitted)
+        self._queue = deque()
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def position(self, ticket: Ticket) -> int:
+        for i, (t, _) in enumerate(self._queue):
+            if t is ticket:
+                return i + 1
+        return 0
+
+    async def acquire(self, ticket: Optional[Ticket] = None):
+        """Wait for a slot
+        :raise Overloaded: at once when the queue is full
+        """
+        if self.in_flight < self.max_in_flight and not self._queue:
+            self.in_flight += 1
+            return
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(f"{self.in_flight} requests running and "
+                             f"{len(self._queue)} waiting")
+        ticket = ticket or Ticket()
+        entry = (ticket, asyncio.get_running_loop().create_future())
+        self._queue.append(entry)
+        ticket.controller = self
+        try:
+            await entry[1]
+        except asyncio.CancelledError:
+            if entry in self._queue:
+                self._queue.remove(entry)
+            elif entry[1].done() and not entry[1].cancelled():
+                # admitted while being cancelled, pass the slot on
+                self.release()
+            raise
+        finally:
+            ticket.controller = None
+
+    def release(self):
+        """Hand the slot over to the first request waiting"""
+        while self._queue:
+            _, admitted = self._queue.popleft()
+            if not admitted.done():
+                admitted.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, ticket: Optional[Ticket] = None):
+        await self.acquire(ticket)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def to_dict(self) -> dict:
+        return {'in_flight': self.in_flight, 'queued': self.queued,
+                'rejected': self.rejected}
@@ -7,8 +7,12 @@
 # License:
 # Description: anthropic ai claude
 
+from functools import lru_cache
+
 import anthropic
 
+from ai.context import ContextTooLong, newest_window
+from ai.stream import or_error
 from logs.log import logger
 
 
@@ -16,30 +20,38 @@ class AnthropicAIService:
     max_tokens = 100000
     token_threshold = 1000
 
-    def __init__(self, api_key: str, model_name: str = 'claude-2', **kwargs):
+    def __init__(self, api_key: str, model_name: str = 'claude-2',
+                 max_retries: int = 2, **kwargs):
+        """
+        :param max_retries: retries of the sdk, 0 when the caller retries
+        """
         self.model_name = model_name
-        self.client = anthropic.AsyncAnthropic(api_key=api_key)
-        # self.client = anthropic.Anthropic()
+        self.client = anthropic.AsyncAnthropic(api_key=api_key,
+                                               max_retries=max_retries)
+        # the sdk counts the tokens locally with the claude tokenizer, the
+        # sync client's count_tokens is memoized: the same turns are counted
+        # on every message of a dialog
+        self.count_tokens = lru_cache(maxsize=8192)(
+            anthropic.Anthropic(api_key=api_key).count_tokens)
 
-    async def solve_context_limit(self, dialogs: list) -> list:
+    def solve_context_limit(self, dialogs: list, message: str = '') -> list:
         """
-        reduce the long context to a short one
+        reduce the long context to a short one, keep the latest turns that
+        fit with the message and the answer
         :param dialogs: [{'user':"", 'assistant':""}]
+        :param message: sent after the dialogs
         :return: dialogs list
         """
-        lgs = [await self.client.count_tokens(
-            d['user']) + await self.client.count_tokens(
-            d['assistant']) for d in dialogs]
-        if sum(lgs) > self.max_tokens:
-            count = 0
-            total = 0
-            for num in lgs:
-                total += num
-                count += 1
-                if total > self.max_tokens:
-                    break
-            dialogs = dialogs[count:]
-        return dialogs
+        budget = self.max_tokens - self.token_threshold - \
+            self.count_tokens(message)
+        if budget < 0:
+            raise ContextTooLong(
+                "Token exceed limit, please short your message")
+        return newest_window(
+            dialogs,
+            lambda d: self.count_tokens(d['user']) +
+            self.count_tokens(d['assistant']),
+            budget)
 
     async def _generate_msg(self, message, dialog_messages, prompt):
         """
@@ -49,9 +61,10 @@ class AnthropicAIService:
         :param chat_mode:
         """
         if not dialog_messages:
-            context = f"{anthropic.HUMAN_PROMPT} {prompt} {anthropic.AI_PROMPT}"
-            return context
-        dialog_messages = await self.solve_context_limit(dialog_messages)
+            first = f"{prompt} {message}" if prompt else message
+            self.solve_context_limit([], first)
+            return f"{anthropic.HUMAN_PROMPT} {first} {anthropic.AI_PROMPT}"
+        dialog_messages = self.solve_context_limit(dialog_messages, message)
         context = ''.join(
             [f"{anthropic.HUMAN_PROMPT} {msg['user']} {anthropic.AI_PROMPT} \
             {msg['assistant']}" for msg in dialog_messages])
@@ -59,52 +72,49 @@ class AnthropicAIService:
         context += f"{anthropic.HUMAN_PROMPT} {message} {anthropic.AI_PROMPT}"
         return context
 
+    async def ask(self, message, dialog_messages=None, prompt=None) -> str:
+        """Ask claude, raise the errors"""
+        messages = await self._generate_msg(message, dialog_messages or [],
+                                            prompt)
+        resp = await self.client.completions.create(
+            prompt=messages,
+            model=self.model_name,
+            max_tokens_to_sample=self.token_threshold,
+        )
+        return resp.completion
+
+    async def ask_stream(self, message, dialog_messages=None, prompt=None):
+        """Ask claude in stream mode, yield the text pieces, raise the
+        errors"""
+        messages = await self._generate_msg(message, dialog_messages or [],
+                                            prompt)
+        stream = await self.client.completions.create(
+            prompt=messages,
+            model=self.model_name,
+            max_tokens_to_sample=self.token_threshold,
+            stream=True
+        )
+        async for completion in stream:
+            if completion.completion:
+                yield completion.completion
+
     async def send_message(self, message, dialog_messages=None, prompt=None):
         """
         Send message to claude without stream response
         """
-        if dialog_messages is None:
-            dialog_messages = []
-
         try:
-            messages = await self._generate_msg(message, dialog_messages,
-                                                prompt)
-            resp = await self.client.completions.create(
-                prompt=messages,
-                model=self.model_name,
-                max_tokens_to_sample=self.token_threshold,
-            )
-            answer = resp.completion
+            answer = await self.ask(message, dialog_messages, prompt)
         except Exception as e:
             logger.error(f"error:\n\n ask: {message} \n with error {e}")
             answer = f"sth wrong with claude, please try again later."
 
         return answer
 
-    async def send_message_stream(self, message, dialog_messages=None,
-                                  prompt=None):
+    def send_message_stream(self, message, dialog_messages=None,
+                            prompt=None):
         """
-        Send message with stream response
+        Send message with stream response, yield the text pieces
         """
-        if dialog_messages is None:
-            dialog_messages = []
-
-        try:
-            messages = await self._generate_msg(message, dialog_messages,
-                                                prompt)
-            answer = await self.client.completions.create(
-                prompt=messages,
-                model=self.model_name,
-                max_tokens_to_sample=self.token_threshold,
-                stream=True
-            )
-        except Exception as e:
-            logger.error(f"error:\n\n ask: {message} \n with error {e}")
-
-            # 创建一个空的异步生成器
-            async def empty_generator():
-                if False:  # 这将永远不会执行
-                    yield
-
-            answer = empty_generator()
-        return answer
+        return or_error(self.ask_stream(message, dialog_messages, prompt),
+                        "sth wrong with claude, please try again later.",
+                        message)
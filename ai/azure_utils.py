@@ -7,9 +7,15 @@
 # License:
 # Description: use openai to generate text for chatgpt and azure openai
 
-import tiktoken
-from openai import AzureOpenAI
+from typing import Optional
 
+import httpx
+from openai import AsyncAzureOpenAI
+
+from ai.context import ContextTooLong, newest_window
+from ai.http import async_http_client
+from ai.stream import or_error
+from ai.tokens import count_tokens, turn_tokens
 from config import config
 from logs.log import logger
 
@@ -20,17 +26,29 @@ class OpenAIService:
     }
 
     def __init__(self, model_name: str = 'gpt-35-turbo-16k',
-                 api_type: str = 'azure', max_token: int = 16000, **kwargs):
+                 api_type: str = 'azure', max_token: int = 16000,
+                 endpoint: Optional[str] = None,
+                 api_key: Optional[str] = None,
+                 api_version: Optional[str] = None,
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 max_retries: int = 2, **kwargs):
         """
         use gpt-3.5-turbo by default
+        :param endpoint, api_key, api_version: of azure openai, the ones in
+         config by default
+        :param http_client: the pooled client the requests are sent with,
+         one of its own by default
+        :param max_retries: retries of the sdk, 0 when the caller retries
         """
         self.model_name = model_name
         self.api_type = api_type
         self.max_token = max_token
-        self.azure_client = AzureOpenAI(
-            azure_endpoint=config.azure_openai_endpoint,
-            api_version=config.azure_openai_api_version,
-            api_key=config.azure_openai_api_key
+        self.azure_client = AsyncAzureOpenAI(
+            azure_endpoint=endpoint or config.azure_openai_endpoint,
+            api_version=api_version or config.azure_openai_api_version,
+            api_key=api_key or config.azure_openai_api_key,
+            http_client=http_client or async_http_client(),
+            max_retries=max_retries
         )
 
     def gen_options(self, messages):
@@ -54,16 +72,20 @@ class OpenAIService:
         """
 
         messages = []
+        prompt_tokens = self.count_tokens(message)
         # tell system the role you want it to play
         if not dialog_messages:
             messages.append({"role": "system", "content": prompt})
-        # take the message from the user
-        ct = ' '.join([msg['content'] for msg in dialog_messages])
-        rq_token = self.count_tokens(message + ct)
-        while rq_token > self.max_token - 200:
-            messages = messages[1:]
-            ct = ' '.join([msg['content'] for msg in messages])
-            rq_token = self.count_tokens(message + ct)
+            prompt_tokens += self.count_tokens(prompt or '')
+        budget = self.max_token - 200
+        if prompt_tokens > budget:
+            raise ContextTooLong(
+                "Token exceed limit, please short your message")
+        # keep the latest turns that fit, with the token counts stored
+        # with the turns
+        dialog_messages = newest_window(
+            dialog_messages, lambda msg: turn_tokens(msg, self.count_tokens),
+            budget, prompt_tokens=prompt_tokens)
 
         for msg in dialog_messages:
             messages.append({"role": "user", "content": msg["user"]})
@@ -71,29 +93,52 @@ class OpenAIService:
         messages.append({"role": "user", "content": message})
         return messages
 
+    async def ask(self, message, dialog_messages=None, prompt=None) -> str:
+        """Ask openai, raise the errors"""
+        messages = self._generate_msg(message, dialog_messages or [], prompt)
+        r = await self.azure_client.chat.completions.create(
+            **self.gen_options(messages))
+        return r.choices[0].message.content
+
+    async def ask_stream(self, message, dialog_messages=None, prompt=None):
+        """Ask openai in stream mode, yield the text pieces, raise the
+        errors"""
+        messages = self._generate_msg(message, dialog_messages or [], prompt)
+        stream = await self.azure_client.chat.completions.create(
+            stream=True, **self.gen_options(messages))
+        async for chunk in stream:
+            # azure sends the content filter results in a chunk without
+            # choices first
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
     async def send_message(self, message, dialog_messages=None,
                            prompt=None):
         """
         Send message to ask openai, same as send_message_stream, but not use
         stream mode
         """
-        if dialog_messages is None:
-            dialog_messages = []
         try:
-            messages = self._generate_msg(message, dialog_messages, prompt)
-            r = self.azure_client.chat.completions.create(
-                **self.gen_options(messages))
-            answer = r.choices[0].message.content
+            answer = await self.ask(message, dialog_messages, prompt)
+        except ContextTooLong as e:
+            answer = str(e)
         except Exception as e:
             logger.error(f"error:\n\n ask: {message} \n with error {e}")
             answer = f"sth went wrong"
 
         return answer
 
+    def send_message_stream(self, message, dialog_messages=None,
+                            prompt=None):
+        """
+        Send message to ask openai with stream response, yield the text pieces
+        """
+        return or_error(self.ask_stream(message, dialog_messages, prompt),
+                        "sth went wrong", message)
+
     @staticmethod
     def count_tokens(text: str, encoding_name: str = "cl100k_base"):
         """
         count token
         """
-        encoding = tiktoken.get_encoding(encoding_name)
-        return len(encoding.encode(text))
+        return count_tokens(text, encoding_name)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: cache.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: cache of the ai answers, addressed by what is sent to the ai
+# (model, chat mode, prompt, message and context). An lru in memory, and
+# optionally a sqlite file the answers outlive a restart in, or a database
+# the workers of the bot share them in.
+#
+#   key = ResponseCache.key(model, chat_mode, prompt, message, context)
+#   answer = await cache.get(key)
+#   if answer is None:
+#       answer = await ask_ai(...)
+#       await cache.set(key, answer)
+import asyncio
+import hashlib
+import json
+import time
+from concurrent.futures import Executor
+from typing import Optional
+
+from cachetools import TLRUCache
+from sqlalchemy import Column, Float, MetaData, String, Table, Text, \
+    delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database.engine import create_db_engine
+
+metadata = MetaData()
+response_cache_table = Table(
+    'response_cache', metadata,
+    Column('key', String(64), primary_key=True),
+    Column('answer', Text, nullable=False),
+    Column('expires_at', Float, nullable=False),
+)
+
+
+def normalize(text: Optional[str]) -> str:
+    """Whitespace doesn't change the answer"""
+    return ' '.join((text or '').split())
+
+
+class ResponseCache:
+    """Answers expire `ttl` seconds after they are cached (or the ttl given
+    with the answer), the least recently used one is evicted from memory
+    when it's full. hits/misses are counted to check the hit rate.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600,
+                 db_path: Optional[str] = None,
+                 executor: Optional[Executor] = None, clock=time.time):
+        """
+        :param db_path: sqlite file or sqlalchemy url of the database of the
+         second tier, memory only if None
+        :param executor: the database io runs in, the db executor of the
+         bot, the default executor of the loop if None
+        """
+        self.ttl = ttl
+        self.clock = clock
+        # the value is (answer, expire time)
+        self._memory = TLRUCache(maxsize=maxsize,
+                                 ttu=lambda key, value, now: value[1],
+                                 timer=clock)
+        self._db = None
+        self._executor = executor
+        self._writes = 0
+        if db_path:
+            if '://' not in db_path:
+                db_path = f'sqlite:///{db_path}'
+            self._db = create_db_engine(db_path)
+            metadata.create_all(self._db)
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, chat_mode: str, prompt: Optional[str], message: str,
+            context: Optional[list] = None) -> str:
+        """Hash of what's sent to the ai"""
+        turns = [[normalize(t.get('user')), normalize(t.get('assistant'))]
+                 for t in context or []]
+        data = json.dumps([model.lower(), chat_mode, normalize(prompt),
+                           normalize(message), turns], ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _db_get(self, key: str) -> Optional[tuple]:
+        table = response_cache_table
+        with self._db.connect() as conn:
+            row = conn.execute(
+                select(table.c.answer, table.c.expires_at).where(
+                    table.c.key == key,
+                    table.c.expires_at > self.clock())).first()
+        return tuple(row) if row is not None else None
+
+    def _db_set(self, key: str, answer: str, expires_at: float):
+        table = response_cache_table
+        values = {'answer': answer, 'expires_at': expires_at}
+        try:
+            # upsert the portable way, no dialect has the same syntax
+            with self._db.begin() as conn:
+                if not conn.execute(update(table).where(
+                        table.c.key == key).values(**values)).rowcount:
+                    conn.execute(insert(table).values(key=key, **values))
+        except IntegrityError:
+            # another worker cached it first, the answer is as good
+            pass
+        self._writes += 1
+        # drop the expired answers now and then
+        if self._writes % 100 == 0:
+            with self._db.begin() as conn:
+                conn.execute(delete(table).where(
+                    table.c.expires_at <= self.clock()))
+
+    async def get(self, key: str) -> Optional[str]:
+        """The answer cached, None if there is none"""
+        value = self._memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value[0]
+        if self._db is not None:
+            # the database io runs out of the event loop
+            value = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._db_get, key)
+            if value is not None:
+                self.db_hits += 1
+                self._memory[key] = value
+                return value[0]
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, answer: str, ttl: Optional[float] = None):
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+        self._memory[key] = (answer, expires_at)
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._db_set, key, answer, expires_at)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.db_hits + self.misses
+        return (self.memory_hits + self.db_hits) / total if total else 0.0
+
+    def report(self) -> dict:
+        return {'memory_hits': self.memory_hits, 'db_hits': self.db_hits,
+                'misses': self.misses, 'hit_rate': self.hit_rate,
+                'size': len(self._memory)}
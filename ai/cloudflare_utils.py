@@ -6,19 +6,33 @@
 # Copyright: 2023 Zhou
 # License:
 # Description: cloudflare worker AI
-import requests
+import json
+from typing import Optional
 
+import httpx
+
+from ai.http import async_http_client
+from ai.stream import or_error
 from logs.log import logger
 
 
 class CloudflareAIService:
 
     def __init__(self, token, account_id,
-                 model_name='@cf/meta/llama-2-7b-chat-int8'):
+                 model_name='@cf/meta/llama-2-7b-chat-int8',
+                 base_url: Optional[str] = None,
+                 http_client: Optional[httpx.AsyncClient] = None):
+        """
+        :param base_url: workers ai api, the cloudflare one of the account
+         by default
+        :param http_client: the pooled client the requests are sent with,
+         one of its own by default
+        """
         self.model = model_name
         self.token = token
-        self.API_BASE_URL = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/"
+        self.API_BASE_URL = base_url or f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/"
         self.headers = {"Authorization": self.token}
+        self.client = http_client or async_http_client()
 
     @staticmethod
     def _gen_msg(q_msg, dialog_messages, prompt):
@@ -43,21 +57,51 @@ class CloudflareAIService:
             answer = answer.replace(s, "")
         return answer
 
-    def send_message(self, message, dialog_messages=None, prompt=None):
-        if dialog_messages is None:
-            dialog_messages = []
+    async def ask(self, message, dialog_messages=None, prompt=None) -> str:
+        """Ask workers ai, raise the errors"""
+        data = {"messages": self._gen_msg(message, [], prompt)}
+        response = await self.client.post(
+            f"{self.API_BASE_URL}{self.model}", headers=self.headers,
+            json=data)
+        response.raise_for_status()
+        response = response.json()
+        """
+        {'result': {'response': "I apologize "}, 'success': True, 'errors': [], 'messages': []}
+        """
+        if not response['success']:
+            raise RuntimeError(response['errors'][0])
+        return self.parse_answer(response['result']['response'])
+
+    async def ask_stream(self, message, dialog_messages=None, prompt=None):
+        """Stream the answer, raise the errors. Workers ai sends server-sent
+        events: data: {"response": "piece"} ... data: [DONE]
+        """
+        data = {"messages": self._gen_msg(message, [], prompt),
+                "stream": True}
+        async with self.client.stream(
+                "POST", f"{self.API_BASE_URL}{self.model}",
+                headers=self.headers, json=data) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                line = line[len('data:'):].strip()
+                if line == '[DONE]':
+                    break
+                text = self.parse_answer(json.loads(line).get('response', ''))
+                if text:
+                    yield text
+
+    async def send_message(self, message, dialog_messages=None, prompt=None):
         try:
-            data = {"messages": self._gen_msg(message,[], prompt)}
-            response = requests.post(f"{self.API_BASE_URL}{self.model}",
-                                     headers=self.headers,
-                                     json=data).json()
-            """
-            {'result': {'response': "I apologize "}, 'success': True, 'errors': [], 'messages': []}
-            """
-            if response['success']:
-                return self.parse_answer(response['result']['response'])
-            return response['errors'][0]
+            answer = await self.ask(message, dialog_messages, prompt)
         except Exception as e:
             logger.error(f"error:\n\n ask: {message} \n with error {e}")
             answer = f"sth went wrong"
         return answer
+
+    def send_message_stream(self, message, dialog_messages=None,
+                            prompt=None):
+        """Stream the answer, yield the text pieces"""
+        return or_error(self.ask_stream(message, dialog_messages, prompt),
+                        "sth went wrong", message)
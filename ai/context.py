@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: context.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: context window of a dialog, shared by the ai services
+from typing import Callable, Sequence, Union
+
+
+class ContextTooLong(ValueError):
+    """The message doesn't fit in the token limit of the model: the request
+    is at fault, not the provider"""
+
+
+def window_start(counts: Union[Sequence[int], Callable[[int], int]],
+                 n: int, budget: int) -> int:
+    """Index of the oldest turn of the newest window of the n turns whose
+    tokens fit in budget, n if not even the latest turn fits.
+    Walks back from the latest turn, so only the turns in the window (and
+    the one before) are counted.
+
+    :param counts: token count of each turn, or a function counting the
+     tokens of the turn at an index
+    """
+    count = counts if callable(counts) else counts.__getitem__
+    total = 0
+    for i in range(n - 1, -1, -1):
+        total += count(i)
+        if total > budget:
+            return i + 1
+    return 0
+
+
+def newest_window(turns: Sequence[dict],
+                  counts: Union[Sequence[int], Callable[[dict], int]],
+                  budget: int, prompt_tokens: int = 0) -> list:
+    """The newest turns which fit in the budget along with the prompt
+
+        turns = newest_window(dialog_messages, turn_tokens, 4000,
+                              prompt_tokens=count_tokens(prompt + message))
+
+    :param turns: [{'user': "", 'assistant': ""}], oldest first
+    :param counts: token count of each turn, or a function counting the
+     tokens of a turn, it's called for the turns looked at only
+    :param budget: tokens of the prompt and the turns
+    :param prompt_tokens: tokens of what's sent besides the turns (prompt,
+     message...)
+    """
+    if callable(counts):
+        def count(i):
+            return counts(turns[i])
+    else:
+        count = counts
+    start = window_start(count, len(turns), budget - prompt_tokens)
+    return list(turns[start:])
@@ -8,42 +8,87 @@ from typing import Optional
 # Copyright: 2023 Zhou
 # License:
 # Description:  google paLM2 service
-import google.generativeai as palm
-from google.ai.generativelanguage_v1beta2 import DiscussServiceAsyncClient
-from google.generativeai import count_message_tokens
-from google.generativeai.discuss import DEFAULT_DISCUSS_MODEL
-from google.generativeai.types import MessagePromptOptions, discuss_types
+import google.ai.generativelanguage_v1beta2 as glm
+from google.ai.generativelanguage_v1beta2 import (
+    DiscussServiceAsyncClient,
+    TextServiceAsyncClient,
+)
+from google.generativeai.discuss import chat_async
 
+from ai.context import ContextTooLong, newest_window
+from ai.stream import or_error, single_chunk
+from ai.tokens import count_tokens, turn_tokens
 from logs.log import logger
 
 
+def message_prompt(context: str, message: str,
+                   examples=None) -> glm.MessagePrompt:
+    """The prompt of a chat request, the examples are (input, output) text
+    pairs or glm.Example"""
+    return glm.MessagePrompt(
+        context=context,
+        examples=[example if isinstance(example, glm.Example) else
+                  glm.Example(input=glm.Message(content=example[0]),
+                              output=glm.Message(content=example[1]))
+                  for example in examples or []],
+        messages=[glm.Message(content=message)])
+
+
 class GoogleAIService:
+    text_model = 'models/text-bison-001'
 
     def __init__(self, api_key: str, model_name='models/chat-bison-001',
-                 max_token: int = 4096):
+                 max_token: int = 4096,
+                 discuss_client: Optional[DiscussServiceAsyncClient] = None,
+                 text_client: Optional[TextServiceAsyncClient] = None):
+        """
+        :param discuss_client, text_client: the async clients the requests
+         are sent with, made on first use by default
+        """
         self.model = model_name
-        palm.configure(api_key=api_key)
         self.max_token = max_token
+        self._client_options = {'api_key': api_key}
+        self._discuss_client = discuss_client
+        self._text_client = text_client
+
+    @property
+    def discuss_client(self) -> DiscussServiceAsyncClient:
+        """Made on first use, in the event loop its grpc channel is bound
+        to, and kept: the requests share the channel"""
+        if self._discuss_client is None:
+            self._discuss_client = DiscussServiceAsyncClient(
+                client_options=self._client_options)
+        return self._discuss_client
+
+    @property
+    def text_client(self) -> TextServiceAsyncClient:
+        if self._text_client is None:
+            self._text_client = TextServiceAsyncClient(
+                client_options=self._client_options)
+        return self._text_client
+
+    async def generate_text(self, prompt: str) -> Optional[str]:
+        rsp = await self.text_client.generate_text(
+            model=self.text_model, prompt=glm.TextPrompt(text=prompt))
+        return rsp.candidates[0].output if rsp.candidates else None
 
     async def en2zh(self, message):
         """translate english to chinese
         it's weak for now
         """
         prompt = f"Please translate the following sentence into Chinese(return the translated sentence only): {message}"
-        rsp = palm.generate_text(prompt=prompt)
-        return rsp.result
+        return await self.generate_text(prompt)
 
     async def zh2en(self, message):
         """translate chinese to english
         it's weak for now
         """
         prompt = f"Please translate the following sentence into english(return the translated sentence only): '{message}'"
-        rsp = palm.generate_text(prompt=prompt)
-        return rsp.result
+        return await self.generate_text(prompt)
 
-    async def send_message(self, message, dialog_messages=None,
-                           examples=None, prompt=None):
-        """send message to palm
+    async def ask(self, message, dialog_messages=None, prompt=None,
+                  examples=None) -> str:
+        """Ask palm, raise the errors
         :examples: example tuple
         examples = [
             ("What's up?", # A hypothetical user input
@@ -53,61 +98,83 @@ class GoogleAIService:
               "How can you be bored when there are so many fun, exciting, beautiful experiences to be had in the world? 🌈")
         ]
         """
-        if dialog_messages is None:
-            dialog_messages = []
+        dialogs = dialog_messages or []
+        if dialogs:
+            # the prompt starts a new dialog only, not the trimmed ones
+            prompt = None
+        budget = self.max_token - 200
+        while True:
+            context, kept = self.gen_context(message, dialogs, prompt, budget)
+            request = message_prompt(context, message, examples)
+            tokens = await self.count_tokens(request)
+            if self.max_token - tokens >= 10:
+                break
+            if not kept:
+                raise ContextTooLong(
+                    "Token exceed limit, please short your message")
+            # the turns were trimmed on the local estimate, trim them again
+            # scaled by the count of palm, one turn less at least
+            estimate = 2 * count_tokens(message) + sum(
+                turn_tokens(msg) for msg in kept)
+            budget = min(budget, (self.max_token - 10) * estimate // tokens)
+            dialogs = kept[1:]
+        response = await chat_async(model=self.model, prompt=request,
+                                    candidate_count=1,
+                                    client=self.discuss_client)
+        return response.last
 
-        context, rs_max_token = self.gen_context(message, dialog_messages,
-                                                 prompt)
-        if rs_max_token < 10:
-            return "Token exceed limit, please short your message"
-        try:
-            response = palm.chat(model=self.model, messages=message,
-                                 context=context, examples=examples,
-                                 candidate_count=1)
-            answer = response.last
+    def ask_stream(self, message, dialog_messages=None, prompt=None):
+        """PaLM chat api has no stream mode, the whole answer is yielded
+        as one piece"""
+        return single_chunk(self.ask(message, dialog_messages, prompt))
 
+    async def send_message(self, message, dialog_messages=None,
+                           examples=None, prompt=None):
+        """send message to palm, see ask for the examples"""
+        try:
+            answer = await self.ask(message, dialog_messages, prompt,
+                                    examples)
+        except ContextTooLong as e:
+            answer = str(e)
         except Exception as e:
             logger.error(f"error:\n\n ask: {message} \n with error {e}")
             answer = f"sth went wrong with palm, please try again later."
         return answer
 
-    def gen_context(self, message, dialog_message: list, prompt: str = None):
+    def send_message_stream(self, message, dialog_messages=None,
+                            prompt=None):
+        """PaLM chat api has no stream mode, the whole answer is yielded
+        as one piece"""
+        return or_error(self.ask_stream(message, dialog_messages, prompt),
+                        "sth went wrong with palm, please try again later.",
+                        message)
+
+    def gen_context(self, message, dialog_message: list, prompt: str = None,
+                    max_token: Optional[int] = None):
         """generate context
-        calculate context token
-        calculate message token
-        rsp_max_token = total_token - context_token - message_token
-        if message_token > throttle token then return
-        if message_token + context_token > total_token then shorter context
+        keep the latest turns which fit in max_token (self.max_token - 200
+        by default) along with the message, the tokens are estimated with
+        the counts stored with the turns (no api call)
+        return the context and the turns kept
         """
+        if max_token is None:
+            max_token = self.max_token - 200
         context = []
-        rs_max_token = 4096
-        if not dialog_message:
+        if not dialog_message and prompt:
             context.append(prompt)
+        # the message is sent in the context and as the message
+        message_tokens = 2 * count_tokens(message)
+        dialog_message = newest_window(dialog_message, turn_tokens,
+                                       max_token,
+                                       prompt_tokens=message_tokens)
         for msg in dialog_message:
             context.append(f'User said: {msg["user"]}\n')
             context.append(f'Your answer is:  {msg["assistant"]}\n')
         context.append(f'User said: {message}\n')
-        ct = ' '.join(context)
-
-        rq_token = self.count_tokens(messages=message, context=ct)
-        while rq_token > self.max_token - 200:
-            context = context[150:]
-            rq_token = self.count_tokens(messages=message,
-                                         context=''.join(context))
-
-        return ''.join(context), rs_max_token
-
-    def count_tokens(
-            self, *,
-            prompt: MessagePromptOptions = None,
-            context: Optional[str] = None,
-            examples: Optional[discuss_types.ExamplesOptions] = None,
-            messages: Optional[discuss_types.MessagesOptions] = None,
-            model: str = DEFAULT_DISCUSS_MODEL,
-            client: Optional[DiscussServiceAsyncClient] = None):
-        """count tokens"""
-        model = self.model or model
-        d = count_message_tokens(prompt=prompt, context=context,
-                                 examples=examples, messages=messages,
-                                 model=model, client=client)
-        return d.get('token_count')
+        return ''.join(context), dialog_message
+
+    async def count_tokens(self, prompt: glm.MessagePrompt) -> int:
+        """count tokens of the whole prompt, in one call"""
+        rsp = await self.discuss_client.count_message_tokens(model=self.model,
+                                                             prompt=prompt)
+        return rsp.token_count
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: http.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: pooled async http clients of the ai services
+import httpx
+
+from config import config
+
+
+def async_http_client(timeout: float = None, connect_timeout: float = None,
+                      max_connections: int = None, **kwargs
+                      ) -> httpx.AsyncClient:
+    """An async client keeping its connections alive between requests, so
+    a request doesn't pay a tcp and tls handshake each time. One per service
+    (per api host) and shared by its requests.
+
+    :param timeout: seconds to wait for the response (between two pieces
+     when streaming)
+    :param connect_timeout: seconds to wait for a connection
+    :param max_connections: requests sent at once, the others wait for a
+     connection of the pool
+    """
+    timeout = config.ai_timeout if timeout is None else timeout
+    connect_timeout = config.ai_connect_timeout if connect_timeout is None \
+        else connect_timeout
+    max_connections = config.ai_max_connections if max_connections is None \
+        else max_connections
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_connections,
+                            keepalive_expiry=60),
+        **kwargs)
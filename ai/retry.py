@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: retry.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: retry of the transient errors of the ai providers, with
+# exponential backoff and full jitter, honoring Retry-After, within a
+# deadline. The sdk clients retry nothing themselves (max_retries=0), so a
+# request is retried by one policy only.
+#
+#   policy = RetryPolicy(attempts=3, deadline=60)
+#   answer = await policy.call('claude', service.ask, message, context)
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+# timeout, conflict, too early, too many requests, server errors
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+
+def status_code(exc: BaseException) -> Optional[int]:
+    """Http status of the error of an sdk (openai, anthropic, httpx, google
+    api core), None if it has none"""
+    code = getattr(exc, 'status_code', None)
+    if code is None and isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+    if code is None:
+        code = getattr(exc, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+def retryable(exc: BaseException) -> bool:
+    """The error may not happen again: a timeout, a connection error, a
+    rate limit or an error of the server"""
+    code = status_code(exc)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    # the connection errors of the openai and anthropic sdks (the timeouts
+    # are ones) wrap the httpx ones
+    return isinstance(exc, (asyncio.TimeoutError, ConnectionError,
+                            httpx.TransportError)) or \
+        isinstance(exc.__cause__, httpx.TransportError) or \
+        any(c.__name__ == 'APIConnectionError' for c in type(exc).__mro__)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the server asks to wait, from the Retry-After header of the
+    response of the error"""
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None)
+    value = headers.get('retry-after') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(),
+                   0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryMetrics:
+    """Attempts and outcomes of the requests of a provider"""
+
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.successes = 0
+        self.failures = 0
+        # failed on an error not worth retrying
+        self.permanent = 0
+        # the deadline or the attempts ran out
+        self.exhausted = 0
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class RetryPolicy:
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5,
+                 max_delay: float = 8.0, deadline: float = 60.0,
+                 rng: Optional[random.Random] = None, sleep=asyncio.sleep,
+                 clock=time.monotonic):
+        """
+        :param attempts: attempts of a request, 1 is no retry
+        :param base_delay: seconds before the first retry, doubled each time
+         up to max_delay, the actual wait is a random part of it
+        :param deadline: seconds from the first attempt after which no retry
+         is started
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.rng = rng or random.Random()
+        self.sleep = sleep
+        self.clock = clock
+        self.metrics: Dict[str, RetryMetrics] = {}
+
+    def delay(self, attempt: int, exc: BaseException) -> float:
+        """Seconds to wait after the failed attempt (1 based)"""
+        after = retry_after(exc)
+        if after is not None:
+            return after
+        return self.rng.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def _should_retry(self, name: str, attempt: int,
+                            exc: BaseException, start: float) -> bool:
+        """Wait before the next attempt, False if there is none"""
+        metrics = self.metrics[name]
+        if not retryable(exc):
+            metrics.permanent += 1
+            return False
+        delay = self.delay(attempt, exc)
+        if attempt >= self.attempts or \
+                self.clock() + delay - start > self.deadline:
+            metrics.exhausted += 1
+            return False
+        metrics.retries += 1
+        await self.sleep(delay)
+        return True
+
+    async def call(self, name: str, func, *args, **kwargs):
+        """Await func(*args, **kwargs), retried on the transient errors
+        :param name: of the provider, the metrics are kept per name
+        """
+        metrics = self.metrics.setdefault(name, RetryMetrics())
+        start = self.clock()
+        attempt = 0
+        while True:
+            attempt += 1
+            metrics.attempts += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if await self._should_retry(name, attempt, e, start):
+                    continue
+                metrics.failures += 1
+                raise
+            metrics.successes += 1
+            return result
+
+    async def stream(self, name: str, func, *args,
+                     **kwargs) -> AsyncIterator[str]:
+        """Pass the pieces of func(*args, **kwargs) through, retried on the
+        transient errors until the first piece: an answer half sent can't
+        be taken back"""
+        metrics = self.metrics.setdefault(name, RetryMetrics())
+        start = self.clock()
+        attempt = 0
+        while True:
+            attempt += 1
+            metrics.attempts += 1
+            answered = False
+            try:
+                async for text in func(*args, **kwargs):
+                    answered = True
+                    yield text
+            except Exception as e:
+                if not answered and \
+                        await self._should_retry(name, attempt, e, start):
+                    continue
+                metrics.failures += 1
+                raise
+            metrics.successes += 1
+            return
+
+    def report(self) -> Dict[str, dict]:
+        return {name: m.to_dict() for name, m in self.metrics.items()}
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: router.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: route the questions over the ai providers, keep the rolling
+# latency and error rate of each, fail over to the fastest healthy one and
+# optionally hedge a second provider when the first is slow
+#
+#   router = ProviderRouter({'claude': anthropic_service, ...},
+#                           fallbacks=['azure_openai'], hedge_delay=3)
+#   answer = await router.ask('claude', message, context, prompt)
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Union
+
+from ai.admission import AdmissionController, Overloaded, Ticket
+from ai.context import ContextTooLong
+from ai.retry import RetryPolicy
+from logs.log import logger
+
+
+class ProvidersFailed(Exception):
+    """None of the providers tried answered"""
+
+
+class ProvidersBusy(ProvidersFailed):
+    """The queues of the providers tried are full"""
+
+
+class ProviderStats:
+    """Latency and outcome of the latest `window` requests of a provider.
+    The latency is the time to the answer, or to its first piece when
+    streamed."""
+
+    def __init__(self, window: int = 100):
+        self.latencies = deque(maxlen=window)
+        self.errors = deque(maxlen=window)
+
+    def record(self, latency: Optional[float], error: bool = False):
+        self.errors.append(error)
+        if not error:
+            self.latencies.append(latency)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """p-th percentile (0-100) of the latencies, None before any"""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p / 100),
+                             len(latencies) - 1)]
+
+    @property
+    def p50(self) -> Optional[float]:
+        return self.percentile(50)
+
+    @property
+    def p95(self) -> Optional[float]:
+        return self.percentile(95)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.errors) / len(self.errors) if self.errors else 0.0
+
+    @property
+    def requests(self) -> int:
+        return len(self.errors)
+
+    def to_dict(self) -> dict:
+        return {'requests': self.requests, 'p50': self.p50, 'p95': self.p95,
+                'error_rate': self.error_rate}
+
+
+class ProviderRouter:
+    """Ask the provider of the model chosen first, and fail over to the
+    fallbacks, fastest p95 first, when it fails or is unhealthy (error rate
+    over max_error_rate). With a hedge_delay, the next provider is asked
+    too when the first hasn't answered after hedge_delay seconds, the first
+    answer wins and the other request is cancelled.
+
+    With a retry policy, the transient errors of a provider are retried
+    before failing over.
+
+    With max_in_flight, at most that many requests are sent to a provider
+    at once, max_queue more wait for their turn and the next ones fail over
+    at once (ProvidersBusy if all the providers are full).
+
+    The providers are the ai services: ask(message, dialog_messages,
+    prompt) and ask_stream(...) raising their errors.
+    """
+
+    def __init__(self, providers: dict, fallbacks: Optional[list] = None,
+                 hedge_delay: Optional[float] = None,
+                 max_error_rate: float = 0.5, min_requests: int = 5,
+                 window: int = 100,
+                 max_in_flight: Union[int, dict, None] = None,
+                 max_queue: int = 0, retry: Optional[RetryPolicy] = None,
+                 clock=time.monotonic):
+        """
+        :param providers: {name: service}, a model is routed to the first
+         provider whose name is in the model name
+        :param fallbacks: names of the providers to fail over to, none by
+         default
+        :param hedge_delay: seconds before asking a second provider, no
+         hedging if None or 0
+        :param min_requests: requests of a provider before its error rate
+         counts
+        :param max_in_flight: requests sent at once to a provider, or
+         {name: requests} per provider, no limit if None
+        :param max_queue: requests waiting for a provider
+        :param retry: policy retrying the requests to a provider, no retry
+         if None
+        """
+        self.providers = providers
+        self.fallbacks = [f for f in fallbacks or [] if f in providers]
+        self.hedge_delay = hedge_delay or None
+        self.max_error_rate = max_error_rate
+        self.min_requests = min_requests
+        self.retry = retry
+        self.clock = clock
+        self.stats: Dict[str, ProviderStats] = {
+            name: ProviderStats(window) for name in providers}
+        self.admission: Dict[str, AdmissionController] = {}
+        for name in providers:
+            limit = max_in_flight.get(name) \
+                if isinstance(max_in_flight, dict) else max_in_flight
+            if limit:
+                self.admission[name] = AdmissionController(limit, max_queue)
+
+    def provider_name(self, ai_name: str) -> Optional[str]:
+        """The provider of a model, None if no provider serves it"""
+        ai_name = ai_name.lower()
+        for name in self.providers:
+            if name in ai_name:
+                return name
+        return None
+
+    def healthy(self, name: str) -> bool:
+        stats = self.stats[name]
+        return stats.requests < self.min_requests or \
+            stats.error_rate <= self.max_error_rate
+
+    def candidates(self, ai_name: str) -> List[str]:
+        """The providers to ask in order: the one of the model, then the
+        fallbacks by p95 latency (the unknown ones first, to measure them),
+        the unhealthy ones last"""
+        first = self.provider_name(ai_name)
+        others = sorted(
+            (f for f in self.fallbacks if f != first),
+            key=lambda f: (self.stats[f].p95 is not None,
+                           self.stats[f].p95 or 0))
+        order = ([first] if first else []) + others
+        return [n for n in order if self.healthy(n)] + \
+            [n for n in order if not self.healthy(n)]
+
+    async def _admit(self, name: str, ticket: Optional[Ticket]):
+        """Wait for a slot of the provider, None if it has no limit"""
+        controller = self.admission.get(name)
+        if controller is not None:
+            await controller.acquire(ticket)
+        return controller
+
+    async def _ask_one(self, name: str, message, dialog_messages, prompt,
+                       ticket: Optional[Ticket] = None):
+        controller = await self._admit(name, ticket)
+        start = self.clock()
+        ask = self.providers[name].ask
+        try:
+            if self.retry is not None:
+                answer = await self.retry.call(name, ask, message,
+                                               dialog_messages, prompt)
+            else:
+                answer = await ask(message, dialog_messages, prompt)
+        except ContextTooLong:
+            # the message is at fault, not the provider
+            raise
+        except Exception as e:
+            self.stats[name].record(None, error=True)
+            logger.error(f"provider {name} failed: {e}")
+            raise
+        finally:
+            if controller is not None:
+                controller.release()
+        self.stats[name].record(self.clock() - start)
+        return answer
+
+    @staticmethod
+    def _failed(ai_name: str, error: Optional[Exception]):
+        if isinstance(error, Overloaded):
+            failed = ProvidersBusy(f"providers of {ai_name} are busy: {error}")
+        else:
+            failed = ProvidersFailed(f"no provider answered {ai_name}: {error}")
+        # the handlers tell the user why, e.g. ContextTooLong
+        failed.__cause__ = error
+        return failed
+
+    async def ask(self, ai_name: str, message, dialog_messages=None,
+                  prompt=None, ticket: Optional[Ticket] = None) -> str:
+        """The first answer of the providers of the model
+        :param ticket: tells the place in the queue of the provider
+        :raise ProvidersFailed: when none answered
+        """
+        candidates = iter(self.candidates(ai_name))
+        pending = {}
+        hedged = False
+        error = None
+
+        def start_next() -> bool:
+            name = next(candidates, None)
+            if name is None:
+                return False
+            task = asyncio.create_task(
+                self._ask_one(name, message, dialog_messages, prompt,
+                              ticket))
+            pending[task] = name
+            return True
+
+        if not start_next():
+            raise ProvidersFailed(f"no provider for {ai_name}")
+        try:
+            while pending:
+                timeout = self.hedge_delay if not hedged else None
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # slow, hedge with the next provider
+                    hedged = True
+                    if start_next():
+                        logger.info(f"hedging {ai_name}")
+                    continue
+                for task in done:
+                    del pending[task]
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    if isinstance(error, ContextTooLong):
+                        # too long for the others too, no failing over
+                        raise self._failed(ai_name, error)
+                if not pending:
+                    start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise self._failed(ai_name, error)
+
+    async def ask_stream(self, ai_name: str, message, dialog_messages=None,
+                         prompt=None, ticket: Optional[Ticket] = None
+                         ) -> AsyncIterator[str]:
+        """Stream the answer of the first provider which starts answering.
+        It fails over only before the first piece: an answer half sent
+        can't be taken back. Not hedged.
+        :raise ProvidersFailed: when none answered
+        """
+        error = None
+        for name in self.candidates(ai_name):
+            try:
+                controller = await self._admit(name, ticket)
+            except Overloaded as e:
+                error = e
+                continue
+            start = self.clock()
+            answered = False
+            ask_stream = self.providers[name].ask_stream
+            if self.retry is not None:
+                stream = self.retry.stream(name, ask_stream, message,
+                                           dialog_messages, prompt)
+            else:
+                stream = ask_stream(message, dialog_messages, prompt)
+            try:
+                async for text in stream:
+                    if not answered:
+                        answered = True
+                        self.stats[name].record(self.clock() - start)
+                    yield text
+                if not answered:
+                    self.stats[name].record(self.clock() - start)
+                return
+            except Exception as e:
+                if answered:
+                    raise
+                if isinstance(e, ContextTooLong):
+                    # too long for the others too, no failing over
+                    raise self._failed(ai_name, e)
+                self.stats[name].record(None, error=True)
+                logger.error(f"provider {name} failed: {e}")
+                error = e
+            finally:
+                if controller is not None:
+                    controller.release()
+        raise self._failed(ai_name, error)
+
+    def report(self) -> Dict[str, dict]:
+        """{provider: {'requests', 'p50', 'p95', 'error_rate'}} and
+        {'in_flight', 'queued', 'rejected'} for the providers limited"""
+        report = {name: stats.to_dict() for name, stats in self.stats.items()}
+        for name, controller in self.admission.items():
+            report[name].update(controller.to_dict())
+        if self.retry is not None:
+            for name, metrics in self.retry.report().items():
+                report[name]['retry'] = metrics
+        return report
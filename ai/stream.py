@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: stream.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: helpers for the streaming interface of the ai services.
+# send_message_stream(message, dialog_messages=None, prompt=None) of every
+# service is an async iterator of the text pieces of the answer:
+#
+#   async for text in service.send_message_stream(message, context, prompt):
+#       answer += text
+#
+# ask(...) and ask_stream(...) are the same but raise the errors, for the
+# router to fail over on them.
+from typing import AsyncIterator
+
+from logs.log import logger
+
+
+async def single_chunk(answer) -> AsyncIterator[str]:
+    """Stream an answer the api can't stream as one piece, answer is the
+    awaitable of the whole answer"""
+    text = await answer
+    if text:
+        yield text
+
+
+async def or_error(stream: AsyncIterator[str], error: str,
+                   message: str = '') -> AsyncIterator[str]:
+    """Pass the pieces of stream through, log its error and yield `error`
+    instead if it fails before the first piece"""
+    answered = False
+    try:
+        async for text in stream:
+            answered = True
+            yield text
+    except Exception as e:
+        logger.error(f"error:\n\n ask: {message} \n with error {e}")
+        if not answered:
+            yield error
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: tokens.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: token counting, the tiktoken encoders are loaded once
+from functools import lru_cache
+from typing import Callable
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    """The encoder of encoding_name, loaded (and downloaded) on first use
+    only"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def count_tokens(text: str, encoding_name: str = "cl100k_base") -> int:
+    return len(get_encoding(encoding_name).encode(text or ''))
+
+
+def turn_token_count(user: str, assistant: str) -> int:
+    """Token count of a dialog turn, stored with the turn when it's saved"""
+    return count_tokens(user) + count_tokens(assistant)
+
+
+def turn_tokens(turn: dict, count: Callable[[str], int] = count_tokens
+                ) -> int:
+    """Token count of a turn {'user': "", 'assistant': "", 'token_count': n},
+    counted with `count` if the turn was saved without it"""
+    if turn.get('token_count') is not None:
+        return turn['token_count']
+    return count(turn['user']) + count(turn['assistant'])
@@ -1,5 +1,8 @@
 #!/usr/bin/python
 # coding:utf-8
+import asyncio
+import sys
+
 from telegram.ext import (
     CommandHandler,
     MessageHandler,
@@ -25,15 +28,34 @@ from bot.bot import (
     list_ai_model_handle,
     list_user_handle,
     init_menu, stream_handle,
+    stats_handle,
 )
+from bot import db
+from bot.processor import ChatUpdateProcessor
+from bot.webhook import WebhookServer
 from config import config
+from database import engine, init_db
+from database.model_view import LeaseServices
 
+# the updates are handled concurrently, one after the other per chat, across
+# the workers too if the chats are leased in the shared database
+leases = db.services(LeaseServices(engine)) if config.chat_lease_ttl else None
 application = (
-    ApplicationBuilder().token(config.telegram_token).post_init(init_menu).build()
+    ApplicationBuilder().token(config.telegram_token).post_init(init_menu)
+    .concurrent_updates(ChatUpdateProcessor(
+        config.max_concurrent_updates, leases=leases,
+        lease_ttl=config.chat_lease_ttl or 60))
+    .build()
 )
 
 
 def run_bot() -> None:
+    if config.db_migration_dry_run:
+        # only log the pending migrations, the database is left as it is
+        init_db(dry_run=True)
+        sys.exit('migration dry run done, see the log')
+    init_db()
+
     # add handlers
     if len(config.allowed_telegram_usernames) == 0:
         user_filter = filters.ALL
@@ -63,6 +85,9 @@ def run_bot() -> None:
     application.add_handler(
         CommandHandler("stream", stream_handle, filters=user_filter)
     )
+    application.add_handler(
+        CommandHandler("stats", stats_handle, filters=user_filter)
+    )
     application.add_handler(
         CallbackQueryHandler(set_chat_mode_handle, pattern="^set_chat_mode")
     )
@@ -82,7 +107,14 @@ def run_bot() -> None:
     application.add_error_handler(error_handle)
 
     # start the bot
-    application.run_polling()
+    if config.run_mode == "webhook":
+        server = WebhookServer(
+            application, url=config.webhook_url,
+            listen=config.webhook_listen, port=config.webhook_port,
+            path=config.webhook_path, secret_token=config.webhook_secret_token)
+        asyncio.run(server.serve())
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: bench_claude_tokens.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: latency of the claude context trimming against the dialog
+# length, awaiting client.count_tokens twice per turn (before) against the
+# memoized local count and one pass of cumulative sums (now)
+#
+#   python -m benchmark.bench_claude_tokens [rounds]
+import asyncio
+import random
+import string
+import sys
+import time
+
+import anthropic
+
+from ai.anthropic_utils import AnthropicAIService
+
+
+async def solve_context_limit_before(client, max_tokens, dialogs):
+    lgs = [await client.count_tokens(
+        d['user']) + await client.count_tokens(
+        d['assistant']) for d in dialogs]
+    if sum(lgs) > max_tokens:
+        count = 0
+        total = 0
+        for num in lgs:
+            total += num
+            count += 1
+            if total > max_tokens:
+                break
+        dialogs = dialogs[count:]
+    return dialogs
+
+
+def random_text(words: int) -> str:
+    return ' '.join(''.join(random.choices(string.ascii_lowercase, k=6))
+                    for _ in range(words))
+
+
+async def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    client = anthropic.AsyncAnthropic(api_key='bench')
+    service = AnthropicAIService(api_key='bench')
+    print(f'{"turns":>6} {"before ms":>10} {"now ms":>8}')
+    for turns in [10, 50, 200, 1000]:
+        dialogs = [{'user': random_text(30), 'assistant': random_text(120)}
+                   for _ in range(turns)]
+        # every message of a dialog trims the same turns again
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await solve_context_limit_before(client, service.max_tokens,
+                                             dialogs)
+        before = (time.perf_counter() - start) / rounds * 1000
+
+        service.count_tokens.cache_clear()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            service.solve_context_limit(dialogs)
+        now = (time.perf_counter() - start) / rounds * 1000
+        print(f'{turns:>6} {before:>10.2f} {now:>8.2f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: bench_context.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: trimming a 10k turns history to the context budget, dropping
+# the oldest turn and summing again (as the services did) against the
+# newest window of ai.context
+#
+#   python -m benchmark.bench_context [turns] [rounds]
+import random
+import sys
+import time
+
+from ai.context import newest_window
+
+
+def drop_oldest(turns, counts, budget):
+    while turns and sum(counts) > budget:
+        turns, counts = turns[1:], counts[1:]
+    return turns
+
+
+def bench(func, rounds, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(*args)
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rng = random.Random(0)
+    turns = [{'user': f'q{i}', 'assistant': f'a{i}',
+              'token_count': rng.randint(20, 400)} for i in range(n)]
+    counts = [t['token_count'] for t in turns]
+    print(f'{n} turns, ms per trim')
+    print(f'{"budget":>8} {"drop oldest":>12} {"counts":>8} {"lazy":>8}')
+    for budget in [4000, 16000, 100000, sum(counts)]:
+        assert drop_oldest(turns, counts, budget) == newest_window(
+            turns, counts, budget)
+        print(f'{budget:>8} '
+              f'{bench(drop_oldest, rounds, turns, counts, budget):>12.2f} '
+              f'{bench(newest_window, rounds, turns, counts, budget):>8.3f} '
+              f'{bench(newest_window, rounds, turns, lambda t: t["token_count"], budget):>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
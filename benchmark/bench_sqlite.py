@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: bench_sqlite.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: commit throughput of the default sqlite engine against the
+# tuned one (WAL, synchronous NORMAL, busy_timeout...)
+#
+#   python -m benchmark.bench_sqlite [commits] [threads]
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+
+from database.engine import create_db_engine
+from database.model_view import DialogServices, ModelServices, UnitOfWork
+from database.models import Base
+
+
+def run(engine, commits: int, threads: int) -> float:
+    """every commit appends one dialog turn in its own unit of work,
+    return commits per second"""
+    Base.metadata.create_all(engine)
+    models = ModelServices(engine)
+    models.add_new_model('ChatGpt', is_default=True)
+    dialog_db = DialogServices(engine, models)
+
+    def worker(index):
+        user_id = f'user{index}'
+        for i in range(commits // threads):
+            with UnitOfWork(engine):
+                dialog_db.append_dialog_message(
+                    user_id, {'user': f'question {i}' * 20,
+                              'assistant': f'answer {i}' * 50})
+                dialog_db.get_dialog_messages(user_id, limit=10)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, range(threads)))
+    return commits / (time.perf_counter() - start)
+
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f'{commits} commits, {threads} threads')
+    for name, factory in [('default', create_engine),
+                          ('tuned', create_db_engine)]:
+        fd, db_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        engine = factory(f'sqlite:///{db_file}')
+        try:
+            print(f'{name:>8}: {run(engine, commits, threads):8.0f} commits/s')
+        finally:
+            engine.dispose()
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(db_file + suffix):
+                    os.remove(db_file + suffix)
+
+
+if __name__ == '__main__':
+    main()
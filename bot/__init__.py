@@ -1,10 +1,16 @@
 from ai.anthropic_utils import AnthropicAIService
+from ai.cache import ResponseCache
 from ai.cloudflare_utils import CloudflareAIService
 from ai.google_utils import GoogleAIService
 from ai.azure_utils import OpenAIService
+from ai.http import async_http_client
+from ai.retry import RetryPolicy
+from ai.router import ProviderRouter
+from ai.tokens import turn_token_count
 from bot.helper import AzureService
 from config import config
 from database import engine
+from database.aio import AsyncDatabase, db_executor
 from database.model_view import (
     UserServices,
     DialogServices,
@@ -14,23 +20,52 @@ from database.model_view import (
 )
 
 azure_service = AzureService()
-gpt_service = OpenAIService(model_name=config.openai_engine, api_type="chatgpt")
+# both openai services send their requests through one connection pool
+_openai_http_client = async_http_client()
+gpt_service = OpenAIService(model_name=config.openai_engine, api_type="chatgpt",
+                            http_client=_openai_http_client)
+# the router retries the requests of the services it routes, not their sdks
 azure_openai_service = OpenAIService(
-    model_name=config.azure_openai_engine, api_type="azure"
+    model_name=config.azure_openai_engine, api_type="azure",
+    http_client=_openai_http_client, max_retries=0
 )
 palm_service = GoogleAIService(
     api_key=config.palm_api_key, model_name=config.palm_model_name
 )
 anthropic_service = AnthropicAIService(
-    api_key=config.claude_api_key, model_name=config.claude_model_name
+    api_key=config.claude_api_key, model_name=config.claude_model_name,
+    max_retries=0
 )
 
 cloudflare_service = CloudflareAIService(
     token=config.cloudflare_token, account_id=config.cloudflare_account_id,
     model_name=config.cloudflare_model_name)
 
-user_db = UserServices(engine)
-dialog_db = DialogServices(engine)
-ai_model_db = ModelServices(engine)
-prompt_db = PromptServices(engine)
-role_db = RoleServices(engine)
+# the models are routed to their provider by name, with failover to the
+# fallbacks, retries and optional hedging
+ai_router = ProviderRouter(
+    {'azure_openai': azure_openai_service, 'palm2': palm_service,
+     'claude': anthropic_service, 'cloudflare': cloudflare_service},
+    fallbacks=config.ai_fallbacks, hedge_delay=config.ai_hedge_delay,
+    max_error_rate=config.ai_max_error_rate,
+    max_in_flight=config.ai_max_in_flight, max_queue=config.ai_max_queue,
+    retry=RetryPolicy(attempts=config.ai_retry_attempts,
+                      base_delay=config.ai_retry_base_delay,
+                      max_delay=config.ai_retry_max_delay,
+                      deadline=config.ai_retry_deadline))
+# the handlers await the services, the blocking sqlite io runs in db executor
+db = AsyncDatabase(engine, db_executor(config.db_workers))
+# answers of the same questions, None when off
+response_cache = ResponseCache(
+    maxsize=config.response_cache_size, ttl=config.response_cache_ttl,
+    db_path=config.response_cache_db,
+    executor=db.executor) if config.response_cache_size else None
+_model_services = ModelServices(engine, ttl=config.model_snapshot_ttl)
+_user_services = UserServices(engine)
+user_db = db.services(_user_services)
+ai_model_db = db.services(_model_services)
+dialog_db = db.services(DialogServices(engine, _model_services,
+                                       token_counter=turn_token_count,
+                                       user_db=_user_services))
+prompt_db = db.services(PromptServices(engine))
+role_db = db.services(RoleServices(engine))
@@ -1,16 +1,16 @@
 import asyncio
+import contextvars
 import html
 import json
 import math
-import random
 import re
-import string
 import time
 import traceback
 import wave
 from asyncio import Condition
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 
 import requests
 from bs4 import BeautifulSoup
@@ -18,29 +18,36 @@ from pydub import AudioSegment
 from telegram import Update, User, InlineKeyboardButton, InlineKeyboardMarkup, \
     Message
 from telegram.constants import ParseMode
-from telegram.error import BadRequest, RetryAfter
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext, Application
 
+from ai.cache import ResponseCache
+from ai.admission import Ticket
+from ai.context import ContextTooLong
+from ai.router import ProvidersBusy, ProvidersFailed
+from ai.stream import or_error, single_chunk
 from config import config
 from database.models import Permission
 from logs.log import logger
 from . import (
+    db,
     user_db,
     azure_service,
     dialog_db,
     gpt_service,
     ai_model_db,
     prompt_db,
-    palm_service,
-    azure_openai_service,
-    anthropic_service,
-    role_db, cloudflare_service,
+    role_db,
+    ai_router,
+    response_cache,
 )
+from .editor import StreamEditor
 from .helper import (
     check_contain_code,
     render_msg_with_code,
     get_main_lang,
     num_tokens_from_string,
+    temp_path,
 )
 
 command_list = [
@@ -53,12 +60,23 @@ command_list = [
     ("model", "List all models"),
     ("user", "List all users"),
     ("export", "Export all dialogs"),
-    ("stream", "Streaming response")
+    ("stream", "Streaming response"),
+    ("stats", "Show the cache and ai provider stats")
 ]
 
 HELP_MESSAGE = "\n".join(
     [f"/{command} - {description}" for command, description in command_list]
 )
+# the ai providers are at their request limits, the queues are full
+BUSY_MESSAGE = "Too many requests right now, please try again in a minute ⏳"
+ERROR_MESSAGE = "sth went wrong, please try again later."
+NO_MODEL_MESSAGE = "Ai model not found."
+TOO_LONG_MESSAGE = "Token exceed limit, please short your message"
+# not answers: not kept in the dialog and the api count is given back
+FAILED_ANSWERS = {BUSY_MESSAGE, ERROR_MESSAGE, NO_MODEL_MESSAGE,
+                  TOO_LONG_MESSAGE}
+NO_API_COUNT_MESSAGE = "You have no API count left, please contact the " \
+                       "admin to get more 🤷‍♂️"
 
 
 async def init_menu(app: Application) -> None:
@@ -69,9 +87,9 @@ async def init_menu(app: Application) -> None:
 async def register_user_if_not_exists(
         update: Update, context: CallbackContext, user: User
 ):
-    if not user_db.check_if_user_exists(user.id):
-        role_id = role_db.get_default_role().id
-        user_db.add_new_user(
+    if not await user_db.check_if_user_exists(user.id):
+        role_id = (await role_db.get_default_role()).id
+        await user_db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
@@ -114,9 +132,7 @@ async def reply_voice(update, context, answer):
                     segment_data = f.readframes(end_frame - start_frame)
 
                     # Write the segment data to a temporary file
-                    random_str = random.sample(
-                        string.ascii_letters + string.digits, 6)
-                    segment_filename = f"segment_{random_str}.ogg"
+                    segment_filename = temp_path(".ogg")
                     with wave.open(segment_filename, "wb") as segment_file:
                         segment_file.setparams(f.getparams())
                         segment_file.writeframes(segment_data)
@@ -142,13 +158,14 @@ async def reply_voice(update, context, answer):
         await update.message.reply_text("Text to speech failed")
 
 
+@db.transactional
 async def start_handle(update: Update, context: CallbackContext):
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
     logger.info(f"user_id: {user.id} start chat")
 
-    user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
-    dialog_db.start_new_dialog(user.id)
+    await user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
+    await dialog_db.start_new_dialog(user.id)
 
     reply_text = "Hi! I'm An AI bot implemented with GPT API 🤖\n\n"
     reply_text += HELP_MESSAGE
@@ -157,64 +174,80 @@ async def start_handle(update: Update, context: CallbackContext):
     await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
 
 
+@db.transactional
 async def help_handle(update: Update, context: CallbackContext):
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
+    await user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
+@db.transactional
 async def retry_handle(update: Update, context: CallbackContext):
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    ai_model_name = ai_model_db.get_default_model().name
-    dialog_messages = dialog_db.get_dialog_messages(user.id, dialog_id=None,
-                                                    ai_model=ai_model_name)
-    if len(dialog_messages) == 0:
+    ai_model_name = (await ai_model_db.get_default_model()).name
+    # last message was removed from the context
+    last_dialog_message = await dialog_db.pop_dialog_message(
+        user.id, ai_model=ai_model_name)
+    if last_dialog_message is None:
         await update.message.reply_text("No message to retry 🤷‍♂️")
         return
 
-    last_dialog_message = dialog_messages.pop()
-    # last message was removed from the context
-    dialog_db.set_dialog_messages(user.id, dialog_messages,
-                                  ai_model=ai_model_name)
-
+    # a new answer is wanted, not the cached one
     await message_handle(
         update,
         context,
         message=last_dialog_message["user"],
         use_new_dialog_timeout=False,
+        cache=False,
     )
 
 
+async def with_api_count(update: Update, user_id, answer) -> None:
+    """Take one api call of the user's quota, in a single conditional
+    UPDATE, before awaiting answer: a coroutine returning whether an answer
+    was kept. The api call is given back if not."""
+    if not await user_db.reserve_api_count(user_id):
+        answer.close()
+        await update.message.reply_text(NO_API_COUNT_MESSAGE)
+        return
+    answered = False
+    try:
+        answered = await answer
+    finally:
+        if not answered:
+            await user_db.refund_api_count(user_id)
+
+
 async def stream_message_handle(update: Update, context: CallbackContext,
                                 message=None,
-                                user_new_dialog_timeout=True):
+                                user_new_dialog_timeout=True, cache=False):
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    user_obj = user_db.get_user_by_user_id(user.id)
+    await with_api_count(update, user.id, stream_answer(
+        update, context, user, message, cache))
+
+
+async def stream_answer(update: Update, context: CallbackContext, user,
+                        message, cache) -> bool:
+    user_obj = await user_db.get_user_by_user_id(user.id)
     chat_mode = user_obj.current_chat_mode
-    prompt = config.chat_mode[chat_mode].get("prompt_start")
-    default_model = ai_model_db.get_default_model()
-    context_msg = dialog_db.get_dialog_messages(
-        user.id, dialog_id=None, ai_model=default_model.name
-    )
-    message = update.message.text
-    stream = await anthropic_service.send_message_stream(message, context_msg,
-                                                         prompt)
-    index = 0
+    default_model = await ai_model_db.get_default_model()
+    context_msg, summary = await get_dialog_context(
+        user.id, None, default_model.name)
+    message = message or update.message.text
+    # the pieces of the answer, whatever the ai model is
+    stream = get_answer_stream_from_ai(default_model.name, message,
+                                       chat_mode=chat_mode,
+                                       context=context_msg, summary=summary,
+                                       cache=cache)
     answer = ''
-    prev_answer = ''
-    answer_msg = update.message
+    editor = None
     message_id = update.message.message_id
-    text = ''
-    threshold = 10  # 每次编辑消息最少要5个字的变化
-    async for a in stream:
-        text = a.completion
+    async for text in stream:
         answer = f"{answer}{text}"
-        if len(answer) < 1:
-            break
-        if index == 0:
+        if editor is None:
             answer_msg = await context.bot.send_message(
                 text=f"🗣\n\n{answer}",
                 chat_id=update.message.chat_id,
@@ -222,79 +255,81 @@ async def stream_message_handle(update: Update, context: CallbackContext,
                 parse_mode=ParseMode.HTML,
                 disable_notification=True,
             )
+            # the edits are coalesced and paced per chat
+            editor = StreamEditor(context.bot, answer_msg.chat_id,
+                                  answer_msg.message_id, shown=answer,
+                                  min_interval=config.stream_edit_interval)
         else:
-            if answer == prev_answer:
-                break
-            if len(answer) < threshold + len(prev_answer):
-                continue
-            prev_answer = answer
-            try:
-                answer_msg = await context.bot.edit_message_text(
-                    answer, answer_msg.chat_id, answer_msg.message_id)
-            except (BadRequest, RetryAfter) as e:
-                logger.error(
-                    f"edit_message_text error: {traceback.format_exc()}")
-                logger.error(f"error message{e}")
-                await asyncio.sleep(0.1)
-
-        index = index + 1
-    else:
-        # 循环结束后检查是否有未发送的文本
-        if 0 < len(text) <= threshold:
-            answer = f"{answer}{text}"
-        try:
-            await context.bot.edit_message_text(
-                answer, answer_msg.chat_id, answer_msg.message_id)
-        except (BadRequest, RetryAfter) as e:
-            logger.error(f"edit_message_text error: {traceback.format_exc()}")
-            logger.error(f"error message{e}")
-            await asyncio.sleep(0.1)
+            editor.update(answer)
+    if editor is not None:
+        await editor.finish(answer)
+    if not answer:
+        await context.bot.send_message(
+            text="AI returns Noting",
+            chat_id=update.message.chat_id,
+            reply_to_message_id=message_id,
+            parse_mode=ParseMode.HTML,
+            disable_notification=True,
+        )
+        return False
+    if answer in FAILED_ANSWERS:
+        # the user can ask again, it isn't counted
+        return False
     new_dialog_message = {
         "user": message,
         "assistant": answer,
         "date": datetime.now().strftime("%Y-%m-%d %H:%M:%s"),
     }
-    user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
-    dialog_db.set_dialog_messages(
-        user.id,
-        dialog_db.get_dialog_messages(user.id, ai_model=default_model.name)
-        + [new_dialog_message],
-        ai_model=default_model.name,
-    )
-    user_db.consume_api_count(user.id)
+    await user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
+    await dialog_db.append_dialog_message(user.id, new_dialog_message,
+                                          ai_model=default_model.name)
+    summarize_if_long(user.id, default_model.name)
+    return True
 
 
+@db.transactional
 async def message_handle(
         update: Update, context: CallbackContext, message=None,
-        use_new_dialog_timeout=True
+        use_new_dialog_timeout=True, cache=False
 ):
+    """Answer a chat message, a new answer each time: only the repeatable
+    questions (prompt buttons, OCR actions) are answered from the cache"""
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    user_obj = user_db.get_user_by_user_id(user.id)
-    default_model = ai_model_db.get_default_model()
-    # use stream by message_stream_handle (only for claude model)
-    if user_obj and user_obj.use_stream and default_model.name.lower() == 'claude':
-        await stream_message_handle(update, context, message)
+    user_obj = await user_db.get_user_by_user_id(user.id)
+    default_model = await ai_model_db.get_default_model()
+    # use stream by message_stream_handle
+    if user_obj and user_obj.use_stream and default_model is not None:
+        await stream_message_handle(update, context, message, cache=cache)
         return
     # check if message is edited
     if update.edited_message is not None:
         await edited_message_handle(update, context)
         return
-    if not user_obj or not user_obj.has_api_count():
-        await update.message.reply_text(
-            "You have no API count left, please contact the admin to get more 🤷‍♂️"
-        )
+    if not user_obj:
+        await update.message.reply_text(NO_API_COUNT_MESSAGE)
         return
+    await with_api_count(update, user.id, answer_message(
+        update, context, user, user_obj, default_model, message,
+        use_new_dialog_timeout, cache))
 
+
+async def answer_message(update: Update, context: CallbackContext, user,
+                         user_obj, default_model, message,
+                         use_new_dialog_timeout, cache) -> bool:
+    """Ask the ai, reply and keep the answer in the dialog, False if there
+    is no answer to keep"""
     # new dialog timeout
     if use_new_dialog_timeout:
-        last_time = user_db.get_user_attribute(user.id, "last_interaction")
+        last_time = await user_db.get_user_attribute(user.id, "last_interaction")
         if (datetime.now() - last_time).seconds > config.new_dialog_timeout:
-            dialog_db.start_new_dialog(user_id=str(user.id))
+            await dialog_db.start_new_dialog(user_id=str(user.id))
             await update.message.reply_text(
                 "Starting new dialog due to timeout ⌛️")
     answer = None
     condition = asyncio.Condition()
+    # place in the queue of the ai provider
+    ticket = Ticket()
 
     async def keep_editing(
             condition: Condition, context: CallbackContext, msg: Message,
@@ -303,7 +338,9 @@ async def message_handle(
         """keep editing the tip message until get answer from the ai"""
         if msg is not None and not condition.locked():
             text = text[:-1] + "." + text[-1]
-            await context.bot.edit_message_text(text, msg.chat_id,
+            shown = f"{text}\n⏳ {ticket.position} in the queue" \
+                if ticket.position else text
+            await context.bot.edit_message_text(shown, msg.chat_id,
                                                 msg.message_id)
             await asyncio.sleep(1)
             await keep_editing(condition, context, msg, text)
@@ -313,17 +350,15 @@ async def message_handle(
         if default_model is None:
             await update.message.reply_text("Please set default model first")
             return
-        message = update.message.text
+        message = message or update.message.text
         tip_message = await context.bot.send_message(
             text="I'm working on it, please wait🤔",
             disable_notification=True,
             chat_id=update.message.chat_id,
             parse_mode=ParseMode.HTML,
         )
-        context_msg = dialog_db.get_dialog_messages(
-            user.id, dialog_id=user_obj.current_dialog_id,
-            ai_model=default_model.name
-        )
+        context_msg, summary = await get_dialog_context(
+            user.id, user_obj.current_dialog_id, default_model.name)
         edit_task = asyncio.create_task(
             keep_editing(condition, context, tip_message, tip_message.text)
         )
@@ -332,6 +367,9 @@ async def message_handle(
             message,
             chat_mode=user_obj.current_chat_mode,
             context=context_msg,
+            summary=summary,
+            cache=cache,
+            ticket=ticket,
         )
         message_id = update.message.message_id
         if not answer:
@@ -361,11 +399,13 @@ async def message_handle(
             parse_mode=ParseMode.HTML,
             disable_notification=True,
         )
-        user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
+        await user_db.set_user_attribute(user.id, "last_interaction", datetime.now())
+        if answer in FAILED_ANSWERS:
+            # the user can ask again, it isn't counted
+            return
         # if answer is not in chinese give translate options
         if azure_service.translate_service_available and \
-                not re.search(r"[\u4e00-\u9fff]+", answer) and \
-                'sth went wrong' != answer:
+                not re.search(r"[\u4e00-\u9fff]+", answer):
             translate_choice = [
                 InlineKeyboardButton("请帮我翻译成中文󠁧󠁢󠁥󠁮󠁧󠁿",
                                      callback_data=f"translate|zh"),
@@ -383,14 +423,10 @@ async def message_handle(
             "assistant": answer,
             "date": datetime.now().strftime("%Y-%m-%d %H:%M:%s"),
         }
-        dialog_db.set_dialog_messages(
-            user.id,
-            dialog_db.get_dialog_messages(user.id, ai_model=default_model.name)
-            + [new_dialog_message],
-            ai_model=default_model.name,
-        )
-
-        user_db.consume_api_count(user.id)
+        await dialog_db.append_dialog_message(user.id, new_dialog_message,
+                                              ai_model=default_model.name)
+        summarize_if_long(user.id, default_model.name)
+        return True
     except BadRequest as e:
         # Can't parse entities: unsupported start tag "=" at byte offset 1267
         if "unsupported start tag" in str(e.message):
@@ -455,11 +491,7 @@ async def url_link_handle(update: Update, context: CallbackContext):
                 "assistant": answer,
                 "date": datetime.now().strftime("%Y-%m-%d %H:%M:%s"),
             }
-            dialog_db.set_dialog_messages(
-                user_id,
-                dialog_db.get_dialog_messages(user_id, dialog_id=None)
-                + [new_dialog_message],
-            )
+            await dialog_db.append_dialog_message(user_id, new_dialog_message)
     except Exception as e:
         logger.error(f"sth wrong with :{e}")
         logger.error(f"traceback {traceback.format_exc()}")
@@ -470,32 +502,166 @@ async def url_link_handle(update: Update, context: CallbackContext):
         )
 
 
+def with_summary(context: list, summary: Optional[str]) -> list:
+    """The summary of the older turns takes their place in the context,
+    as a turn every ai model understands"""
+    if not summary:
+        return context
+    return [{"user": "What have we talked about so far?",
+             "assistant": summary}] + list(context)
+
+
 async def get_answer_from_ai(ai_name: str, message: str, chat_mode: str,
-                             context: list):
+                             context: list, summary: Optional[str] = None,
+                             cache: bool = False,
+                             ticket: Optional[Ticket] = None):
     """Get answer from ai model. no matter chatgpt or azure openai,
-    or palm2 etc."""
-    answer = None
+    or palm2 etc.
+    :param summary: summary of the turns older than the context
+    :param cache: answer from the response cache if the same was asked
+    :param ticket: tells the place in the queue of the ai provider
+    """
     prompt = config.chat_mode[chat_mode].get("prompt_start")
-    ai_name = ai_name.lower()
-    if "azure_openai" in ai_name:
-        answer = await azure_openai_service.send_message(message, context,
-                                                         prompt)
-    elif "palm2" in ai_name:
-        answer = await palm_service.send_message(message, context,
-                                                 prompt=prompt)
-    elif "claude" in ai_name:
-        answer = await anthropic_service.send_message(message, context, prompt)
-    elif 'cloudflare' in ai_name:
-        answer = cloudflare_service.send_message(message, context, prompt)
-    else:
-        answer = "Ai model not found."
+    context = with_summary(context, summary)
+    if ai_router.provider_name(ai_name) is None:
+        return NO_MODEL_MESSAGE
+    key = None
+    if cache and response_cache is not None:
+        key = ResponseCache.key(ai_name, chat_mode, prompt, message, context)
+        answer = await response_cache.get(key)
+        if answer is not None:
+            return answer
+    try:
+        answer = await ai_router.ask(ai_name, message, context, prompt,
+                                     ticket=ticket)
+    except ProvidersBusy as e:
+        logger.warning(f"rejected: {e}")
+        return BUSY_MESSAGE
+    except ProvidersFailed as e:
+        logger.error(f"error:\n\n ask: {message} \n with error {e}")
+        if isinstance(e.__cause__, ContextTooLong):
+            return TOO_LONG_MESSAGE
+        return ERROR_MESSAGE
+    if key is not None and answer:
+        await response_cache.set(key, answer)
     return answer
 
 
+def get_answer_stream_from_ai(ai_name: str, message: str, chat_mode: str,
+                              context: list, summary: Optional[str] = None,
+                              cache: bool = False):
+    """Same as get_answer_from_ai, but return an async iterator of the
+    pieces of the answer"""
+    prompt = config.chat_mode[chat_mode].get("prompt_start")
+    context = with_summary(context, summary)
+    if ai_router.provider_name(ai_name) is None:
+        return single_chunk(asyncio.sleep(0, NO_MODEL_MESSAGE))
+    stream = ai_router.ask_stream(ai_name, message, context, prompt)
+    if cache and response_cache is not None:
+        stream = cached_stream(
+            ResponseCache.key(ai_name, chat_mode, prompt, message, context),
+            stream)
+    return or_error(or_busy(stream), ERROR_MESSAGE, message)
+
+
+async def or_busy(stream):
+    """Tell the providers are busy when the stream is rejected"""
+    try:
+        async for text in stream:
+            yield text
+    except ProvidersBusy as e:
+        logger.warning(f"rejected: {e}")
+        yield BUSY_MESSAGE
+
+
+async def cached_stream(key: str, stream):
+    """The cached answer as one piece, or the pieces of stream, the whole
+    answer is cached once the stream ends"""
+    answer = await response_cache.get(key)
+    if answer is not None:
+        yield answer
+        return
+    pieces = []
+    async for text in stream:
+        pieces.append(text)
+        yield text
+    if pieces:
+        await response_cache.set(key, ''.join(pieces))
+
+
+async def get_dialog_context(user_id, dialog_id, ai_model: str) -> tuple:
+    """The turns sent to the ai as context, and the summary of the older
+    ones (None when the summaries are off or not made yet)"""
+    if not config.summary_threshold:
+        turns = await dialog_db.get_dialog_messages(
+            user_id, dialog_id=dialog_id, ai_model=ai_model,
+            limit=config.max_context_turns)
+        return turns, None
+    turns = await dialog_db.get_dialog_messages(
+        user_id, dialog_id=dialog_id, ai_model=ai_model,
+        limit=config.max_context_turns, since_summary=True)
+    summary = await dialog_db.get_dialog_summary(user_id, dialog_id,
+                                                 ai_model)
+    return turns, summary
+
+
+# (user_id, ai_model) -> the task summarizing the dialog
+_summary_tasks = {}
+
+
+def summarize_if_long(user_id, ai_model: str):
+    """Summarize the older turns of the dialog in the background when more
+    than summary_threshold turns are not in the summary yet"""
+    if not config.summary_threshold:
+        return
+    key = (str(user_id), ai_model)
+    if key in _summary_tasks:
+        return
+    # a context of its own, the task must not join the unit of work of the
+    # update being handled
+    task = contextvars.Context().run(asyncio.create_task,
+                                     summarize_dialog(str(user_id), ai_model))
+    _summary_tasks[key] = task
+    task.add_done_callback(lambda t: _summary_tasks.pop(key, None))
+
+
+async def summarize_dialog(user_id: str, ai_model: str):
+    """Fold the turns not summarized yet, but the latest summary_keep_turns,
+    into the summary of the dialog"""
+    try:
+        # the turn just added may not be committed yet, it's counted next
+        # time
+        if await dialog_db.count_turns_to_summarize(
+                user_id, ai_model) <= config.summary_threshold:
+            return
+        todo = await dialog_db.get_turns_to_summarize(
+            user_id, ai_model, keep=config.summary_keep_turns)
+        if todo is None:
+            return
+        text = ("Summarize the conversation below in less than 200 words, "
+                "keep the facts, names, numbers and decisions it may need "
+                "later. Return the summary only.\n\n")
+        if todo['summary']:
+            text += f"Summary of the conversation before: {todo['summary']}\n\n"
+        text += "\n".join(f"User: {t['user']}\nAssistant: {t['assistant']}"
+                          for t in todo['turns'])
+        summary = await get_answer_from_ai(ai_model, text,
+                                           chat_mode="assistant", context=[])
+        if not summary or summary in FAILED_ANSWERS:
+            logger.error(f"summary of dialog {todo['dialog_id']} failed: "
+                         f"{summary}")
+            return
+        await dialog_db.set_dialog_summary(todo['dialog_id'], summary,
+                                           todo['until'])
+    except Exception:
+        logger.error(f"summary error: {traceback.format_exc()}")
+
+
+@db.transactional
 async def voice_message_handle(update: Update, context: CallbackContext):
     logger.info("voice message handler:")
     await register_user_if_not_exists(update, context, update.message.from_user)
-    default_model = ai_model_db.get_default_model()
+    default_model = await ai_model_db.get_default_model()
     if default_model is None:
         await update.message.reply_text("Please set default model first")
         return
@@ -506,8 +672,8 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         )
         return
     user_id = str(update.message.from_user.id)
-    user_obj = user_db.get_user_by_user_id(user_id)
-    name = f"{update.message.chat_id}{int(time.time())}"
+    user_obj = await user_db.get_user_by_user_id(user_id)
+    name = temp_path()
     logger.info(f"filename:{name}")
     try:
         # get voice message and use whisper api translate it to text
@@ -526,10 +692,11 @@ async def voice_message_handle(update: Update, context: CallbackContext):
                 default_model.name,
                 recognized_text,
                 chat_mode=user_obj.current_chat_mode,
-                context=dialog_db.get_dialog_messages(user_id, dialog_id=None),
+                context=await dialog_db.get_dialog_messages(
+                    user_id, dialog_id=None, limit=config.max_context_turns),
             )
-            user_db.set_user_attribute(user_id, "last_interaction",
-                                       datetime.now())
+            await user_db.set_user_attribute(user_id, "last_interaction",
+                                             datetime.now())
             logger.info(f"chatgpt answered: {answer}")
             if check_contain_code(answer):
                 answer = render_msg_with_code(answer)
@@ -546,11 +713,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
                 "assistant": answer,
                 "date": datetime.now().strftime("%Y-%m-%d %H:%M:%s"),
             }
-            dialog_db.set_dialog_messages(
-                user_id,
-                dialog_db.get_dialog_messages(user_id, dialog_id=None)
-                + [new_dialog_message],
-            )
+            await dialog_db.append_dialog_message(user_id, new_dialog_message)
 
     except Exception as e:
         error_text = f"Sth went wrong: {e}"
@@ -563,25 +726,27 @@ async def voice_message_handle(update: Update, context: CallbackContext):
                 Path(file_name).unlink()
 
 
+@db.transactional
 async def new_dialog_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = str(update.message.from_user.id)
-    user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    dialog_db.start_new_dialog(user_id)
+    await dialog_db.start_new_dialog(user_id)
     await update.message.reply_text("Starting new dialog ✅")
 
-    chat_mode = user_db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await user_db.get_user_attribute(user_id, "current_chat_mode")
     await update.message.reply_text(
         f"{config.chat_mode[chat_mode]['welcome_message']}",
         parse_mode=ParseMode.HTML
     )
 
 
+@db.transactional
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = str(update.message.from_user.id)
-    user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     keyboard = []
     for chat_mode, chat_mode_dict in config.chat_mode.items():
@@ -599,6 +764,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
                                     reply_markup=reply_markup)
 
 
+@db.transactional
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context,
                                       update.callback_query.from_user)
@@ -609,8 +775,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     chat_mode = query.data.split("|")[1]
 
-    user_db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    dialog_db.start_new_dialog(user_id)
+    await user_db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await dialog_db.start_new_dialog(user_id)
 
     await query.edit_message_text(
         f"<b>{config.chat_mode[chat_mode]['name']}</b> chat mode is set",
@@ -628,6 +794,7 @@ async def edited_message_handle(update: Update, context: CallbackContext):
     await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
+@db.transactional
 async def photo_handle(update: Update, context: CallbackContext):
     logger.info("picture message handler:")
     await register_user_if_not_exists(update, context, update.message.from_user)
@@ -669,7 +836,10 @@ async def ocr_handle(update: Update, context: CallbackContext):
         chat_id=query.message.chat_id,
         parse_mode=ParseMode.HTML,
     )
-    _, img_name, action_type = query.data.split("|")
+    # the name in the data only tells the buttons apart, the picture is
+    # downloaded to a path of this worker and deleted by ocr
+    _, _, action_type = query.data.split("|")
+    img_name = temp_path(".jpg")
     file_id = query.message.reply_to_message.photo[-1].file_id
     img_file = await context.bot.get_file(file_id)
     await img_file.download_to_drive(img_name)
@@ -687,18 +857,19 @@ async def ocr_handle(update: Update, context: CallbackContext):
             text = f"Translate the following text to {lang}:\n {text}"
         elif action_type == "summary":
             text = f"Summary the main point of the following text in {text_main_lang}:\n {text}"
-        default_model = ai_model_db.get_default_model()
+        default_model = await ai_model_db.get_default_model()
         if default_model is None:
             await update.message.reply_text("Please set default model first")
             return
-        user_obj = user_db.get_user_by_user_id(user_id)
+        user_obj = await user_db.get_user_by_user_id(user_id)
         answer = await get_answer_from_ai(
             ai_name=default_model.name,
             message=text,
             chat_mode=user_obj.current_chat_mode,
             context=[],
+            cache=True,
         )
-        user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        await user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
         await tip_message.delete()
         await query.message.reply_text(answer, parse_mode=ParseMode.HTML)
     else:
@@ -747,6 +918,7 @@ async def translate_handle(update, context, lang):
     )
 
 
+@db.transactional
 async def dispatch_callback_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context,
                                       update.callback_query.from_user)
@@ -812,15 +984,16 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
         )
 
 
+@db.transactional
 async def list_user_handle(update: Update, context: CallbackContext):
     # for admin to manage user
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    user_obj = user_db.get_user_by_user_id(user.id)
-    if not user_obj or not user_db.is_admin(user.id):
+    user_obj = await user_db.get_user_by_user_id(user.id)
+    if not user_obj or not await user_db.is_admin(user.id):
         await update.message.reply_text("You don't have permission to do this")
         return
-    users = user_db.list_all_user()
+    users = await user_db.list_all_user()
     text = "List All Users \nHere are the available users:\n"
     btns = InlineKeyboardMarkup(
         [
@@ -839,13 +1012,13 @@ async def list_user_handle(update: Update, context: CallbackContext):
 
 async def manage_user_handle(update: Update, context: CallbackContext):
     user = update.callback_query.from_user
-    user_obj = user_db.get_user_by_user_id(user.id)
-    if not user_obj or not user_db.is_admin(user.id):
+    user_obj = await user_db.get_user_by_user_id(user.id)
+    if not user_obj or not await user_db.is_admin(user.id):
         await update.message.reply_text("You don't have permission to do this")
         return
     _, user_id = update.callback_query.data.split("|")
-    cur_user = user_db.get_user_by_user_id(user_id)
-    is_admin = user_db.is_admin(user_id)
+    cur_user = await user_db.get_user_by_user_id(user_id)
+    is_admin = await user_db.is_admin(user_id)
     text = f"{'👑' if is_admin else '👤'}{cur_user.username if cur_user.username else 'Nobody'} \
     id:{cur_user.user_id} (API COUNT:{cur_user.api_count}  TOTAL:{cur_user.total_api_count})"
     btns = InlineKeyboardMarkup(
@@ -884,10 +1057,11 @@ async def manage_user_handle(update: Update, context: CallbackContext):
     )
 
 
+@db.transactional
 async def stream_handle(update: Update, context: CallbackContext):
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    user_obj = user_db.get_user_by_user_id(user.id)
+    user_obj = await user_db.get_user_by_user_id(user.id)
     if user_obj:
         btns = InlineKeyboardMarkup(
             [
@@ -912,7 +1086,7 @@ async def stream_handle(update: Update, context: CallbackContext):
 
 async def set_stream_handle(update: Update, context: CallbackContext):
     user = update.callback_query.from_user
-    user_obj = user_db.get_user_by_user_id(user.id)
+    user_obj = await user_db.get_user_by_user_id(user.id)
     _, user_id, flag = update.callback_query.data.split("|")
     flag_enabled = True if flag == '1' else False
     if user_obj and user_id and user_obj.user_id != user_id:
@@ -925,7 +1099,7 @@ async def set_stream_handle(update: Update, context: CallbackContext):
             parse_mode=ParseMode.HTML
         )
     else:
-        user_db.set_user_attribute(user_id, "use_stream", flag_enabled)
+        await user_db.set_user_attribute(user_id, "use_stream", flag_enabled)
         await context.bot.send_message(
             chat_id=update.callback_query.message.chat_id,
             text=f"stream response has been <b>{'enabled' if flag_enabled else 'disabled'}</b> successfully!",
@@ -935,48 +1109,83 @@ async def set_stream_handle(update: Update, context: CallbackContext):
 
 async def add_api_count_handle(update: Update, context: CallbackContext):
     user = update.callback_query.from_user
-    user_obj = user_db.get_user_by_user_id(user.id)
-    if not user_obj or not user_db.is_admin(user.id):
+    user_obj = await user_db.get_user_by_user_id(user.id)
+    if not user_obj or not await user_db.is_admin(user.id):
         await update.message.reply_text("You don't have permission to do this")
         return
     _, user_id, count = update.callback_query.data.split("|")
     if count == "0":
-        user_db.set_user_attribute(user_id, "api_count", int(count))
+        await user_db.set_user_attribute(user_id, "api_count", int(count))
     else:
-        user_db.add_user_api_count(user_id, int(count))
+        await user_db.add_user_api_count(user_id, int(count))
     await context.bot.send_message(
         chat_id=update.callback_query.message.chat_id,
         text=f"Add {count} to {user_id} successfully.Current api count:\
-        {user_db.get_user_by_user_id(user_id).api_count}",
+        {(await user_db.get_user_by_user_id(user_id)).api_count}",
     )
 
 
 async def set_admin_handle(update: Update, context: CallbackContext):
     user = update.callback_query.from_user
-    user_obj = user_db.get_user_by_user_id(user.id)
-    if not user_obj or not user_db.is_admin(user.id):
+    user_obj = await user_db.get_user_by_user_id(user.id)
+    if not user_obj or not await user_db.is_admin(user.id):
         await update.message.reply_text("You don't have permission to do this")
         return
     _, user_id = update.callback_query.data.split("|")
-    role_id = role_db.get_role_by_name("admin").role_id
-    if not user_db.is_admin(user_id):
-        user_db.set_user_attribute(user_id, "role_id", role_id)
+    role_id = (await role_db.get_role_by_name("admin")).role_id
+    if not await user_db.is_admin(user_id):
+        await user_db.set_user_attribute(user_id, "role_id", role_id)
         await context.bot.send_message(
             chat_id=update.callback_query.message.chat_id,
             text=f"Set {user_id} as admin successfully.",
         )
 
 
+@db.transactional
+async def stats_handle(update: Update, context: CallbackContext):
+    """for admin, the hit rates of the caches and the latency of the ai
+    providers"""
+    user = update.message.from_user
+    await register_user_if_not_exists(update, context, user)
+    if not await user_db.is_admin(user.id):
+        await update.message.reply_text("You don't have permission to do this")
+        return
+    lines = ["<b>Response cache</b>"]
+    if response_cache is None:
+        lines.append("off")
+    else:
+        r = response_cache.report()
+        lines.append(f"hit rate {r['hit_rate']:.1%}, memory hits "
+                     f"{r['memory_hits']}, db hits {r['db_hits']}, misses "
+                     f"{r['misses']}, size {r['size']}")
+    users = user_db.cache.stats()
+    lines.append("<b>User cache</b>")
+    lines.append(f"hit rate {users['hit_rate']:.1%}, hits {users['hits']}, "
+                 f"misses {users['misses']}, size {users['size']}")
+    lines.append("<b>AI providers</b>")
+    for name, r in ai_router.report().items():
+        p50 = f"{r['p50']:.2f}s" if r['p50'] is not None else "-"
+        p95 = f"{r['p95']:.2f}s" if r['p95'] is not None else "-"
+        lines.append(f"{name}: {r['requests']} requests, p50 {p50}, "
+                     f"p95 {p95}, errors {r['error_rate']:.1%}")
+        if 'in_flight' in r:
+            lines.append(f"  {r['in_flight']} running, {r['queued']} "
+                         f"waiting, {r['rejected']} rejected")
+    await update.message.reply_text("\n".join(lines),
+                                    parse_mode=ParseMode.HTML)
+
+
+@db.transactional
 async def list_ai_model_handle(update: Update, context: CallbackContext):
     """list the ai model"""
     user = update.message.from_user
     await register_user_if_not_exists(update, context, user)
-    user_obj = user_db.get_user_by_user_id(user.id)
+    user_obj = await user_db.get_user_by_user_id(user.id)
     if not user_obj or not user_obj.has_permission(Permission.ADMIN):
         await update.message.reply_text("You don't have permission to do this")
         return
 
-    models = ai_model_db.list_all_model()
+    models = await ai_model_db.list_all_model()
     if len(models) == 0:
         await update.message.reply_text("No models yet, please add one first.")
         return
@@ -1013,12 +1222,12 @@ async def operate_ai_model_handle(update: Update, context: CallbackContext):
     """toggle ai model available"""
     user = update.callback_query.from_user
     await register_user_if_not_exists(update, context, user)
-    user_obj = user_db.get_user_by_user_id(user.id)
+    user_obj = await user_db.get_user_by_user_id(user.id)
     if not user_obj or not user_obj.has_permission(Permission.ADMIN):
         await update.message.reply_text("You don't have permission to do this")
         return
     _, action, ai_name = update.callback_query.data.split("|")
-    ai_model = ai_model_db.get_model(ai_name)
+    ai_model = await ai_model_db.get_model(ai_name)
     if not ai_model:
         await context.bot.send_message(
             update.callback_query.message.chat_id,
@@ -1028,10 +1237,10 @@ async def operate_ai_model_handle(update: Update, context: CallbackContext):
         return
     if action == "set":
         if ai_model.is_available:
-            df_model = ai_model_db.get_default_model()
+            df_model = await ai_model_db.get_default_model()
             if df_model:
-                ai_model_db.update_model(df_model.name, is_default=False)
-            ai_model_db.update_model(ai_name, is_default=True)
+                await ai_model_db.update_model(df_model.name, is_default=False)
+            await ai_model_db.update_model(ai_name, is_default=True)
             await context.bot.send_message(
                 update.callback_query.message.chat_id,
                 f"Set <b>{ai_name}</b> as default model success.",
@@ -1047,22 +1256,22 @@ async def operate_ai_model_handle(update: Update, context: CallbackContext):
     elif action == 'toggle':
         flag = ai_model.is_available
         if ai_model.is_available:
-            ai_model_db.update_model(ai_name, is_available=False)
+            await ai_model_db.update_model(ai_name, is_available=False)
         else:
-            ai_model_db.update_model(ai_name, is_available=True)
+            await ai_model_db.update_model(ai_name, is_available=True)
         await context.bot.send_message(
             update.callback_query.message.chat_id,
             f"{ai_name} is set to {'not available' if flag else 'available'}",
             parse_mode=ParseMode.HTML,
         )
     elif action == "del":
-        ai_model_db.del_model(ai_name)
+        await ai_model_db.del_model(ai_name)
         await context.bot.send_message(
             update.callback_query.message.chat_id,
             f"{ai_name} has been deleted",
             parse_mode=ParseMode.HTML,
         )
-    names = [m.name for m in ai_model_db.list_all_model()]
+    names = [m.name for m in await ai_model_db.list_all_model()]
     await context.bot.send_message(
         update.callback_query.message.chat_id,
         f"Now, we have {'、'.join(names)}",
@@ -1070,9 +1279,10 @@ async def operate_ai_model_handle(update: Update, context: CallbackContext):
     )
 
 
+@db.transactional
 async def list_prompt_handle(update: Update, context: CallbackContext) -> None:
     """list the prompt already exist"""
-    prompts = prompt_db.get_prompts()
+    prompts = await prompt_db.get_prompts()
     if len(prompts) == 0:
         await update.message.reply_text("No prompt yet, please add one first.")
         return
@@ -1102,7 +1312,7 @@ async def new_prompt_handle(update: Update, context: CallbackContext):
     try:
         _, data = update.message.text.split(" ", 1)
         short_desc, prompt = data.split("|")
-        prompt_db.add_new_prompt(short_desc, prompt)
+        await prompt_db.add_new_prompt(short_desc, prompt)
         await update.message.reply_text(
             f"Prompt ({short_desc}) added successfully.")
     except ValueError as ve:
@@ -1115,7 +1325,7 @@ async def del_prompt_handle(update: Update, context: CallbackContext):
     """delete a prompt"""
     try:
         prompt_id = update.message.text.split(" ")[1]
-        prompt_db.del_prompt(prompt_id)
+        await prompt_db.del_prompt(prompt_id)
         await update.message.reply_text(
             f"Prompt ({prompt_id}) deleted successfully.")
     except ValueError as ve:
@@ -1128,12 +1338,17 @@ async def prompt_handle(update: Update, context: CallbackContext):
     """handle prompt callback query"""
     query = update.callback_query
     prompt_id = query.data.split("|")[1]
-    prompt = prompt_db.get_prompt(int(prompt_id))
+    prompt = await prompt_db.get_prompt(int(prompt_id))
     if prompt:
         tip_message = await query.message.reply_text("I'm thinking...")
-        answer, _ = gpt_service.send_message(
-            prompt.description, dialog_messages=[], chat_mode="assistant"
-        )
+        default_model = await ai_model_db.get_default_model()
+        if default_model is None:
+            await query.message.reply_text("Please set default model first")
+            return
+        # every press of the button asks the same
+        answer = await get_answer_from_ai(
+            default_model.name, prompt.description, chat_mode="assistant",
+            context=[], cache=True)
         if not answer:
             await query.message.reply_text("I have no idea about this.")
             return
@@ -1143,13 +1358,14 @@ async def prompt_handle(update: Update, context: CallbackContext):
         await query.message.reply_text("Prompt not found.")
 
 
+@db.transactional
 async def export_handle(update: Update, context: CallbackContext):
     """
     export latest dialog as default
     """
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await user_db.set_user_attribute(user_id, "last_interaction", datetime.now())
     dialog_id = None
     if " " in update.message.text:
         _, dialog_id = update.message.text.split(" ", 1)
@@ -1163,18 +1379,21 @@ async def export_handle(update: Update, context: CallbackContext):
         else:
             await update.message.reply_text("Invalid dialog id.")
 
-    dialog_id = dialog_db.get_real_dialog_id(str(user_id), dialog_id)
-    messages = dialog_db.get_dialog_messages(str(user_id), dialog_id)
+    dialog_id = await dialog_db.get_real_dialog_id(str(user_id), dialog_id)
+    messages = await dialog_db.get_dialog_messages(str(user_id), dialog_id)
     if messages:
-        with open("messages.txt", "w") as f:
-            for msg in messages:
-                f.write(f"User: {msg['user']}\n")
-                f.write(f"GPT: {msg['assistant']}\n")
-        if Path("messages.txt").exists():
-            await context.bot.sendDocument(
-                chat_id=update.effective_chat.id,
-                document=open("messages.txt", "rb")
-            )
-            Path("messages.txt").unlink()
+        file_name = temp_path(".txt")
+        try:
+            with open(file_name, "w") as f:
+                for msg in messages:
+                    f.write(f"User: {msg['user']}\n")
+                    f.write(f"GPT: {msg['assistant']}\n")
+            with open(file_name, "rb") as f:
+                await context.bot.sendDocument(
+                    chat_id=update.effective_chat.id,
+                    document=f, filename="messages.txt"
+                )
+        finally:
+            Path(file_name).unlink(missing_ok=True)
     else:
         await update.message.reply_text("No message to export.")
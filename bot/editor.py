@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: editor.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: edit a streamed reply without hitting telegram flood limits
+import asyncio
+from typing import Optional
+
+from cachetools import TTLCache
+from telegram.error import BadRequest, RetryAfter
+
+from logs.log import logger
+
+
+class ChatRate:
+    """The edit pace of a chat, shared by all the replies streamed to it"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_time = 0.0
+
+
+class StreamEditor:
+    """Edit a streamed reply with the latest text, at most once every
+    `interval` seconds per chat. The text updated in between is coalesced,
+    only the latest is sent. On RetryAfter the chat waits as long as
+    telegram asks and the interval doubles (up to max_interval), it goes
+    back to min_interval slowly after each edit that succeeds.
+
+        msg = await bot.send_message(chat_id, text)
+        editor = StreamEditor(bot, msg.chat_id, msg.message_id, text)
+        async for piece in stream:
+            text += piece
+            editor.update(text)
+        await editor.finish(text)
+    """
+    _chats = TTLCache(maxsize=10000, ttl=600)
+
+    def __init__(self, bot, chat_id: int, message_id: int,
+                 shown: Optional[str] = None, min_interval: float = 1.0,
+                 max_interval: float = 10.0):
+        """
+        :param shown: the text the message was sent with
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate = self._chats.get(chat_id) or ChatRate(min_interval)
+        self._chats[chat_id] = self.rate
+        self._loop = asyncio.get_running_loop()
+        # sending the message counts as an edit
+        self.rate.next_time = max(self.rate.next_time,
+                                  self._loop.time() + self.rate.interval)
+        self._shown = shown
+        self._text = shown
+        self._changed = asyncio.Event()
+        self._closed = False
+        self._task = None
+
+    def update(self, text: str):
+        """Set the text to show, it's sent on the next turn of the chat"""
+        self._text = text
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def finish(self, text: str):
+        """Stop editing and show the final text, exactly once"""
+        self._closed = True
+        self._changed.set()
+        if self._task is not None:
+            await self._task
+        while not await self._edit(text):
+            pass
+
+    async def _wait_turn(self):
+        # another reply of the chat may have taken the turn while sleeping
+        while (delay := self.rate.next_time - self._loop.time()) > 0:
+            await asyncio.sleep(delay)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            if self._closed:
+                return
+            await self._wait_turn()
+            if self._closed:
+                return
+            self._changed.clear()
+            if not await self._edit(self._text):
+                # retry the latest text on the next turn
+                self._changed.set()
+
+    async def _edit(self, text: str) -> bool:
+        """Wait for the turn of the chat and edit, False if telegram asks
+        to retry later"""
+        if text == self._shown:
+            return True
+        await self._wait_turn()
+        # take the turn, no await in between
+        self.rate.next_time = self._loop.time() + self.rate.interval
+        try:
+            await self.bot.edit_message_text(text, self.chat_id,
+                                             self.message_id)
+        except RetryAfter as e:
+            logger.info(f"edit of chat {self.chat_id} retry after "
+                        f"{e.retry_after}s")
+            self.rate.interval = min(self.max_interval,
+                                     self.rate.interval * 2)
+            self.rate.next_time = self._loop.time() + e.retry_after
+            return False
+        except BadRequest as e:
+            # Message is not modified, or can't be edited any more
+            logger.error(f"edit_message_text error: {e}")
+        self._shown = text
+        self.rate.interval = max(self.min_interval, self.rate.interval * 0.9)
+        return True
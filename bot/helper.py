@@ -1,18 +1,19 @@
 #!/usr/bin/python
 # coding:utf-8
 import asyncio
+import os
 import random
 import re
+import tempfile
 import time
 import traceback
+import uuid
 import wave
-from datetime import datetime
 from pathlib import Path
 
 import azure.cognitiveservices.speech as speechsdk
 import openai
 import requests
-import tiktoken
 from azure.ai.translation.text import TextTranslationClient, TranslatorCredential
 from azure.ai.translation.text.models import InputTextItem
 from azure.cognitiveservices.vision.computervision import ComputerVisionClient
@@ -20,6 +21,7 @@ from azure.core.exceptions import HttpResponseError
 from msrest.authentication import CognitiveServicesCredentials
 from telegram.constants import ParseMode
 
+from ai.tokens import get_encoding
 from config import config
 from logs.log import logger
 
@@ -115,6 +117,12 @@ async def send_like_tying(update, context, text):
         await asyncio.sleep(random.uniform(0.01, 0.15))
 
 
+def temp_path(suffix: str = "") -> str:
+    """A new file path in the temp dir, the workers of the bot (and the
+    updates handled at once) never write the same file"""
+    return os.path.join(tempfile.gettempdir(), f"aibot_{uuid.uuid4().hex}{suffix}")
+
+
 def check_contain_code(check_str):
     """
     check if the str contains code
@@ -258,7 +266,7 @@ class AzureService:
         speech_config = speechsdk.SpeechConfig(
             subscription=self.text2speech_key, region=self.region
         )
-        file_name = f"./{datetime.now().strftime('%Y%m%d%H%M%S')}.wav"
+        file_name = temp_path(".wav")
         logger.info(f"file_name:{file_name}")
         audio_config = speechsdk.audio.AudioOutputConfig(filename=file_name)
 
@@ -379,6 +387,6 @@ class AzureService:
 
 def num_tokens_from_string(string: str, encoding_name: str = "gpt2") -> tuple:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     tokens = encoding.encode(string)
     return len(tokens), tokens, encoding
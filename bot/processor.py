@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: processor.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: concurrent update processing, up to max_concurrent_updates
+# updates are handled at once but the updates of a chat (and of a user,
+# whose dialog they write) are handled one after the other, in order.
+# With several workers serving the bot, a chat is also leased in the
+# database while a worker handles its update.
+#
+#   ApplicationBuilder().token(token).concurrent_updates(
+#       ChatUpdateProcessor(64)).build()
+import asyncio
+import os
+import socket
+import uuid
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Dict, Hashable, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from logs.log import logger
+
+
+class KeyedLocks:
+    """A lock per key, dropped when nobody holds or waits for it"""
+
+    def __init__(self):
+        # key -> [lock, users]
+        self._locks: Dict[Hashable, list] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    async def acquire(self, key: Hashable):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._forget(key, entry)
+            raise
+
+    def release(self, key: Hashable):
+        entry = self._locks[key]
+        entry[0].release()
+        self._forget(key, entry)
+
+    def _forget(self, key: Hashable, entry: list):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Handle the updates concurrently, serialized per chat and per user.
+    The chat lock is always taken before the user one, so two updates can't
+    wait for each other."""
+
+    def __init__(self, max_concurrent_updates: int, leases=None,
+                 lease_ttl: float = 60, owner: Optional[str] = None,
+                 max_poll_interval: float = 1.0):
+        """
+        :param leases: awaitable LeaseServices on the database shared by the
+         workers, the keys are only locked in this process if None
+        :param lease_ttl: seconds a lease is taken for, renewed while the
+         update is handled, a crashed worker's leases expire after it
+        :param owner: of the leases, unique per worker
+        :param max_poll_interval: max seconds between two tries to take a
+         lease another worker holds
+        """
+        super().__init__(max_concurrent_updates)
+        self.locks = KeyedLocks()
+        self.leases = leases
+        self.lease_ttl = lease_ttl
+        self.owner = owner or (f"{socket.gethostname()}:{os.getpid()}:"
+                               f"{uuid.uuid4().hex[:8]}")
+        self.max_poll_interval = max_poll_interval
+
+    @staticmethod
+    def serialization_keys(update: object) -> List[Hashable]:
+        """The keys the update is serialized on, none for the updates
+        without a chat or a user"""
+        if not isinstance(update, Update):
+            return []
+        keys = []
+        if update.effective_chat is not None:
+            keys.append(('chat', update.effective_chat.id))
+        if update.effective_user is not None:
+            keys.append(('user', update.effective_user.id))
+        return keys
+
+    @staticmethod
+    def lease_key(key: Hashable) -> str:
+        kind, _id = key
+        return f"{kind}:{_id}"
+
+    async def acquire_lease(self, key: str):
+        """Wait until the lease is taken, polling with backoff"""
+        delay = 0.05
+        while not await self.leases.acquire(key, self.owner, self.lease_ttl):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    async def release_lease(self, key: str):
+        try:
+            await self.leases.release(key, self.owner)
+        except Exception as e:
+            # it expires after lease_ttl anyway
+            logger.error(f"release lease {key} failed: {e}")
+
+    async def renew_leases(self, keys: List[str]):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            for key in keys:
+                try:
+                    if not await self.leases.renew(key, self.owner,
+                                                   self.lease_ttl):
+                        logger.warning(f"lease {key} lost, another worker "
+                                       f"may handle the chat at once")
+                except Exception as e:
+                    logger.error(f"renew lease {key} failed: {e}")
+
+    async def hold_keys(self, stack: AsyncExitStack, update: object):
+        """Take the locks (and leases) of the update, released when the
+        stack is closed"""
+        leased = []
+        for key in self.serialization_keys(update):
+            await self.locks.acquire(key)
+            stack.callback(self.locks.release, key)
+            if self.leases is not None:
+                # only one update per key of this worker gets here
+                leased.append(self.lease_key(key))
+                await self.acquire_lease(leased[-1])
+                stack.push_async_callback(self.release_lease, leased[-1])
+        if leased:
+            renewing = asyncio.create_task(self.renew_leases(leased))
+            stack.callback(renewing.cancel)
+
+    async def process_update(self, update: object,
+                             coroutine: Awaitable[Any]) -> None:
+        """The keys are taken before a slot of max_concurrent_updates: an
+        update waiting for its chat doesn't hold a slot, a chat flooding the
+        bot doesn't stop the others. (final in BaseUpdateProcessor for the
+        type checkers only, the application calls it.)"""
+        async with AsyncExitStack() as stack:
+            try:
+                await self.hold_keys(stack, update)
+            except BaseException:
+                # never run, don't leave it unawaited
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+                raise
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update: object,
+                                coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
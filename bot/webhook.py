@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: webhook.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: webhook mode, telegram posts the updates to an aiohttp
+# server instead of the bot polling for them. The requests are checked
+# against the secret token of the webhook, GET /healthz tells a load
+# balancer whether the bot is up, and on SIGINT/SIGTERM the server stops
+# taking updates and the ones received are handled before exiting.
+import asyncio
+import hmac
+import signal
+from typing import Optional
+from urllib.parse import urlparse
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from logs.log import logger
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+
+    def __init__(self, application: Application, url: str, secret_token: str,
+                 listen: str = '0.0.0.0', port: int = 8443,
+                 path: Optional[str] = None,
+                 shutdown_timeout: float = 30):
+        """
+        :param url: the public url telegram posts the updates to, the
+         server is behind it (a reverse proxy terminating tls)
+        :param path: of the updates on this server, the path of url if None
+        :param secret_token: telegram sends it with every update, the same
+         one for all the workers behind url
+        :param shutdown_timeout: seconds the requests being served are
+         given on shutdown
+        """
+        self.application = application
+        self.url = url
+        self.listen = listen
+        self.port = port
+        self.path = path or urlparse(url).path or '/'
+        if not secret_token:
+            raise ValueError('secret_token is required')
+        self.secret_token = secret_token
+        self.shutdown_timeout = shutdown_timeout
+        self.app = web.Application()
+        self.app.router.add_post(self.path, self.handle_update)
+        self.app.router.add_get('/healthz', self.handle_health)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(),
+                                   self.secret_token.encode()):
+            logger.warning(f"webhook request from {request.remote} with a "
+                           f"wrong secret token")
+            return web.Response(status=403)
+        if not self.application.running:
+            # shutting down, telegram sends it again later
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            logger.error(f"bad webhook update: {e}")
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        if self.application.running:
+            return web.json_response({'status': 'ok'})
+        return web.json_response({'status': 'stopped'}, status=503)
+
+    async def start(self):
+        """Start the application and the server, then point the webhook of
+        the bot to the server"""
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+        self._runner = web.AppRunner(
+            self.app, shutdown_timeout=self.shutdown_timeout,
+            access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        await self.application.bot.set_webhook(
+            url=self.url, secret_token=self.secret_token,
+            allowed_updates=Update.ALL_TYPES)
+        logger.info(f"webhook server listening on {self.listen}:{self.port}"
+                    f"{self.path}")
+
+    async def stop(self):
+        """Stop taking updates, handle the ones received, then stop.
+        The webhook is left set, the other instances keep serving it."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self.application.running:
+            await self.application.stop()
+        if self.application.post_stop:
+            await self.application.post_stop(self.application)
+        await self.application.shutdown()
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+        logger.info("webhook server stopped")
+
+    async def serve(self):
+        """Serve until SIGINT or SIGTERM"""
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        await self.start()
+        try:
+            await stopping.wait()
+        finally:
+            await self.stop()
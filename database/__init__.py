@@ -8,17 +8,36 @@
 # Description:  Database init
 import os
 
-from sqlalchemy import create_engine, Table, Column, Boolean, MetaData, text, \
-    select, insert
+from sqlalchemy import inspect
 
+from config import config
+from database.engine import create_db_engine
+from database.migrations import stamp, upgrade
 from database.model_view import RoleServices, ModelServices, UserServices
-from database.models import Base
+from database.models import Base, User
 
 base_dir = '/etc/aibot'
 db_file = os.path.join(base_dir, 'db.sqlite')
-db_url = f'sqlite:///{os.path.join(base_dir, db_file)}'
-if not os.path.exists(db_file):
-    engine = create_engine(db_url, echo=False)
+# a networked database lets several workers share the users and dialogs
+db_url = config.db_url or f'sqlite:///{db_file}'
+engine = create_db_engine(db_url, pool_size=config.db_pool_size,
+                          max_overflow=config.db_max_overflow,
+                          pragmas=config.sqlite_pragmas)
+
+
+def init_db(dry_run: bool = False) -> list:
+    """Create the tables of a new database, or bring an existing one up to
+    date with the versioned steps in database/migrations.py. Called once on
+    start, not on import: importing the package doesn't touch the schema.
+    :param dry_run: only log the pending migrations, the database is left
+     as it is
+    :return: the versions applied (pending if dry_run)
+    """
+    if inspect(engine).has_table(User.__tablename__):
+        return upgrade(engine, dry_run=dry_run,
+                       batch_size=config.db_migration_batch_size)
+    if dry_run:
+        return []
     Base.metadata.create_all(engine)
 
     models_service = ModelServices(engine)
@@ -29,31 +48,5 @@ if not os.path.exists(db_file):
 
     user_service = UserServices(engine)
     user_service.init_root_user()
-else:
-    engine = create_engine(db_url, echo=False)
-    # 2023.10.17
-    # add a new column to model user
-    # metadata = MetaData()
-    # metadata.bind = engine
-    # user_table = Table('user', metadata, autoload_with=engine)
-    # if 'use_stream' not in user_table.columns:
-    #     with engine.begin() as conn:
-    #         conn.execute(text(
-    #             'ALTER TABLE user ADD COLUMN use_stream BOOLEAN DEFAULT FALSE'))
-
-    # 2023.10.19
-    # metadata = MetaData()
-    # metadata.bind = engine
-    # user_table = Table('ai_model', metadata, autoload_with=engine)
-    # # 开始数据库会话
-    # with engine.begin() as conn:
-    #     # 查询是否存在名为 "cloudflare" 的记录
-    #     query = select(user_table).where(user_table.c.name == 'cloudflare')
-    #     result = conn.execute(query)
-    #     record = result.fetchone()
-    #
-    #     # 如果不存在名为 "cloudflare" 的记录，则插入一条新记录
-    #     if record is None:
-    #         new_record = {'name': 'cloudflare', 'is_default': False,
-    #                       'is_available': True}
-    #         conn.execute(insert(user_table), new_record)
+    stamp(engine)
+    return []
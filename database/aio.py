@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: aio.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: awaitable services, run the blocking database calls in an
+# executor so they don't stall the asyncio event loop
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from .model_view import UnitOfWork, current_session
+
+
+def db_executor(max_workers: int = 1) -> ThreadPoolExecutor:
+    """The bounded executor all database calls run in.
+    A session is never used by two calls at once: the calls of one update
+    share its unit of work and run one after another, other calls get a
+    unit of work each.
+    """
+    return ThreadPoolExecutor(max_workers=max_workers,
+                              thread_name_prefix="db")
+
+
+class AsyncServices:
+    """Awaitable version of a services object (UserServices, DialogServices,
+    ModelServices, PromptServices...), every method runs in the executor:
+
+        user_db = AsyncServices(UserServices(engine), executor)
+        user = await user_db.get_user_by_user_id(user_id)
+
+    The method runs in the unit of work of the caller, or in a unit of work
+    of its own if the caller has none.
+    """
+
+    def __init__(self, services, executor: Executor):
+        self.services = services
+        self._executor = executor
+
+    def _run(self, func):
+        if current_session() is not None:
+            return func()
+        with UnitOfWork(self.services._engine):
+            return func()
+
+    def __getattr__(self, name):
+        attr = getattr(self.services, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # executor threads don't inherit the context (the unit of work)
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self._executor, ctx.run, self._run,
+                functools.partial(attr, *args, **kwargs))
+
+        return wrapper
+
+
+class AsyncDatabase:
+    """The engine and the db executor used by the handlers
+
+        db = AsyncDatabase(engine, db_executor(4))
+        user_db = db.services(UserServices(engine))
+
+        @db.transactional
+        async def message_handle(update, context):
+            ...
+    """
+
+    def __init__(self, engine, executor: Executor):
+        self.engine = engine
+        self.executor = executor
+
+    def services(self, services) -> AsyncServices:
+        return AsyncServices(services, self.executor)
+
+    async def _run(self, func):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func)
+
+    @asynccontextmanager
+    async def unit_of_work(self):
+        """One session for all services called inside, committed once at the
+        end, rolled back on exception. Nested calls join the outer one."""
+        if current_session() is not None:
+            yield
+            return
+        uow = UnitOfWork(self.engine)
+        uow.start()
+        try:
+            yield uow
+            await self._run(uow.commit)
+        except BaseException:
+            await self._run(uow.rollback)
+            raise
+        finally:
+            await self._run(uow.close)
+            uow.end()
+
+    def transactional(self, handler):
+        """Run the handler in a unit of work, one per telegram update"""
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            async with self.unit_of_work():
+                return await handler(*args, **kwargs)
+
+        return wrapper
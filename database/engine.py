@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: engine.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: engine factory, apply the sqlite pragmas on connect
+from typing import Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+# WAL lets readers run alongside the writer, synchronous NORMAL is safe in
+# WAL mode and saves a fsync per commit, busy_timeout (ms) waits for the lock
+# instead of failing at once with "database is locked"
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,  # negative: in KiB
+    'mmap_size': 134217728,
+}
+
+
+def create_db_engine(db_url: str, echo: bool = False,
+                     pool_size: int = 5, max_overflow: int = 10,
+                     pragmas: Optional[dict] = None) -> Engine:
+    """Create the engine, for sqlite every new connection is set up with
+    `pragmas` (DEFAULT_SQLITE_PRAGMAS if None, {} for sqlite defaults)
+
+    :param pool_size: connections kept open in the pool
+    :param max_overflow: connections opened beyond pool_size when all are
+     in use, -1 for no limit
+    """
+    kwargs = {}
+    # in memory sqlite uses a single connection pool, no size to set
+    if db_url not in ('sqlite://', 'sqlite:///:memory:'):
+        kwargs.update(pool_size=pool_size, max_overflow=max_overflow)
+    engine = create_engine(db_url, echo=echo, **kwargs)
+
+    if engine.dialect.name == 'sqlite':
+        pragmas = DEFAULT_SQLITE_PRAGMAS if pragmas is None else pragmas
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for key, value in pragmas.items():
+                cursor.execute(f'PRAGMA {key}={value}')
+            cursor.close()
+
+    return engine
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: migrations.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: versioned schema migrations, the applied versions are kept in
+# the schema_version table
+#
+# A schema migration is a function taking a connection, all pending ones run
+# in a single transaction. A data migration moves rows in batches, one short
+# transaction per batch, and runs after all the schema migrations:
+#
+#   @migration(6, 'add column dialog.title')
+#   def add_dialog_title(conn):
+#       ...
+#
+#   @data_migration(7, 'fill dialog.title')
+#   def fill_dialog_title(conn, after_id, batch_size):
+#       ...  # handle batch_size rows with id > after_id
+#       return last_id  # None when no row is left
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import inspect, text, select, insert, func, event
+
+from logs.log import logger
+from .model_view import DialogServices
+from .models import AiModel, ChatLease, Dialog, DialogMessage, SchemaVersion
+
+Migration = namedtuple('Migration', 'version description step batched')
+
+MIGRATIONS = []
+# dialects rolling back CREATE/ALTER, mysql commits them on their own
+TRANSACTIONAL_DDL = {'sqlite', 'postgresql'}
+
+
+def migration(version: int, description: str, batched: bool = False):
+    """Register a migration step, versions must be increasing"""
+
+    def decorator(step):
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version
+        MIGRATIONS.append(Migration(version, description, step, batched))
+        return step
+
+    return decorator
+
+
+def data_migration(version: int, description: str):
+    """Register a batched data migration step"""
+    return migration(version, description, batched=True)
+
+
+@migration(1, 'add column user.use_stream')  # 2023.10.17
+def add_user_use_stream(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('user')]
+    if 'use_stream' not in columns:
+        conn.execute(text(
+            'ALTER TABLE user ADD COLUMN use_stream BOOLEAN DEFAULT FALSE'))
+
+
+@migration(2, 'add model cloudflare')  # 2023.10.19
+def add_cloudflare_model(conn):
+    table = AiModel.__table__
+    if conn.execute(select(table).where(
+            table.c.name == 'cloudflare')).first() is None:
+        conn.execute(insert(table), {'name': 'cloudflare',
+                                     'is_default': False,
+                                     'is_available': True})
+
+
+@migration(3, 'add table dialog_message')  # 2026.10.18
+def add_dialog_message(conn):
+    DialogMessage.__table__.create(conn, checkfirst=True)
+
+
+@migration(4, 'index dialog by (user_id, ai_model_id, id) and '
+              '(user_id, start_time)')
+def add_dialog_indexes(conn):
+    for index in Dialog.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+@data_migration(5, 'move the dialog.messages json turns to dialog_message')
+def move_dialog_turns(conn, after_id, batch_size):
+    return DialogServices(conn).migrate_json_messages(after_id, batch_size)
+
+
+@migration(6, 'add column dialog_message.token_count')
+def add_turn_token_count(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('dialog_message')]
+    if 'token_count' not in columns:
+        conn.execute(text(
+            'ALTER TABLE dialog_message ADD COLUMN token_count INTEGER'))
+
+
+@migration(7, 'add columns dialog.summary and dialog.summary_until')
+def add_dialog_summary(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('dialog')]
+    if 'summary' not in columns:
+        conn.execute(text('ALTER TABLE dialog ADD COLUMN summary TEXT'))
+    if 'summary_until' not in columns:
+        conn.execute(text(
+            'ALTER TABLE dialog ADD COLUMN summary_until INTEGER'))
+
+
+@migration(8, 'add table chat_lease')
+def add_chat_lease(conn):
+    ChatLease.__table__.create(conn, checkfirst=True)
+
+
+def applied_versions(conn) -> set:
+    SchemaVersion.__table__.create(conn, checkfirst=True)
+    return set(conn.execute(select(SchemaVersion.version)).scalars())
+
+
+def current_version(conn) -> int:
+    """The version of the schema migrations applied"""
+    SchemaVersion.__table__.create(conn, checkfirst=True)
+    version = conn.execute(select(func.max(SchemaVersion.version)).where(
+        SchemaVersion.version.in_(
+            [m.version for m in MIGRATIONS if not m.batched]))).scalar()
+    return version or 0
+
+
+def _pending(conn) -> list:
+    version = current_version(conn)
+    applied = applied_versions(conn)
+    return [m for m in MIGRATIONS if m.version not in applied and (
+            m.batched or m.version > version)]
+
+
+def _record(conn, version: int, description: str):
+    conn.execute(insert(SchemaVersion.__table__),
+                 {'version': version, 'description': description,
+                  'applied_at': datetime.now()})
+
+
+@contextmanager
+def _transaction(engine, rollback: bool = False):
+    """Like engine.begin(), rolled back at the end if rollback.
+    pysqlite only begins a transaction before INSERT/UPDATE/DELETE, CREATE and
+    ALTER would be committed on their own, so BEGIN is sent explicitly to
+    have the whole upgrade in one transaction."""
+    with engine.connect() as conn:
+        dbapi_conn = conn.connection.driver_connection
+        is_sqlite = conn.dialect.name == 'sqlite'
+        if is_sqlite:
+            isolation_level = dbapi_conn.isolation_level
+            dbapi_conn.isolation_level = None
+            event.listen(conn, 'begin',
+                         lambda c: c.exec_driver_sql('BEGIN IMMEDIATE'))
+        try:
+            trans = conn.begin()
+            try:
+                yield conn
+            except BaseException:
+                trans.rollback()
+                raise
+            if rollback:
+                trans.rollback()
+            else:
+                trans.commit()
+        finally:
+            if is_sqlite:
+                dbapi_conn.isolation_level = isolation_level
+
+
+def stamp(engine):
+    """Mark a database created by create_all as up to date"""
+    with _transaction(engine) as conn:
+        applied = applied_versions(conn)
+        for m in MIGRATIONS:
+            if m.version not in applied:
+                _record(conn, m.version, m.description)
+
+
+def upgrade(engine, dry_run: bool = False, batch_size: int = 500) -> list:
+    """Apply the pending migrations, return their versions.
+
+    The schema migrations newer than the database run in one transaction:
+    all of them are applied or none. Then the pending data migrations run,
+    batch_size rows per transaction, a data migration interrupted is started
+    over on next upgrade.
+
+    :param dry_run: run the schema migrations and roll back, the data
+     migrations are only listed. All of them are only listed if the dialect
+     can't roll back the schema changes
+    """
+    if dry_run and engine.dialect.name not in TRANSACTIONAL_DDL:
+        with engine.connect() as conn:
+            # not even the schema_version table is created
+            pending = _pending(conn) if inspect(conn).has_table(
+                SchemaVersion.__tablename__) else list(MIGRATIONS)
+        for m in pending:
+            logger.info(f"dry run, not run on {engine.dialect.name}: "
+                        f"migration {m.version}: {m.description}")
+        return [m.version for m in pending]
+
+    with _transaction(engine, rollback=dry_run) as conn:
+        pending = _pending(conn)
+        for m in pending:
+            if m.batched:
+                continue
+            logger.info(f"{'dry run ' if dry_run else ''}migration "
+                        f"{m.version}: {m.description}")
+            m.step(conn)
+            _record(conn, m.version, m.description)
+
+    for m in pending:
+        if not m.batched:
+            continue
+        logger.info(f"{'dry run ' if dry_run else ''}data migration "
+                    f"{m.version}: {m.description}")
+        if dry_run:
+            continue
+        after_id, batches = 0, 0
+        while after_id is not None:
+            with engine.begin() as conn:
+                after_id = m.step(conn, after_id, batch_size)
+                if after_id is None:
+                    _record(conn, m.version, m.description)
+            batches += 1
+        logger.info(f"data migration {m.version} done in {batches} batches")
+    return [m.version for m in pending]
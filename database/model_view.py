@@ -1,25 +1,120 @@
+import time
 import uuid
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Optional, Any
+from threading import Lock
+from typing import Optional, Any, Callable
 
-from sqlalchemy import desc
-from sqlalchemy.exc import NoResultFound
-from sqlalchemy.orm import sessionmaker
+from cachetools import TTLCache
+from sqlalchemy import case, desc, delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, joinedload, Session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from config import config
-from .models import User, Dialog, Prompt, AiModel, Permission, Role
+from .models import User, Dialog, DialogMessage, Prompt, AiModel, ChatLease, \
+    Permission, Role
+
+
+# the unit of work of the telegram update being handled in current context
+_current_uow: ContextVar[Optional["UnitOfWork"]] = ContextVar(
+    "current_uow", default=None)
+
+
+def current_session() -> Optional[Session]:
+    """The session of the active unit of work, None if there is none"""
+    uow = _current_uow.get()
+    if uow is not None and uow.active:
+        return uow.session
+    return None
+
+
+class UnitOfWork:
+    """One session per telegram update, shared by all services and committed
+    once at the end. autoflush is off: the changes are written by the final
+    commit only, so no write lock is held while the handler waits for the ai.
+
+        with UnitOfWork(engine):
+            user_db.set_user_attribute(user_id, 'last_interaction', now)
+            dialog_db.append_dialog_message(user_id, dialog_message)
+    """
+
+    def __init__(self, _engine):
+        self.session = Session(_engine, autoflush=False,
+                               expire_on_commit=False)
+        self.active = False
+        self._token = None
+
+    def start(self):
+        self.active = True
+        self._token = _current_uow.set(self)
+
+    def end(self):
+        """Deactivate, must be called in the context start was called in"""
+        self.active = False
+        if self._token is not None:
+            _current_uow.reset(self._token)
+            self._token = None
+
+    def commit(self):
+        self.session.commit()
+        self.session.info.pop('on_rollback', None)
+
+    def rollback(self):
+        self.session.rollback()
+        for callback in self.session.info.pop('on_rollback', []):
+            callback()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+            self.end()
 
 
 class Database:
 
     def __init__(self, _engine):
         self._engine = _engine
-        self.session = sessionmaker(bind=self._engine)()
+        self._session_factory = sessionmaker(bind=self._engine)
+        self._session = self._session_factory()
+
+    @property
+    def session(self) -> Session:
+        """The session of the current unit of work, or the own session of the
+        services when called outside a unit of work"""
+        session = current_session()
+        return session if session is not None else self._session
+
+    def _standalone(self):
+        """A session committed at once, even inside a unit of work, for the
+        rare writes that must be visible right away"""
+        return self._session_factory.begin()
+
+    def _on_rollback(self, callback):
+        """Run callback if the current unit of work rolls back"""
+        session = current_session()
+        if session is not None:
+            session.info.setdefault('on_rollback', []).append(callback)
 
     def __enter__(self):
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if current_session() is not None:
+            # the unit of work commits or rolls back once at the end
+            return
         if exc_type is None:
             self.session.commit()
         else:
@@ -50,12 +145,111 @@ class RoleServices(Database):
         return self.session.query(Role).filter_by(name='User').first()
 
 
+class UserCache:
+    """In-process cache for User rows on the request hot path.
+    Entries expire after `ttl` seconds, the least recently used one is evicted
+    when the cache is full, nothing is cached if maxsize is 0. hits/misses
+    are counted to check the hit rate.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 300):
+        self.maxsize = maxsize
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # the services run in the db executor threads
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            user = self._cache.get(str(user_id))
+            if user is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return user
+
+    def set(self, user_id, user: User):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._cache[str(user_id)] = user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._cache.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._cache),
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
 class UserServices(Database):
+
+    def __init__(self, _engine):
+        super().__init__(_engine)
+        self.cache = UserCache(maxsize=config.user_cache_size,
+                               ttl=config.user_cache_ttl)
+
+    def _get_user(self, user_id: str) -> Optional[User]:
+        """Get the User (with its role loaded) from cache, query the database
+        on cache miss. The cached User is detached from any session, it is
+        only modified by _update_user so the cache stays in sync with the db
+        """
+        user = self.cache.get(user_id)
+        if user is None:
+            user = self.session.query(User).options(
+                joinedload(User.role)).filter_by(user_id=user_id).first()
+            # changed in the current unit of work (autoflush is off, the
+            # query returns the object of the session): it stays in the
+            # session with its changes and isn't cached until committed
+            if user is not None and user not in self.session.dirty:
+                self.session.expunge(user)
+                if user.role is not None:
+                    self.session.expunge(user.role)
+                self.cache.set(user_id, user)
+        return user
+
+    def _update_user(self, user_id: str, **values) -> bool:
+        """Write values to the user row and the cached User (write through),
+        return False if the user not exists
+        """
+        user = self._get_user(user_id)
+        if user is None:
+            return False
+        # already changed in the current unit of work, not cached
+        attached = user in self.session
+        try:
+            with self as session:
+                # load=False: no select, the cached user is the current row
+                target = user if attached else session.merge(user,
+                                                             load=False)
+                for key, value in values.items():
+                    setattr(target, key, value)
+        except Exception:
+            self.cache.invalidate(user_id)
+            raise
+        if attached or 'role_id' in values:
+            # role relationship is stale now, reload it next time
+            self.cache.invalidate(user_id)
+        else:
+            for key, value in values.items():
+                set_committed_value(user, key, value)
+            self._on_rollback(lambda: self.cache.invalidate(user_id))
+        return True
+
     def check_if_user_exists(self, user_id: str):
         """Check if user exists in database,
         use cache to reduce database query
         """
-        return self.session.query(User).filter_by(user_id=user_id).count() > 0
+        return self._get_user(user_id) is not None
 
     def add_new_user(self, user_id: str, chat_id: int, username: str = "",
                      first_name: str = "", last_name: str = "",
@@ -65,7 +259,9 @@ class UserServices(Database):
         if not self.check_if_user_exists(user_id):
             if role_id == 0:
                 role_id = RoleServices(self._engine).get_default_role().id
-            with self as session:
+            # committed at once even inside a unit of work, the handler reads
+            # the new user back right away
+            with self._standalone() as session:
                 user = User(**{'user_id': user_id, 'chat_id': chat_id,
                                'username': username, 'first_name': first_name,
                                'last_name': last_name, 'role_id': role_id})
@@ -78,14 +274,11 @@ class UserServices(Database):
         it query the database twice, use try except instead
         get user's attribute by key
         """
-        try:
-            user = self.session.query(User).filter_by(user_id=user_id).first()
-            if not hasattr(user, key):
-                raise ValueError(
-                    f"User {user_id} does not have a value for {key}")
-            return getattr(user, key)
-        except NoResultFound:
-            return None
+        user = self._get_user(user_id)
+        if not hasattr(user, key):
+            raise ValueError(
+                f"User {user_id} does not have a value for {key}")
+        return getattr(user, key)
 
     def list_all_user(self):
         return self.session.query(User).all()
@@ -95,21 +288,13 @@ class UserServices(Database):
                 use try except instead
                 set user's attribute by key
         """
-        user = self.session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            with self as session:
-                setattr(user, key, value)
-                session.add(user)
-        else:
+        if not self._update_user(user_id, **{key: value}):
             raise Exception('user not exists, can not set attribute')
 
     def add_user_api_count(self, user_id: str, count: int):
-        user = self.session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            with self as session:
-                user.api_count += count
-                session.add(user)
-        else:
+        user = self._get_user(user_id)
+        if not user or not self._update_user(
+                user_id, api_count=user.api_count + count):
             raise Exception('user not exists, can not add api count')
 
     def del_user(self, user_id: str):
@@ -117,11 +302,12 @@ class UserServices(Database):
         """
         with self as session:
             session.query(User).filter_by(user_id=user_id).delete()
+        self.cache.invalidate(user_id)
 
     def get_user_by_user_id(self, user_id):
         """user telegram user id to return the User object id
         """
-        return self.session.query(User).filter_by(user_id=user_id).first()
+        return self._get_user(user_id)
 
     def init_root_user(self):
         with self as session:
@@ -134,61 +320,214 @@ class UserServices(Database):
                     session.add(user)
             else:
                 self.add_new_user(config.root_user_id, 0, role_id=role_id)
+        self.cache.invalidate(config.root_user_id)
 
     def is_admin(self, user_id: str):
         # admin user will not consume api count
-        return self.session.query(User).filter_by(
-            user_id=user_id).first().role.has_permission(Permission.ADMIN)
+        return self._get_user(user_id).has_permission(Permission.ADMIN)
 
     def is_root(self, user_id: str):
         # root user will not consume api count
-        return self.session.query(User).filter_by(
-            user_id=user_id).first().role.has_permission(Permission.ROOT)
-
-    def consume_api_count(self, user_id: str):
-        with self as session:
-            user = session.query(User).filter_by(user_id=user_id).first()
-            if user:
-                user.total_api_count += 1
-                if user.api_count > 0 and not self.is_admin(user_id):
-                    user.api_count -= 1
-                session.add(user)
+        return self._get_user(user_id).has_permission(Permission.ROOT)
+
+    def _change_api_count(self, user_id: str, step: int,
+                          check: bool) -> bool:
+        """Add step to the user's total api count, and take it from the api
+        count unless the user is an admin, in one statement committed at
+        once so concurrent messages (of any worker) can't overspend or lose
+        a change. With check, nothing changes if the count is used up.
+        The cached user gets the new counts."""
+        table = User.__table__
+        is_admin = table.c.role_id.in_(select(Role.id).where(
+            Role.permissions.op('&')(Permission.ADMIN.value) ==
+            Permission.ADMIN.value))
+        stmt = update(table).where(table.c.user_id == str(user_id)).values(
+            total_api_count=table.c.total_api_count + step,
+            api_count=case((is_admin, table.c.api_count),
+                           else_=table.c.api_count - step))
+        if check:
+            stmt = stmt.where(or_(table.c.api_count > 0, is_admin))
+        columns = (table.c.api_count, table.c.total_api_count)
+        with self._standalone() as session:
+            if self._engine.dialect.update_returning:
+                row = session.execute(stmt.returning(*columns)).first()
+            else:
+                # no UPDATE ... RETURNING (mysql), read it back in the
+                # same transaction, the row is locked by the update
+                row = session.execute(stmt).rowcount and session.execute(
+                    select(*columns).where(
+                        table.c.user_id == str(user_id))).first()
+        if not row:
+            return False
+        user = self.cache.get(user_id)
+        if user is not None:
+            set_committed_value(user, 'api_count', row[0])
+            set_committed_value(user, 'total_api_count', row[1])
+        return True
+
+    def reserve_api_count(self, user_id: str) -> bool:
+        """Take one api call of the user's quota before asking the ai,
+        False if there is none left (or no such user). Admins are not
+        limited. refund_api_count gives it back if no answer is kept."""
+        return self._change_api_count(user_id, 1, check=True)
+
+    def refund_api_count(self, user_id: str):
+        self._change_api_count(user_id, -1, check=False)
 
 
 class DialogServices(Database):
 
+    def __init__(self, _engine, model_db: Optional["ModelServices"] = None,
+                 token_counter: Optional[Callable[[str, str], int]] = None,
+                 user_db: Optional[UserServices] = None):
+        """
+        :param model_db: share the ModelServices (and its model snapshot)
+         so that the ai models are looked up without query
+        :param token_counter: token_counter(user, assistant) counts the
+         tokens of a turn, stored with the turn so it's not counted again
+         on every message. Not counted if None
+        :param user_db: share the UserServices, the current dialog of the
+         user is set through it so its cached user stays in sync
+        """
+        super().__init__(_engine)
+        self.model_db = model_db or ModelServices(_engine)
+        self.token_counter = token_counter
+        self.user_db = user_db
+
+    def _set_current_dialog(self, session, user_obj: Optional[User],
+                            user_id: str, dialog_id: str):
+        if self.user_db is not None:
+            # write through the cached user
+            self.user_db._update_user(user_id, current_dialog_id=dialog_id)
+        elif user_obj is not None:
+            user_obj.current_dialog_id = dialog_id
+            session.add(user_obj)
+
+    def _new_turn(self, dialog: Dialog, user: str, assistant: str,
+                  created_at: datetime) -> DialogMessage:
+        token_count = None
+        if self.token_counter is not None:
+            token_count = self.token_counter(user, assistant)
+        return DialogMessage(dialog=dialog, user=user, assistant=assistant,
+                             created_at=created_at, token_count=token_count)
+
+    def _get_model_id(self, ai_model: str) -> Optional[int]:
+        ai_model_obj = self.model_db.get_model(ai_model)
+        return ai_model_obj.id if ai_model_obj is not None else None
+
     def start_new_dialog(self, user_id: str):
         """Start a new dialog for user"""
         with self as session:
             user = session.query(User).filter_by(user_id=user_id).first()
-            ai = session.query(AiModel).filter_by(is_default=True).first()
+            ai = self.model_db.get_default_model()
             dialog_id = str(uuid.uuid4())
             dialog = Dialog(
                 **{'dialog_id': dialog_id, 'user_id': user_id,
                    'chat_mode': user.current_chat_mode,
                    'start_time': datetime.now(), 'messages': [],
-                   "ai_model": ai})
-            session.add_all([user, dialog])
+                   "ai_model_id": ai.id if ai is not None else None})
+            session.add(dialog)
+            self._set_current_dialog(session, user, user_id, dialog_id)
         return dialog
 
-    def get_dialog_messages(self, user_id: str, dialog_id: Optional[str] = None,
-                            ai_model: str = "ChatGpt"):
-        """Get dialog messages for user"""
-        user_obj = self.session.query(User).filter_by(user_id=user_id).first()
-        ai_model_obj = self.session.query(AiModel).filter_by(
-            name=ai_model).first()
+    def _get_dialog(self, user_id: str, dialog_id: Optional[str] = None,
+                    ai_model: str = "ChatGpt"):
+        """Get the dialog by dialog_id, or the latest dialog of the user"""
+        ai_model_id = self._get_model_id(ai_model)
+        dq = self.session.query(Dialog).filter_by(user_id=user_id,
+                                                  ai_model_id=ai_model_id)
         if dialog_id is None:
-            dialog = self.session.query(Dialog).filter_by(
-                user_id=user_obj.user_id, ai_model=ai_model_obj).order_by(
-                desc(Dialog.id)).first()
-        else:
-            dialog = self.session.query(Dialog).filter_by(
-                user_id=user_obj.user_id, dialog_id=dialog_id,
-                ai_model=ai_model_obj).first()
-        # reduce the messages length
-        if dialog is not None:
-            return dialog.messages
-        return []
+            # a dialog started in the current unit of work is not flushed yet
+            for obj in self.session.new:
+                if isinstance(obj, Dialog) and str(obj.user_id) == str(
+                        user_id) and obj.ai_model_id == ai_model_id:
+                    return obj
+            return dq.order_by(desc(Dialog.id)).first()
+        return dq.filter_by(dialog_id=dialog_id).first()
+
+    def _get_turns(self, dialog: Dialog, limit: Optional[int] = None,
+                   after_id: Optional[int] = None) -> list:
+        """Get the last `limit` turns of the dialog, including the turns
+        added and excluding the ones deleted in the current unit of work
+        :param after_id: only the turns saved after this one
+        """
+        deleted = self.session.deleted
+        turns = []
+        if dialog.id is not None:
+            mq = self.session.query(DialogMessage).filter_by(
+                dialog_id=dialog.id).order_by(desc(DialogMessage.id))
+            if after_id is not None:
+                mq = mq.filter(DialogMessage.id > after_id)
+            if limit is not None:
+                mq = mq.limit(limit + len(deleted))
+            turns = [m for m in reversed(mq.all()) if m not in deleted]
+        turns += [obj for obj in self.session.new
+                  if isinstance(obj, DialogMessage) and obj.dialog is dialog]
+        return turns[-limit:] if limit is not None else turns
+
+    def get_dialog_messages(self, user_id: str, dialog_id: Optional[str] = None,
+                            ai_model: str = "ChatGpt",
+                            limit: Optional[int] = None,
+                            since_summary: bool = False):
+        """Get dialog messages for user
+        :param limit: only return the last `limit` turns, all turns if None
+        :param since_summary: only return the turns not in the summary of
+         the dialog
+        """
+        dialog = self._get_dialog(user_id, dialog_id, ai_model)
+        if dialog is None:
+            return []
+        after_id = dialog.summary_until if since_summary else None
+        return [m.to_dict() for m in self._get_turns(dialog, limit, after_id)]
+
+    def get_dialog_summary(self, user_id: str, dialog_id: Optional[str] = None,
+                           ai_model: str = "ChatGpt") -> Optional[str]:
+        """The summary of the older turns of the dialog, None if there is
+        none"""
+        dialog = self._get_dialog(user_id, dialog_id, ai_model)
+        return dialog.summary if dialog is not None else None
+
+    def count_turns_to_summarize(self, user_id: str,
+                                 ai_model: str = "ChatGpt") -> int:
+        """The number of turns of the latest dialog not in its summary,
+        counted in the database: the context is cut to max_context_turns"""
+        dialog = self._get_dialog(user_id, ai_model=ai_model)
+        if dialog is None or dialog.id is None:
+            return 0
+        mq = self.session.query(func.count(DialogMessage.id)).filter(
+            DialogMessage.dialog_id == dialog.id)
+        if dialog.summary_until is not None:
+            mq = mq.filter(DialogMessage.id > dialog.summary_until)
+        return mq.scalar()
+
+    def get_turns_to_summarize(self, user_id: str, ai_model: str = "ChatGpt",
+                               keep: int = 0) -> Optional[dict]:
+        """The turns of the latest dialog not summarized yet but the latest
+        `keep` ones, None if there is none
+        :return: {'dialog_id': dialog.id, 'summary': current summary,
+         'turns': [{'user': "", 'assistant': ""}], 'until': last turn id}
+        """
+        dialog = self._get_dialog(user_id, ai_model=ai_model)
+        if dialog is None or dialog.id is None:
+            return None
+        turns = [t for t in self._get_turns(dialog,
+                                            after_id=dialog.summary_until)
+                 if t.id is not None]
+        turns = turns[:max(len(turns) - keep, 0)]
+        if not turns:
+            return None
+        return {'dialog_id': dialog.id, 'summary': dialog.summary,
+                'turns': [t.to_dict() for t in turns],
+                'until': turns[-1].id}
+
+    def set_dialog_summary(self, dialog_id: int, summary: str, until: int):
+        """Save the summary of the turns of the dialog up to turn `until`,
+        committed at once: it's made in the background, out of any update
+        :param dialog_id: Dialog.id
+        """
+        with self._standalone() as session:
+            session.query(Dialog).filter_by(id=dialog_id).update(
+                {'summary': summary, 'summary_until': until})
 
     def get_real_dialog_id(self, user_id: str, dialog_id: int) -> int:
         """
@@ -206,31 +545,128 @@ class DialogServices(Database):
             dialog_id = dq.order_by(Dialog.start_time.desc())[dialog_id - 1].id
         return dialog_id
 
-    def set_dialog_messages(self, user_id: str, dialog_messages: list,
-                            ai_model: str = "ChatGpt"):
-        ai_model_obj = self.session.query(AiModel).filter_by(
-            name=ai_model).first()
-        user_obj = self.session.query(User).filter_by(user_id=user_id).first()
-        dialog_obj = self.session.query(Dialog).filter_by(
-            user_id=user_id, ai_model=ai_model_obj).order_by(
-            desc(Dialog.id)).first()
+    def _get_or_create_dialog(self, session, user_id: str,
+                              ai_model: str = "ChatGpt"):
+        """Get the latest dialog of the user, create one if there is none"""
+        dialog_obj = self._get_dialog(user_id, ai_model=ai_model)
         if dialog_obj is None:
+            user_obj = session.query(User).filter_by(user_id=user_id).first()
             dialog_id = str(uuid.uuid4())
-            new_dialog = Dialog(
+            dialog_obj = Dialog(
                 **{'dialog_id': dialog_id, 'user_id': user_id,
-                   'start_time': datetime.now(), 'messages': dialog_messages})
-            new_dialog.ai_model = ai_model_obj
-            self.session.add(new_dialog)
-            user_obj.current_dialog_id = dialog_id
-            self.session.add(user_obj)
+                   'start_time': datetime.now(), 'messages': [],
+                   'ai_model_id': self._get_model_id(ai_model)})
+            session.add(dialog_obj)
+            self._set_current_dialog(session, user_obj, user_id, dialog_id)
+        return dialog_obj
+
+    @staticmethod
+    def _delete_turn(session, turn: DialogMessage):
+        if turn in session.new:
+            # not written yet, unlink it so it's not cascaded back at flush
+            turn.dialog = None
+            session.expunge(turn)
         else:
-            dialog_obj.messages = dialog_messages
-            self.session.merge(dialog_obj)
+            session.delete(turn)
 
-        self.session.commit()
+    def append_dialog_message(self, user_id: str, dialog_message: dict,
+                              ai_model: str = "ChatGpt"):
+        """Append one turn to the latest dialog, only the new turn is written
+        :param dialog_message: {'user': "", 'assistant': "", 'date': ""}
+        """
+        with self as session:
+            dialog_obj = self._get_or_create_dialog(session, user_id, ai_model)
+            session.add(self._new_turn(dialog_obj, dialog_message['user'],
+                                       dialog_message['assistant'],
+                                       datetime.now()))
+
+    def pop_dialog_message(self, user_id: str, ai_model: str = "ChatGpt"):
+        """Remove the last turn of the latest dialog and return it"""
+        dialog_obj = self._get_dialog(user_id, ai_model=ai_model)
+        if dialog_obj is None:
+            return None
+        turns = self._get_turns(dialog_obj, limit=1)
+        if not turns:
+            return None
+        dialog_message = turns[0].to_dict()
+        with self as session:
+            self._delete_turn(session, turns[0])
+        return dialog_message
+
+    def set_dialog_messages(self, user_id: str, dialog_messages: list,
+                            ai_model: str = "ChatGpt"):
+        """Replace all turns of the latest dialog, prefer append_dialog_message
+        when only one turn is added"""
+        with self as session:
+            dialog_obj = self._get_or_create_dialog(session, user_id, ai_model)
+            for turn in self._get_turns(dialog_obj):
+                self._delete_turn(session, turn)
+            session.add_all(
+                [self._new_turn(dialog_obj, msg['user'], msg['assistant'],
+                                datetime.now())
+                 for msg in dialog_messages])
+
+    def migrate_json_messages(self, after_id: int = 0,
+                              batch_size: Optional[int] = None
+                              ) -> Optional[int]:
+        """Move the turns saved in Dialog.messages json column to the
+        dialog_message table, the json column is emptied so it's safe to run
+        more than once.
+        :param after_id: only the dialogs with a greater id are moved
+        :param batch_size: move at most batch_size dialogs, all if None
+        :return: the id of the last dialog looked at, None if none was left
+        """
+        with self as session:
+            dq = session.query(Dialog).filter(Dialog.id > after_id).order_by(
+                Dialog.id)
+            if batch_size is not None:
+                dq = dq.limit(batch_size)
+            dialogs = dq.all()
+            last_id = dialogs[-1].id if dialogs else None
+            for dialog in dialogs:
+                if not dialog.messages:
+                    continue
+                session.add_all(
+                    [DialogMessage(dialog=dialog, user=msg.get('user', ''),
+                                   assistant=msg.get('assistant', ''),
+                                   created_at=dialog.start_time)
+                     for msg in dialog.messages if isinstance(msg, dict)])
+                dialog.messages = []
+        return last_id
 
 
 class ModelServices(Database):
+    """The ai_model table only changes when admin operates the models, so
+    a snapshot of the table is kept in memory and the getters do no query.
+    The snapshot is refreshed by add_new_model, del_model and update_model,
+    they commit at once (even inside a unit of work) to keep it in sync.
+    With several workers the others change the table too, the snapshot is
+    then reloaded `ttl` seconds after it was taken.
+    """
+
+    def __init__(self, _engine, ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param ttl: seconds the snapshot is kept, forever if None
+        """
+        super().__init__(_engine)
+        self.ttl = ttl
+        self.clock = clock
+        self._models = None
+        self._expires_at = None
+
+    def _snapshot(self) -> list:
+        if self._models is None or (self._expires_at is not None and
+                                    self.clock() >= self._expires_at):
+            self.refresh()
+        return self._models
+
+    def refresh(self):
+        """Reload the snapshot, the AiModel objects are detached"""
+        with Session(self._engine) as session:
+            self._models = session.query(AiModel).order_by(AiModel.id).all()
+        if self.ttl is not None:
+            self._expires_at = self.clock() + self.ttl
 
     def init_models(self):
         # init models from config available models
@@ -240,35 +676,37 @@ class ModelServices(Database):
                                is_available=True)
 
     def get_available_models(self):
-        return [m.name for m in
-                self.session.query(AiModel).filter_by(is_available=True).all()]
+        return [m.name for m in self._snapshot() if m.is_available]
 
     def get_default_model(self):
-        return self.session.query(AiModel).filter_by(is_default=True).first()
+        return next((m for m in self._snapshot() if m.is_default), None)
 
     def add_new_model(self, name: str, is_default: bool = False,
                       is_available: bool = True):
-        with self as session:
+        with self._standalone() as session:
             session.add(AiModel(**{'name': name, 'is_default': is_default,
                                    'is_available': is_available}))
+        self.refresh()
 
     def del_model(self, name: str):
-        with self as session:
+        with self._standalone() as session:
             session.query(AiModel).filter_by(name=name).delete()
+        self.refresh()
 
     def update_model(self, name: str, is_default: bool = False,
                      is_available: bool = True):
-        with self as session:
+        with self._standalone() as session:
             model = session.query(AiModel).filter_by(name=name).first()
             model.is_default = is_default
             model.is_available = is_available
             session.add(model)
+        self.refresh()
 
     def get_model(self, name: str):
-        return self.session.query(AiModel).filter_by(name=name).first()
+        return next((m for m in self._snapshot() if m.name == name), None)
 
     def list_all_model(self):
-        return self.session.query(AiModel).all()
+        return list(self._snapshot())
 
 
 class PromptServices(Database):
@@ -285,3 +723,52 @@ class PromptServices(Database):
     def del_prompt(self, _id: int):
         with self as session:
             session.query(Prompt).filter_by(id=_id).delete()
+
+
+class LeaseServices(Database):
+    """Leases on the chats (or any key) shared by the workers of a bot, a key
+    is held by one owner until it's released or expires. Every call commits
+    at once, the other workers see it right away.
+
+        if lease_db.acquire('chat:42', owner, ttl=60):
+            ...  # lease_db.renew() before the ttl is over
+            lease_db.release('chat:42', owner)
+    """
+
+    def __init__(self, _engine, clock: Callable[[], float] = time.time):
+        super().__init__(_engine)
+        self.clock = clock
+
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        """Take the lease for ttl seconds if it's free, expired or already
+        owned, return False if another owner holds it"""
+        now = self.clock()
+        with self._standalone() as session:
+            taken = session.execute(
+                update(ChatLease).where(
+                    ChatLease.key == key,
+                    or_(ChatLease.owner == owner, ChatLease.expires_at <= now))
+                .values(owner=owner, expires_at=now + ttl)).rowcount
+        if taken:
+            return True
+        try:
+            with self._standalone() as session:
+                session.add(ChatLease(key=key, owner=owner,
+                                      expires_at=now + ttl))
+            return True
+        except IntegrityError:
+            # the row is there, held by another owner
+            return False
+
+    def renew(self, key: str, owner: str, ttl: float) -> bool:
+        """Extend the lease, False if it was lost (expired and taken)"""
+        with self._standalone() as session:
+            return session.execute(
+                update(ChatLease).where(ChatLease.key == key,
+                                        ChatLease.owner == owner)
+                .values(expires_at=self.clock() + ttl)).rowcount > 0
+
+    def release(self, key: str, owner: str):
+        with self._standalone() as session:
+            session.execute(delete(ChatLease).where(ChatLease.key == key,
+                                                    ChatLease.owner == owner))
@@ -12,9 +12,11 @@ from sqlalchemy import (
     Text,
     ForeignKey,
     Boolean,
+    Float,
     CheckConstraint,
+    Index,
 )
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.orm import declarative_base, relationship, backref
 
 Base = declarative_base()
 
@@ -85,6 +87,40 @@ class Dialog(Base):
     messages = Column(JSON(), nullable=False)
     ai_model_id = Column(Integer, ForeignKey("ai_model.id"))
     ai_model = relationship("AiModel", backref="dialogs")
+    # rolling summary of the turns up to dialog_message.id summary_until
+    summary = Column(Text, nullable=True, default=None)
+    summary_until = Column(Integer, nullable=True, default=None)
+
+    __table_args__ = (
+        # latest dialog of a user with a model: filter user/model, order id
+        Index("ix_dialog_user_id_ai_model_id_id", "user_id", "ai_model_id",
+              "id"),
+        # dialogs of a user by start time (get_real_dialog_id)
+        Index("ix_dialog_user_id_start_time", "user_id", "start_time"),
+    )
+
+
+class DialogMessage(Base):
+    """One user/assistant turn of a dialog, appended instead of rewriting
+    the whole Dialog.messages json column every turn"""
+    __tablename__ = "dialog_message"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dialog_id = Column(Integer, ForeignKey("dialog.id"), nullable=False,
+                       index=True)
+    user = Column(Text, nullable=False, default="")
+    assistant = Column(Text, nullable=False, default="")
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    # tokens of user + assistant, counted once when the turn is saved
+    token_count = Column(Integer, nullable=True, default=None)
+    dialog = relationship("Dialog", backref=backref("turns", lazy="dynamic"))
+
+    def to_dict(self):
+        return {
+            "user": self.user,
+            "assistant": self.assistant,
+            "date": self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "token_count": self.token_count,
+        }
 
 
 class AiModel(Base):
@@ -99,6 +135,23 @@ class AiModel(Base):
     ]
 
 
+class SchemaVersion(Base):
+    """One row per migration applied to the database"""
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(128), nullable=False, default="")
+    applied_at = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class ChatLease(Base):
+    """A worker handles the updates of the key (chat or user) until
+    expires_at (epoch seconds), the others wait for it"""
+    __tablename__ = "chat_lease"
+    key = Column(String(64), primary_key=True)
+    owner = Column(String(128), nullable=False)
+    expires_at = Column(Float, nullable=False)
+
+
 class Prompt(Base):
     __tablename__ = "prompt"
     id = Column(Integer, primary_key=True, autoincrement=True)
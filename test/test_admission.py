@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_admission.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the admission control of the ai providers
+
+import asyncio
+import unittest
+
+from ai.admission import AdmissionController, Overloaded, Ticket
+from ai.router import ProviderRouter, ProvidersBusy
+
+
+class SlowProvider:
+    def __init__(self, name):
+        self.name = name
+        self.running = 0
+        self.max_running = 0
+        self.release = asyncio.Event()
+
+    async def ask(self, message, dialog_messages=None, prompt=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+        finally:
+            self.running -= 1
+        return self.name
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limit_and_queue(self):
+        controller = AdmissionController(max_in_flight=2, max_queue=2)
+        await controller.acquire()
+        await controller.acquire()
+        tickets = [Ticket(), Ticket()]
+        waiting = [asyncio.create_task(controller.acquire(t))
+                   for t in tickets]
+        await asyncio.sleep(0)
+        self.assertListEqual([t.position for t in tickets], [1, 2])
+        # the queue is full: rejected at once
+        with self.assertRaises(Overloaded):
+            await controller.acquire()
+        self.assertEqual(controller.rejected, 1)
+
+        controller.release()
+        await waiting[0]
+        self.assertListEqual([t.position for t in tickets], [0, 1])
+        self.assertEqual(controller.in_flight, 2)
+        controller.release()
+        await waiting[1]
+        for _ in range(2):
+            controller.release()
+        self.assertEqual(controller.in_flight, 0)
+
+    async def test_cancel_while_waiting(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=5)
+        await controller.acquire()
+        first, second = Ticket(), Ticket()
+        gone = asyncio.create_task(controller.acquire(first))
+        staying = asyncio.create_task(controller.acquire(second))
+        await asyncio.sleep(0)
+        gone.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(second.position, 1)
+        controller.release()
+        await staying
+        self.assertEqual(controller.in_flight, 1)
+        self.assertEqual(controller.queued, 0)
+
+    async def test_router_limits_provider(self):
+        claude = SlowProvider('claude')
+        router = ProviderRouter({'claude': claude}, max_in_flight=2,
+                                max_queue=3)
+        asks = [asyncio.create_task(router.ask('claude', 'hi'))
+                for _ in range(5)]
+        await asyncio.sleep(0.01)
+        with self.assertRaises(ProvidersBusy):
+            await router.ask('claude', 'hi')
+        self.assertEqual(router.report()['claude']['queued'], 3)
+        claude.release.set()
+        self.assertListEqual(await asyncio.gather(*asks), ['claude'] * 5)
+        self.assertEqual(claude.max_running, 2)
+        # rejections are not errors of the provider
+        self.assertEqual(router.stats['claude'].error_rate, 0)
+
+    async def test_overflow_fails_over(self):
+        claude, palm = SlowProvider('claude'), SlowProvider('palm2')
+        palm.release.set()
+        router = ProviderRouter({'claude': claude, 'palm2': palm},
+                                fallbacks=['palm2'],
+                                max_in_flight={'claude': 1})
+        first = asyncio.create_task(router.ask('claude', 'hi'))
+        await asyncio.sleep(0)
+        self.assertEqual(await router.ask('claude', 'hi'), 'palm2')
+        claude.release.set()
+        self.assertEqual(await first, 'claude')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_aio.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test awaitable services
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database.aio import AsyncServices, AsyncDatabase, db_executor
+from database.model_view import UserServices, DialogServices, ModelServices, \
+    RoleServices
+from database.models import Base, User, DialogMessage
+
+
+class SlowServices:
+    _engine = None
+    name = 'slow'
+
+    def query(self, value):
+        time.sleep(0.2)
+        return value, threading.current_thread().name
+
+
+class TestAsyncServices(unittest.IsolatedAsyncioTestCase):
+
+    async def test_call_in_executor(self):
+        svc = AsyncServices(SlowServices(), db_executor())
+        self.assertEqual(svc.name, 'slow')
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        value, thread_name = await svc.query(1)
+        task.cancel()
+        self.assertEqual(value, 1)
+        self.assertTrue(thread_name.startswith('db'))
+        # the event loop kept running while the query blocked
+        self.assertGreater(ticks, 5)
+
+
+class TestUnitOfWork(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        fd, self.db_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.engine = create_engine(f'sqlite:///{self.db_file}')
+        Base.metadata.create_all(self.engine)
+        RoleServices(self.engine).init_roles()
+        models = ModelServices(self.engine)
+        models.add_new_model('ChatGpt', is_default=True)
+        self.db = AsyncDatabase(self.engine, db_executor(4))
+        self.user_db = self.db.services(UserServices(self.engine))
+        self.dialog_db = self.db.services(DialogServices(self.engine, models))
+        self.commits = 0
+
+        def count_commit(conn):
+            self.commits += 1
+
+        event.listen(self.engine, 'commit', count_commit)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        os.remove(self.db_file)
+
+    async def test_commit_once(self):
+        await self.user_db.add_new_user('uow_user', 1)
+        self.commits = 0
+
+        @self.db.transactional
+        async def handle():
+            await self.user_db.set_user_attribute('uow_user', 'username',
+                                                  'name')
+            await self.dialog_db.start_new_dialog('uow_user')
+            await self.dialog_db.append_dialog_message(
+                'uow_user', {'user': 'q', 'assistant': 'a'})
+            # the changes of the unit of work are seen before the commit
+            msgs = await self.dialog_db.get_dialog_messages('uow_user')
+            self.assertEqual(len(msgs), 1)
+            self.assertEqual(self.commits, 0)
+
+        await handle()
+        self.assertEqual(self.commits, 1)
+        session = sessionmaker(bind=self.engine)()
+        self.assertEqual(session.query(User).filter_by(
+            user_id='uow_user').first().username, 'name')
+        self.assertEqual(session.query(DialogMessage).count(), 1)
+        session.close()
+
+    async def test_rollback(self):
+        await self.user_db.add_new_user('uow_user', 1)
+
+        @self.db.transactional
+        async def handle():
+            await self.user_db.set_user_attribute('uow_user', 'username',
+                                                  'name')
+            await self.dialog_db.append_dialog_message(
+                'uow_user', {'user': 'q', 'assistant': 'a'})
+            raise ValueError('sth went wrong')
+
+        with self.assertRaises(ValueError):
+            await handle()
+        self.assertEqual(
+            await self.user_db.get_user_attribute('uow_user', 'username'), '')
+        self.assertListEqual(
+            await self.dialog_db.get_dialog_messages('uow_user'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_anthropic.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test claude token counting and context trimming
+
+import unittest
+
+from ai.anthropic_utils import AnthropicAIService
+from ai.context import ContextTooLong
+
+
+class TestAnthropicAIService(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.service = AnthropicAIService(api_key='key')
+        self.service.token_threshold = 0
+
+    def test_count_tokens(self):
+        count_tokens = self.service.count_tokens
+        self.assertGreater(count_tokens('hello world'), 0)
+        self.assertEqual(count_tokens(''), 0)
+        count_tokens('hello world')
+        self.assertEqual(count_tokens.cache_info().hits, 1)
+
+    def test_keep_latest_turns(self):
+        dialogs = [{'user': f'question {i}', 'assistant': f'answer {i}'}
+                   for i in range(10)]
+        count_tokens = self.service.count_tokens
+        turn = count_tokens('question 1') + count_tokens('answer 1')
+        self.service.max_tokens = turn * 3
+        self.assertListEqual(self.service.solve_context_limit(dialogs),
+                             dialogs[-3:])
+        # the message sent takes from the budget too
+        message = 'question 10 ' * 5
+        self.service.max_tokens = turn * 3 + count_tokens(message)
+        self.assertListEqual(
+            self.service.solve_context_limit(dialogs, message), dialogs[-3:])
+        self.service.max_tokens = turn * 3 + count_tokens(message) - 1
+        self.assertListEqual(
+            self.service.solve_context_limit(dialogs, message), dialogs[-2:])
+        self.service.max_tokens = count_tokens(message) - 1
+        with self.assertRaises(ContextTooLong):
+            self.service.solve_context_limit(dialogs, message)
+        self.service.max_tokens = 100000
+        self.assertListEqual(self.service.solve_context_limit(dialogs),
+                             dialogs)
+        self.assertListEqual(self.service.solve_context_limit([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_azure.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test azure openai service against a local stub server
+
+import asyncio
+import json
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ai.azure_utils import OpenAIService
+from ai.context import ContextTooLong
+from ai.http import async_http_client
+
+
+def completion(content: str) -> dict:
+    return {'id': 'chatcmpl', 'object': 'chat.completion', 'created': 0,
+            'model': 'gpt-35-turbo-16k',
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant',
+                                     'content': content}}]}
+
+
+def completion_chunk(content: str) -> dict:
+    return {'id': 'chatcmpl', 'object': 'chat.completion.chunk',
+            'created': 0, 'model': 'gpt-35-turbo-16k',
+            'choices': [{'index': 0, 'finish_reason': None,
+                         'delta': {'content': content}}]}
+
+
+class StubOpenAI:
+    """answers every chat completion after `delay` seconds"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self.app = web.Application()
+        self.app.router.add_post(
+            '/openai/deployments/{model}/chat/completions', self.handle)
+
+    async def handle(self, request):
+        body = await request.json()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if not body.get('stream'):
+                await asyncio.sleep(self.delay)
+                return web.json_response(completion('pong'))
+            response = web.StreamResponse(
+                headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            for piece in ['po', 'n', 'g']:
+                await asyncio.sleep(self.delay / 3)
+                await response.write(
+                    f'data: {json.dumps(completion_chunk(piece))}\n\n'.encode())
+            await response.write(b'data: [DONE]\n\n')
+            return response
+        finally:
+            self.running -= 1
+
+
+class TestOpenAIService(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self) -> None:
+        self.stub = StubOpenAI(delay=0.5)
+        self.server = TestServer(self.stub.app, host='127.0.0.1')
+        await self.server.start_server()
+        self.http_client = async_http_client(timeout=5, max_connections=10)
+        self.service = OpenAIService(
+            model_name='gpt-35-turbo-16k', api_type='azure',
+            endpoint=str(self.server.make_url('')), api_key='key',
+            api_version='2023-05-15', http_client=self.http_client)
+        # tiktoken downloads its encodings, not needed here
+        self.service.count_tokens = len
+
+    async def asyncTearDown(self) -> None:
+        await self.http_client.aclose()
+        await self.server.close()
+
+    async def test_send_message(self):
+        self.assertEqual(await self.service.send_message('ping', [], 'p'),
+                         'pong')
+
+    async def test_trim_context(self):
+        counted = []
+
+        def count(text):
+            counted.append(text)
+            return len(text)
+
+        self.service.count_tokens = count
+        self.service.max_token = 200 + 4 + 25
+        turns = [{'user': f'q{i}', 'assistant': f'a{i}', 'token_count': 10}
+                 for i in range(5)]
+        turns[-1]['token_count'] = None
+        messages = self.service._generate_msg('ping', turns, 'p')
+        # 25 tokens left: the last turn (4 counted) and 2 turns of 10
+        self.assertListEqual([m['content'] for m in messages],
+                             ['q2', 'a2', 'q3', 'a3', 'q4', 'a4', 'ping'])
+        # only the message and the turn saved without count are counted
+        self.assertListEqual(sorted(counted), ['a4', 'ping', 'q4'])
+
+    async def test_prompt_budget(self):
+        # the system prompt of a new dialog counts in the budget
+        self.service.max_token = 200 + 10
+        messages = self.service._generate_msg('ping', [], 'prompt')
+        self.assertListEqual([m['content'] for m in messages],
+                             ['prompt', 'ping'])
+        with self.assertRaises(ContextTooLong):
+            self.service._generate_msg('ping', [], 'long prompt')
+        self.assertEqual(await self.service.send_message(
+            'ping', [], 'long prompt'),
+            "Token exceed limit, please short your message")
+        self.assertEqual(self.stub.max_running, 0)
+
+    async def test_requests_overlap(self):
+        start = time.perf_counter()
+        answers = await asyncio.gather(*[
+            self.service.send_message(f'ping {i}', [], 'p') for i in range(5)])
+        elapsed = time.perf_counter() - start
+        self.assertListEqual(answers, ['pong'] * 5)
+        self.assertEqual(self.stub.max_running, 5)
+        # 5 requests of 0.5s each, sent at once
+        self.assertLess(elapsed, 1.5)
+
+    async def test_stream(self):
+        pieces = [p async for p in self.service.send_message_stream(
+            'ping', [], 'p')]
+        self.assertListEqual(pieces, ['po', 'n', 'g'])
+
+    async def test_timeout(self):
+        self.stub.delay = 2
+        http_client = async_http_client(timeout=0.2)
+        self.addAsyncCleanup(http_client.aclose)
+        service = OpenAIService(
+            model_name='gpt-35-turbo-16k', api_type='azure',
+            endpoint=str(self.server.make_url('')), api_key='key',
+            api_version='2023-05-15', http_client=http_client)
+        service.count_tokens = len
+        service.azure_client.max_retries = 0
+        start = time.perf_counter()
+        self.assertEqual(await service.send_message('ping', [], 'p'),
+                         'sth went wrong')
+        self.assertLess(time.perf_counter() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_cache.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the response cache
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ai.cache import ResponseCache
+from database.aio import db_executor
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResponseCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.clock = Clock()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'cache.sqlite')
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_key(self):
+        key = ResponseCache.key('Claude', 'assistant', 'be nice', 'hi  there',
+                                [{'user': 'q', 'assistant': 'a'}])
+        self.assertEqual(key, ResponseCache.key(
+            'claude', 'assistant', 'be nice', ' hi there\n',
+            [{'user': 'q ', 'assistant': 'a'}]))
+        self.assertNotEqual(key, ResponseCache.key(
+            'claude', 'assistant', 'be nice', 'hi there',
+            [{'user': 'q', 'assistant': 'b'}]))
+        self.assertNotEqual(key, ResponseCache.key(
+            'claude', 'code_assistant', 'be nice', 'hi there',
+            [{'user': 'q', 'assistant': 'a'}]))
+
+    async def test_memory(self):
+        cache = ResponseCache(maxsize=2, ttl=10, clock=self.clock)
+        self.assertIsNone(await cache.get('k1'))
+        await cache.set('k1', 'a1')
+        await cache.set('k2', 'a2', ttl=100)
+        self.assertEqual(await cache.get('k1'), 'a1')
+        # k2 is the least recently used
+        await cache.set('k3', 'a3', ttl=100)
+        self.assertIsNone(await cache.get('k2'))
+        self.clock.now += 11
+        self.assertIsNone(await cache.get('k1'))
+        self.assertEqual(await cache.get('k3'), 'a3')
+        self.assertEqual(cache.report()['memory_hits'], 2)
+        self.assertEqual(cache.hit_rate, 0.4)
+
+    async def test_sqlite_tier(self):
+        cache = ResponseCache(maxsize=10, ttl=10, db_path=self.db_path,
+                              clock=self.clock)
+        await cache.set('k1', 'a1')
+        # a new process finds it on disk
+        cache = ResponseCache(maxsize=10, ttl=10, db_path=self.db_path,
+                              clock=self.clock)
+        self.assertEqual(await cache.get('k1'), 'a1')
+        self.assertEqual(await cache.get('k1'), 'a1')
+        self.assertEqual(cache.db_hits, 1)
+        self.assertEqual(cache.memory_hits, 1)
+        self.clock.now += 11
+        cache = ResponseCache(maxsize=10, ttl=10, db_path=self.db_path,
+                              clock=self.clock)
+        self.assertIsNone(await cache.get('k1'))
+
+    async def test_shared_db(self):
+        # two workers on the same database url
+        url = f'sqlite:///{self.db_path}'
+        worker1 = ResponseCache(maxsize=10, ttl=10, db_path=url,
+                                clock=self.clock)
+        worker2 = ResponseCache(maxsize=10, ttl=10, db_path=url,
+                                clock=self.clock)
+        await worker1.set('k1', 'a1')
+        self.assertEqual(await worker2.get('k1'), 'a1')
+        # the newer answer replaces the one in the database
+        await worker2.set('k1', 'a2', ttl=100)
+        self.clock.now += 11
+        self.assertEqual(await worker1.get('k1'), 'a2')
+        self.assertEqual(worker1.db_hits, 1)
+
+
+    async def test_db_executor(self):
+        # the database io runs in the executor given, the db one of the bot
+        executor = db_executor(1)
+        self.addCleanup(executor.shutdown)
+        cache = ResponseCache(maxsize=10, ttl=10, db_path=self.db_path,
+                              executor=executor, clock=self.clock)
+        threads = []
+        db_get = cache._db_get
+
+        def record(key):
+            threads.append(threading.current_thread().name)
+            return db_get(key)
+
+        with mock.patch.object(cache, '_db_get', record):
+            self.assertIsNone(await cache.get('k1'))
+        self.assertTrue(threads[0].startswith('db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_cloudflare.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test cloudflare workers ai service against a local stub server
+
+import asyncio
+import json
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ai.cloudflare_utils import CloudflareAIService
+from ai.http import async_http_client
+
+
+class StubWorkersAI:
+    """answers after `delay` seconds, remembers the client ports to tell
+    the connections apart"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self.ports = set()
+        self.app = web.Application()
+        self.app.router.add_post('/run/{model:.+}', self.handle)
+
+    async def handle(self, request):
+        body = await request.json()
+        self.ports.add(request.transport.get_extra_info('peername')[1])
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if not body.get('stream'):
+                await asyncio.sleep(self.delay)
+                return web.json_response(
+                    {'result': {'response': 'pong'}, 'success': True,
+                     'errors': [], 'messages': []})
+            response = web.StreamResponse(
+                headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            for piece in ['po', 'n', 'g']:
+                await asyncio.sleep(self.delay / 3)
+                await response.write(
+                    f'data: {json.dumps({"response": piece})}\n\n'.encode())
+            await response.write(b'data: [DONE]\n\n')
+            return response
+        finally:
+            self.running -= 1
+
+
+class TestCloudflareAIService(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self) -> None:
+        self.stub = StubWorkersAI(delay=0.3)
+        self.server = TestServer(self.stub.app, host='127.0.0.1')
+        await self.server.start_server()
+        self.http_client = async_http_client(timeout=5, max_connections=10)
+        self.service = CloudflareAIService(
+            token='Bearer token', account_id='account',
+            model_name='@cf/meta/llama-2-7b-chat-int8',
+            base_url=str(self.server.make_url('/run/')),
+            http_client=self.http_client)
+
+    async def asyncTearDown(self) -> None:
+        await self.http_client.aclose()
+        await self.server.close()
+
+    async def test_send_message(self):
+        self.assertEqual(await self.service.send_message('ping'), 'pong')
+
+    async def test_requests_overlap(self):
+        start = time.perf_counter()
+        answers = await asyncio.gather(
+            *[self.service.send_message(f'ping {i}') for i in range(5)])
+        self.assertListEqual(answers, ['pong'] * 5)
+        self.assertEqual(self.stub.max_running, 5)
+        self.assertLess(time.perf_counter() - start, 0.9)
+
+    async def test_keep_alive(self):
+        for i in range(3):
+            await self.service.send_message(f'ping {i}')
+        # one connection for the requests sent one after another
+        self.assertEqual(len(self.stub.ports), 1)
+
+    async def test_stream(self):
+        pieces = [p async for p in self.service.send_message_stream('ping')]
+        self.assertListEqual(pieces, ['po', 'n', 'g'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_context.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the context window, the properties are checked on
+# random dialogs
+
+import random
+import unittest
+
+from ai.context import newest_window, window_start
+
+
+def random_dialog(rng: random.Random):
+    n = rng.randint(0, 60)
+    turns = [{'user': f'q{i}', 'assistant': f'a{i}'} for i in range(n)]
+    counts = [rng.choice([0, rng.randint(1, 50), rng.randint(50, 500)])
+              for _ in range(n)]
+    return turns, counts
+
+
+class TestContextWindow(unittest.TestCase):
+    runs = 2000
+
+    def test_properties(self):
+        rng = random.Random(20261018)
+        for _ in range(self.runs):
+            turns, counts = random_dialog(rng)
+            budget = rng.randint(-10, 3000)
+            prompt_tokens = rng.randint(0, 200)
+            window = newest_window(turns, counts, budget, prompt_tokens)
+            start = len(turns) - len(window)
+            case = (counts, budget, prompt_tokens)
+            # the newest turns
+            self.assertListEqual(window, turns[start:], case)
+            # which fit
+            if window:
+                self.assertLessEqual(sum(counts[start:]) + prompt_tokens,
+                                     budget, case)
+            # and one more turn doesn't
+            if start > 0:
+                self.assertGreater(sum(counts[start - 1:]) + prompt_tokens,
+                                   budget, case)
+
+    def test_count_function(self):
+        rng = random.Random(18)
+        for _ in range(self.runs // 10):
+            turns, counts = random_dialog(rng)
+            budget = rng.randint(0, 3000)
+            looked_at = []
+
+            def count(turn):
+                looked_at.append(turn)
+                return counts[turns.index(turn)]
+
+            window = newest_window(turns, count, budget)
+            self.assertListEqual(window, newest_window(turns, counts, budget))
+            # only the window and the turn before it are counted
+            self.assertLessEqual(len(looked_at), len(window) + 1)
+
+    def test_edges(self):
+        self.assertEqual(window_start([], 0, 100), 0)
+        self.assertEqual(window_start([10, 10], 2, 20), 0)
+        self.assertEqual(window_start([10, 10], 2, 19), 1)
+        self.assertEqual(window_start([10, 30], 2, 20), 2)
+        turns = [{'user': 'q', 'assistant': 'a'}]
+        self.assertListEqual(newest_window(turns, [5], 10, 6), [])
+        self.assertListEqual(newest_window(turns, [5], 10, 5), turns)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,8 +13,8 @@ import unittest
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from database.model_view import DialogServices
-from database.models import Base, User, AiModel
+from database.model_view import DialogServices, UserServices, UnitOfWork
+from database.models import Base, User, AiModel, Dialog, DialogMessage
 
 engine = create_engine('sqlite:///./test.sqlite')
 Base.metadata.drop_all(engine)
@@ -53,6 +53,115 @@ class TestDialogServices(unittest.TestCase):
         result = self.dialog_svc.get_dialog_messages('user1', dialog_id)
         self.assertListEqual(result, msgs)
 
+    def test_append_dialog_message(self):
+        self.dialog_svc.start_new_dialog('user1')
+        for i in range(3):
+            self.dialog_svc.append_dialog_message(
+                'user1', {'user': f'q{i}', 'assistant': f'a{i}'})
+        result = self.dialog_svc.get_dialog_messages('user1')
+        self.assertListEqual([m['user'] for m in result], ['q0', 'q1', 'q2'])
+
+        result = self.dialog_svc.get_dialog_messages('user1', limit=2)
+        self.assertListEqual([m['assistant'] for m in result], ['a1', 'a2'])
+
+    def test_token_count(self):
+        dialog_svc = DialogServices(
+            engine, token_counter=lambda user, assistant: len(user + assistant))
+        dialog_svc.start_new_dialog('user1')
+        dialog_svc.append_dialog_message('user1',
+                                         {'user': 'q', 'assistant': 'abc'})
+        result = dialog_svc.get_dialog_messages('user1')
+        self.assertEqual(result[-1]['token_count'], 4)
+        # not counted without a counter
+        self.dialog_svc.append_dialog_message('user1',
+                                              {'user': 'q', 'assistant': 'a'})
+        result = self.dialog_svc.get_dialog_messages('user1')
+        self.assertIsNone(result[-1]['token_count'])
+
+    def test_dialog_summary(self):
+        self.dialog_svc.start_new_dialog('user1')
+        self.assertIsNone(self.dialog_svc.get_turns_to_summarize('user1'))
+        for i in range(5):
+            self.dialog_svc.append_dialog_message(
+                'user1', {'user': f'q{i}', 'assistant': f'a{i}'})
+        self.assertEqual(
+            self.dialog_svc.count_turns_to_summarize('user1'), 5)
+        todo = self.dialog_svc.get_turns_to_summarize('user1', keep=2)
+        self.assertIsNone(todo['summary'])
+        self.assertListEqual([t['user'] for t in todo['turns']],
+                             ['q0', 'q1', 'q2'])
+        self.dialog_svc.set_dialog_summary(todo['dialog_id'], 'q0 to q2',
+                                           todo['until'])
+        self.assertEqual(self.dialog_svc.get_dialog_summary('user1'),
+                         'q0 to q2')
+        result = self.dialog_svc.get_dialog_messages('user1',
+                                                     since_summary=True)
+        self.assertListEqual([m['user'] for m in result], ['q3', 'q4'])
+        self.assertEqual(
+            self.dialog_svc.count_turns_to_summarize('user1'), 2)
+        # all turns still there
+        self.assertEqual(
+            len(self.dialog_svc.get_dialog_messages('user1')), 5)
+        # the kept turns are summarized next time
+        self.assertIsNone(self.dialog_svc.get_turns_to_summarize(
+            'user1', keep=2))
+        todo = self.dialog_svc.get_turns_to_summarize('user1')
+        self.assertEqual(todo['summary'], 'q0 to q2')
+        self.assertListEqual([t['user'] for t in todo['turns']],
+                             ['q3', 'q4'])
+
+    def test_current_dialog_cached(self):
+        # the cached user follows the dialog the turns are written to
+        user_svc = UserServices(engine)
+        dialog_svc = DialogServices(engine, user_db=user_svc)
+
+        def db_current_dialog():
+            self.session.expire_all()
+            return self.session.query(User).filter_by(
+                user_id='user1').first().current_dialog_id
+
+        user_svc.get_user_by_user_id('user1')
+        dialog_svc.start_new_dialog('user1')
+        first = db_current_dialog()
+        self.assertIsNotNone(first)
+        self.assertEqual(
+            user_svc.get_user_by_user_id('user1').current_dialog_id, first)
+        with UnitOfWork(engine):
+            dialog_svc.start_new_dialog('user1')
+            dialog_svc.append_dialog_message('user1',
+                                             {'user': 'q', 'assistant': 'a'})
+        user = user_svc.get_user_by_user_id('user1')
+        self.assertNotEqual(user.current_dialog_id, first)
+        self.assertEqual(user.current_dialog_id, db_current_dialog())
+        self.assertEqual(user.username, 'dialog_user')
+        messages = dialog_svc.get_dialog_messages(
+            'user1', dialog_id=user.current_dialog_id)
+        self.assertListEqual([m['user'] for m in messages], ['q'])
+
+    def test_pop_dialog_message(self):
+        self.dialog_svc.start_new_dialog('user1')
+        self.assertIsNone(self.dialog_svc.pop_dialog_message('user1'))
+        self.dialog_svc.append_dialog_message('user1',
+                                              {'user': 'q', 'assistant': 'a'})
+        last = self.dialog_svc.pop_dialog_message('user1')
+        self.assertEqual(last['user'], 'q')
+        self.assertListEqual(self.dialog_svc.get_dialog_messages('user1'), [])
+
+    def test_migrate_json_messages(self):
+        msgs = [{'user': 'q1', 'assistant': 'a1', 'date': ''},
+                {'user': 'q2', 'assistant': 'a2', 'date': ''}]
+        self.session.add(Dialog(dialog_id='json-dialog', user_id='user_json',
+                                messages=msgs, ai_model_id=1))
+        self.session.commit()
+
+        self.dialog_svc.migrate_json_messages()
+        result = self.dialog_svc.get_dialog_messages('user_json')
+        self.assertListEqual([m['user'] for m in result], ['q1', 'q2'])
+        # run again should not duplicate the turns
+        self.dialog_svc.migrate_json_messages()
+        self.assertEqual(self.session.query(DialogMessage).join(Dialog).filter(
+            Dialog.dialog_id == 'json-dialog').count(), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
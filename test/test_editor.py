@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_editor.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the edits of a streamed reply
+
+import asyncio
+import unittest
+
+from telegram.error import RetryAfter
+
+from bot.editor import StreamEditor
+
+
+class FakeBot:
+
+    def __init__(self, retry_after: int = 0):
+        self.edits = []
+        self.retry_after = retry_after
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        await asyncio.sleep(0.01)
+        if self.retry_after:
+            retry_after, self.retry_after = self.retry_after, 0
+            raise RetryAfter(retry_after)
+        self.edits.append((asyncio.get_running_loop().time(), text))
+
+
+class TestStreamEditor(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        StreamEditor._chats.clear()
+
+    async def stream(self, editor, pieces=50, delay=0.01):
+        text = 'a'
+        for i in range(pieces):
+            text += str(i % 10)
+            editor.update(text)
+            await asyncio.sleep(delay)
+        await editor.finish(text)
+        return text
+
+    async def test_coalesce(self):
+        bot = FakeBot()
+        editor = StreamEditor(bot, 1, 1, shown='a', min_interval=0.1)
+        text = await self.stream(editor)
+        # ~0.5s of pieces, one edit every 0.1s instead of 50
+        self.assertLessEqual(len(bot.edits), 7)
+        self.assertEqual(bot.edits[-1][1], text)
+        # the final text is sent once
+        self.assertEqual([t for _, t in bot.edits].count(text), 1)
+        times = [t for t, _ in bot.edits]
+        for prev, cur in zip(times, times[1:]):
+            self.assertGreaterEqual(cur - prev, 0.09)
+
+    async def test_nothing_new(self):
+        bot = FakeBot()
+        editor = StreamEditor(bot, 1, 1, shown='answer', min_interval=0.1)
+        await editor.finish('answer')
+        self.assertListEqual(bot.edits, [])
+
+    async def test_retry_after(self):
+        bot = FakeBot(retry_after=1)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        editor = StreamEditor(bot, 2, 1, shown='a', min_interval=0.05)
+        text = await self.stream(editor, pieces=20)
+        # nothing is edited before telegram allows it
+        self.assertGreaterEqual(bot.edits[0][0] - start, 1)
+        self.assertEqual(bot.edits[-1][1], text)
+        self.assertEqual(len(bot.edits), 1)
+        # the chat goes on at a slower pace
+        self.assertGreater(StreamEditor._chats[2].interval, 0.05)
+
+    async def test_shared_by_chat(self):
+        bot = FakeBot()
+        first = StreamEditor(bot, 3, 1, shown='a', min_interval=0.1)
+        second = StreamEditor(bot, 3, 2, shown='a', min_interval=0.1)
+        self.assertIs(first.rate, second.rate)
+        await asyncio.gather(self.stream(first, 20), self.stream(second, 20))
+        times = sorted(t for t, _ in bot.edits)
+        for prev, cur in zip(times, times[1:]):
+            self.assertGreaterEqual(cur - prev, 0.09)
+
+
+if __name__ == '__main__':
+    unittest.main()
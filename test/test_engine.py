@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_engine.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test engine factory
+
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import text
+
+from database.engine import create_db_engine
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self) -> None:
+        fd, self.db_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self) -> None:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.db_file + suffix):
+                os.remove(self.db_file + suffix)
+
+    def pragma(self, engine, name):
+        with engine.connect() as conn:
+            return conn.execute(text(f'PRAGMA {name}')).scalar()
+
+    def test_default_pragmas(self):
+        engine = create_db_engine(f'sqlite:///{self.db_file}')
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(engine, 'synchronous'), 1)  # NORMAL
+        self.assertEqual(self.pragma(engine, 'busy_timeout'), 5000)
+        engine.dispose()
+
+    def test_custom_pragmas(self):
+        engine = create_db_engine(f'sqlite:///{self.db_file}',
+                                  pragmas={'busy_timeout': 100})
+        self.assertEqual(self.pragma(engine, 'busy_timeout'), 100)
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'delete')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
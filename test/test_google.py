@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_google.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the palm service on fake async clients
+
+import asyncio
+import unittest
+from unittest import mock
+
+import google.ai.generativelanguage_v1beta2 as glm
+
+from ai.context import ContextTooLong
+from ai.google_utils import GoogleAIService
+
+
+class FakeDiscussClient:
+    """answers after `delay` seconds, counts a token per character"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.count_calls = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def count_message_tokens(self, model=None, prompt=None):
+        self.count_calls += 1
+        self.last_context = prompt.context
+        tokens = len(prompt.context) + sum(len(m.content)
+                                           for m in prompt.messages)
+        return glm.CountMessageTokensResponse(token_count=tokens)
+
+    async def generate_message(self, request=None, **kwargs):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        messages = list(request.prompt.messages)
+        return glm.GenerateMessageResponse(
+            candidates=[glm.Message(author='1', content='pong')],
+            messages=messages)
+
+
+class FakeTextClient:
+    async def generate_text(self, model=None, prompt=None):
+        return glm.GenerateTextResponse(
+            candidates=[glm.TextCompletion(output=f'translated {prompt.text}')])
+
+
+class TestGoogleAIService(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.client = FakeDiscussClient(delay=0.2)
+        self.service = GoogleAIService('key', discuss_client=self.client,
+                                       text_client=FakeTextClient())
+        # tiktoken downloads its encodings, count characters offline
+        patcher = mock.patch('ai.google_utils.count_tokens', len)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dialogs = [{'user': f'q{i}', 'assistant': f'a{i}',
+                         'token_count': 4} for i in range(5)]
+
+    async def test_ask(self):
+        answer = await self.service.ask('ping', self.dialogs)
+        self.assertEqual(answer, 'pong')
+        # the tokens are counted once per request
+        self.assertEqual(self.client.count_calls, 1)
+
+    async def test_not_blocking(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        answers = await asyncio.gather(
+            *[self.service.ask('ping') for _ in range(5)])
+        self.assertListEqual(answers, ['pong'] * 5)
+        # the requests run at once, not one after the other
+        self.assertLess(loop.time() - start, 0.6)
+        self.assertEqual(self.client.max_running, 5)
+
+    async def test_token_limit(self):
+        self.service.max_token = 10
+        # an error, not an answer
+        with self.assertRaises(ContextTooLong):
+            await self.service.ask('a long question')
+        self.assertEqual(await self.service.send_message('a long question'),
+                         "Token exceed limit, please short your message")
+        self.assertEqual(self.client.max_running, 0)
+
+    async def test_trim_on_count(self):
+        # the stored counts are short, the turns are trimmed again on the
+        # count of palm
+        self.service.max_token = 400
+        dialogs = [{'user': f'q{i}', 'assistant': 'a' * 100,
+                    'token_count': 4} for i in range(5)]
+        self.assertEqual(await self.service.ask('ping', dialogs), 'pong')
+        self.assertEqual(self.client.count_calls, 2)
+        # two turns and the message
+        self.assertEqual(self.client.last_context.count('User said'), 3)
+
+    async def test_translate(self):
+        self.assertTrue((await self.service.en2zh('hi')).startswith(
+            'translated'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_migrations.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test schema migrations and dialog indexes
+
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from sqlalchemy import create_engine, desc, inspect, text, event
+from sqlalchemy.orm import Session
+
+from database import migrations
+from database.migrations import upgrade, stamp, current_version, \
+    applied_versions, Migration
+from database.models import Base, Dialog, AiModel
+
+
+def query_plan(session, query) -> list:
+    sql = query.statement.compile(session.bind,
+                                  compile_kwargs={'literal_binds': True})
+    rows = session.execute(text(f'EXPLAIN QUERY PLAN {sql}')).all()
+    return [row[-1] for row in rows]
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self) -> None:
+        fd, self.db_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.engine = create_engine(f'sqlite:///{self.db_file}')
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        os.remove(self.db_file)
+
+    def make_old_db(self):
+        """the schema before the migrations were versioned"""
+        with self.engine.begin() as conn:
+            for index in Dialog.__table__.indexes:
+                index.drop(conn)
+            conn.execute(text('DROP TABLE dialog_message'))
+            conn.execute(text('DROP TABLE schema_version'))
+            conn.execute(text(
+                "INSERT INTO dialog (dialog_id, user_id, chat_mode, "
+                "start_time, messages) VALUES ('d1', 1, 'assistant', "
+                "'2023-10-18 00:00:00.000000', "
+                "'[{\"user\": \"q\", \"assistant\": \"a\"}]')"))
+
+    def index_names(self) -> set:
+        return {i['name'] for i in inspect(self.engine).get_indexes('dialog')}
+
+    def test_upgrade(self):
+        self.make_old_db()
+        self.assertListEqual(upgrade(self.engine), [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertIn('ix_dialog_user_id_ai_model_id_id', self.index_names())
+        self.assertIn('ix_dialog_user_id_start_time', self.index_names())
+        with self.engine.connect() as conn:
+            self.assertEqual(current_version(conn), 8)
+            self.assertSetEqual(applied_versions(conn), {1, 2, 3, 4, 5, 6, 7, 8})
+            self.assertEqual(conn.execute(text(
+                'SELECT COUNT(*) FROM dialog_message')).scalar(), 1)
+        # nothing left to apply
+        self.assertListEqual(upgrade(self.engine), [])
+
+    def test_dry_run(self):
+        self.make_old_db()
+        self.assertListEqual(upgrade(self.engine, dry_run=True),
+                             [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertSetEqual(self.index_names(), set())
+        self.assertFalse(inspect(self.engine).has_table('dialog_message'))
+        self.assertFalse(inspect(self.engine).has_table('schema_version'))
+
+    def test_dry_run_without_transactional_ddl(self):
+        # the steps are not run, their DDL would not be rolled back
+        self.make_old_db()
+        migrations.TRANSACTIONAL_DDL.discard('sqlite')
+        try:
+            self.assertListEqual(upgrade(self.engine, dry_run=True),
+                                 [1, 2, 3, 4, 5, 6, 7, 8])
+        finally:
+            migrations.TRANSACTIONAL_DDL.add('sqlite')
+        self.assertFalse(inspect(self.engine).has_table('dialog_message'))
+        self.assertFalse(inspect(self.engine).has_table('schema_version'))
+        upgrade(self.engine)
+        migrations.TRANSACTIONAL_DDL.discard('sqlite')
+        try:
+            self.assertListEqual(upgrade(self.engine, dry_run=True), [])
+        finally:
+            migrations.TRANSACTIONAL_DDL.add('sqlite')
+
+    def test_single_transaction(self):
+        self.make_old_db()
+
+        def broken(conn):
+            raise RuntimeError('broken migration')
+
+        migrations.MIGRATIONS.append(Migration(99, 'broken', broken, False))
+        try:
+            with self.assertRaises(RuntimeError):
+                upgrade(self.engine)
+        finally:
+            migrations.MIGRATIONS.pop()
+        # the steps before the broken one are rolled back too
+        self.assertSetEqual(self.index_names(), set())
+        self.assertFalse(inspect(self.engine).has_table('dialog_message'))
+
+    def test_data_migration_batches(self):
+        self.make_old_db()
+        with self.engine.begin() as conn:
+            for i in range(2, 8):
+                conn.execute(text(
+                    f"INSERT INTO dialog (dialog_id, user_id, chat_mode, "
+                    f"start_time, messages) VALUES ('d{i}', {i}, 'assistant',"
+                    f" '2023-10-18 00:00:00.000000', "
+                    f"'[{{\"user\": \"q\", \"assistant\": \"a\"}}]')"))
+        commits = []
+        event.listen(self.engine, 'commit', lambda conn: commits.append(1))
+        upgrade(self.engine, batch_size=2)
+        # 1 schema transaction, 7 dialogs in 4 batches + the empty one
+        self.assertEqual(len(commits), 6)
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute(text(
+                'SELECT COUNT(*) FROM dialog_message')).scalar(), 7)
+            self.assertEqual(conn.execute(text(
+                "SELECT COUNT(*) FROM dialog WHERE messages != '[]'"
+            )).scalar(), 0)
+
+    def test_stamp(self):
+        stamp(self.engine)
+        self.assertListEqual(upgrade(self.engine), [])
+
+    def test_dialog_query_plan(self):
+        session = Session(self.engine)
+        session.add(AiModel(name='ChatGpt'))
+        session.add_all([Dialog(dialog_id=f'd{i}', user_id=i % 10,
+                                start_time=datetime.now(), messages=[],
+                                ai_model_id=1) for i in range(100)])
+        session.commit()
+
+        queries = [
+            # _get_dialog
+            session.query(Dialog).filter_by(
+                user_id='3', ai_model_id=1).order_by(desc(Dialog.id)),
+            # get_real_dialog_id
+            session.query(Dialog).filter_by(user_id='3').order_by(
+                Dialog.start_time.desc()),
+            session.query(Dialog).filter_by(user_id='3').order_by(
+                Dialog.start_time.asc()),
+        ]
+        for query in queries:
+            plan = query_plan(session, query)
+            self.assertFalse(any(p.startswith('SCAN') for p in plan), plan)
+            self.assertFalse(any('TEMP B-TREE' in p for p in plan), plan)
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
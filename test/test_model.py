@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_model.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test ai model snapshot
+
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.model_view import ModelServices
+from database.models import Base, AiModel
+
+engine = create_engine('sqlite://')
+Base.metadata.create_all(engine)
+
+
+class TestModelServices(unittest.TestCase):
+
+    def setUp(self) -> None:
+        session = sessionmaker(bind=engine)
+        self.session = session()
+        self.session.query(AiModel).delete()
+        self.session.commit()
+        self.model_svc = ModelServices(engine)
+        self.model_svc.add_new_model('ChatGpt', is_default=True)
+        self.model_svc.add_new_model('Claude')
+
+    def tearDown(self) -> None:
+        self.session.close()
+
+    def test_snapshot(self):
+        self.assertEqual(self.model_svc.get_default_model().name, 'ChatGpt')
+        self.assertListEqual(self.model_svc.get_available_models(),
+                             ['ChatGpt', 'Claude'])
+        # changes not made by the service are not seen until refresh
+        self.session.query(AiModel).filter_by(name='Claude').delete()
+        self.session.commit()
+        self.assertIsNotNone(self.model_svc.get_model('Claude'))
+        self.model_svc.refresh()
+        self.assertIsNone(self.model_svc.get_model('Claude'))
+
+    def test_snapshot_ttl(self):
+        # another worker deletes the model, seen once the snapshot expires
+        now = [0.0]
+        model_svc = ModelServices(engine, ttl=5, clock=lambda: now[0])
+        self.assertIsNotNone(model_svc.get_model('Claude'))
+        self.model_svc.del_model('Claude')
+        now[0] += 4
+        self.assertIsNotNone(model_svc.get_model('Claude'))
+        now[0] += 1
+        self.assertIsNone(model_svc.get_model('Claude'))
+
+    def test_update_model(self):
+        self.model_svc.update_model('ChatGpt', is_default=False)
+        self.model_svc.update_model('Claude', is_default=True)
+        self.assertEqual(self.model_svc.get_default_model().name, 'Claude')
+
+        self.model_svc.del_model('ChatGpt')
+        self.assertListEqual([m.name for m in self.model_svc.list_all_model()],
+                             ['Claude'])
+
+
+if __name__ == '__main__':
+    unittest.main()
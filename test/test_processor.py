@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_processor.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the concurrent update processing, in order per chat
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from telegram import Update
+
+from bot.processor import ChatUpdateProcessor, KeyedLocks
+from database.aio import AsyncServices, db_executor
+from database.model_view import LeaseServices
+from database.models import ChatLease
+
+
+def message_update(update_id: int, chat_id: int, user_id: int) -> Update:
+    return Update.de_json(
+        {'update_id': update_id,
+         'message': {'message_id': update_id, 'date': 0, 'text': 'hi',
+                     'chat': {'id': chat_id, 'type': 'group'},
+                     'from': {'id': user_id, 'is_bot': False,
+                              'first_name': 'user'}}}, None)
+
+
+class TestChatUpdateProcessor(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.processor = ChatUpdateProcessor(max_concurrent_updates=10)
+        self.log = []
+        self.running = 0
+        self.max_running = 0
+
+    async def handle(self, name, delay):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.log.append(f'start {name}')
+        await asyncio.sleep(delay)
+        self.log.append(f'end {name}')
+        self.running -= 1
+
+    def process(self, update, name, delay):
+        return asyncio.create_task(self.processor.process_update(
+            update, self.handle(name, delay)))
+
+    async def test_chats_run_concurrently(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*[
+            self.process(message_update(i, chat_id=i, user_id=i), i, 0.1)
+            for i in range(5)])
+        self.assertLess(loop.time() - start, 0.3)
+        self.assertEqual(self.max_running, 5)
+
+    async def test_same_chat_in_order(self):
+        # the first one is the slowest, the next ones wait for it
+        tasks = [self.process(message_update(i, chat_id=1, user_id=i), i,
+                              0.05 - i * 0.01) for i in range(4)]
+        await asyncio.gather(*tasks)
+        self.assertListEqual(self.log, [f'{e} {i}' for i in range(4)
+                                        for e in ('start', 'end')])
+        self.assertEqual(len(self.processor.locks), 0)
+
+    async def test_same_user_in_other_chats(self):
+        # the dialog of a user is written by the updates of all its chats
+        await asyncio.gather(
+            self.process(message_update(1, chat_id=1, user_id=9), 1, 0.05),
+            self.process(message_update(2, chat_id=2, user_id=9), 2, 0.01))
+        self.assertListEqual(self.log,
+                             ['start 1', 'end 1', 'start 2', 'end 2'])
+
+    async def test_flooding_chat(self):
+        # a chat sends more updates than the slots, the ones waiting for it
+        # don't hold a slot and another chat is handled right away
+        self.processor = ChatUpdateProcessor(max_concurrent_updates=3)
+        flood = [self.process(message_update(i, chat_id=1, user_id=1), i,
+                              0.1) for i in range(6)]
+        await asyncio.sleep(0.01)
+        other = self.process(message_update(9, chat_id=2, user_id=2), 9, 0)
+        await asyncio.wait_for(asyncio.shield(other), 0.05)
+        self.assertListEqual(self.log, ['start 0', 'start 9', 'end 9'])
+        await asyncio.gather(*flood)
+        self.assertEqual(self.max_running, 2)
+
+    async def test_no_chat(self):
+        self.assertListEqual(
+            ChatUpdateProcessor.serialization_keys(object()), [])
+        await asyncio.gather(self.process(object(), 1, 0.05),
+                             self.process(object(), 2, 0.05))
+        self.assertEqual(self.max_running, 2)
+
+
+class TestKeyedLocks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancel_waiting(self):
+        locks = KeyedLocks()
+        await locks.acquire('a')
+        waiting = asyncio.create_task(locks.acquire('a'))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        locks.release('a')
+        self.assertEqual(len(locks), 0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLeases(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        fd, self.db_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.engine = create_engine(f'sqlite:///{self.db_file}')
+        ChatLease.__table__.create(self.engine)
+        self.clock = Clock()
+        self.executor = db_executor(4)
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+        self.engine.dispose()
+        os.remove(self.db_file)
+
+    def test_lease(self):
+        leases = LeaseServices(self.engine, clock=self.clock)
+        self.assertTrue(leases.acquire('chat:1', 'w1', ttl=10))
+        self.assertTrue(leases.acquire('chat:1', 'w1', ttl=10))
+        self.assertFalse(leases.acquire('chat:1', 'w2', ttl=10))
+        self.assertTrue(leases.acquire('chat:2', 'w2', ttl=10))
+        self.clock.now += 8
+        self.assertTrue(leases.renew('chat:1', 'w1', ttl=10))
+        self.clock.now += 8
+        # renewed, not expired yet
+        self.assertFalse(leases.acquire('chat:1', 'w2', ttl=10))
+        self.clock.now += 3
+        # expired, a worker that died doesn't keep it
+        self.assertTrue(leases.acquire('chat:1', 'w2', ttl=10))
+        self.assertFalse(leases.renew('chat:1', 'w1', ttl=10))
+        leases.release('chat:1', 'w1')
+        self.assertFalse(leases.acquire('chat:1', 'w3', ttl=10))
+        leases.release('chat:1', 'w2')
+        self.assertTrue(leases.acquire('chat:1', 'w3', ttl=10))
+
+    async def test_workers_in_order(self):
+        # two workers sharing the database handle a chat one after the other
+        leases = AsyncServices(LeaseServices(self.engine), self.executor)
+        workers = [ChatUpdateProcessor(10, leases=leases, lease_ttl=0.3,
+                                       max_poll_interval=0.05)
+                   for _ in range(2)]
+        self.assertNotEqual(workers[0].owner, workers[1].owner)
+        log = []
+
+        async def handle(name):
+            log.append(f'start {name}')
+            # longer than the ttl, the lease is renewed meanwhile
+            await asyncio.sleep(0.4)
+            log.append(f'end {name}')
+
+        first = asyncio.create_task(workers[0].process_update(
+            message_update(1, chat_id=1, user_id=1), handle(1)))
+        await asyncio.sleep(0.1)
+        await asyncio.gather(first, workers[1].process_update(
+            message_update(2, chat_id=1, user_id=2), handle(2)))
+        self.assertListEqual(log, ['start 1', 'end 1', 'start 2', 'end 2'])
+        # all released
+        self.assertTrue(LeaseServices(self.engine).acquire(
+            'chat:1', 'other', ttl=10))
+
+
+if __name__ == '__main__':
+    unittest.main()
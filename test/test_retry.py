@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_retry.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the retry of the transient errors of the ai providers
+
+import random
+import unittest
+
+import httpx
+import openai
+
+from ai.retry import RetryPolicy, retry_after, retryable
+from ai.router import ProviderRouter
+
+request = httpx.Request('POST', 'https://ai.example.com')
+
+
+def status_error(status: int, headers: dict = None):
+    response = httpx.Response(status, headers=headers, request=request)
+    return openai.APIStatusError('error', response=response, body=None)
+
+
+class FakeClock:
+    """time passes only while sleeping"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Flaky:
+    """fails with the errors given, then answers"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def ask(self, message, dialog_messages=None, prompt=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'answer'
+
+    async def ask_stream(self, message, dialog_messages=None, prompt=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        yield 'ans'
+        yield 'wer'
+
+
+class TestClassify(unittest.TestCase):
+
+    def test_retryable(self):
+        self.assertTrue(retryable(status_error(429)))
+        self.assertTrue(retryable(status_error(502)))
+        self.assertFalse(retryable(status_error(400)))
+        self.assertFalse(retryable(status_error(401)))
+        self.assertTrue(retryable(openai.APITimeoutError(request=request)))
+        self.assertTrue(retryable(httpx.ConnectError('refused')))
+        self.assertFalse(retryable(ValueError('bad answer')))
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(status_error(429, {'Retry-After': '3'})),
+                         3.0)
+        self.assertIsNone(retry_after(status_error(429)))
+        self.assertIsNone(retry_after(ValueError()))
+        self.assertEqual(retry_after(status_error(
+            503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0.0)
+
+
+class TestRetryPolicy(unittest.IsolatedAsyncioTestCase):
+
+    def policy(self, **kwargs):
+        self.clock = FakeClock()
+        return RetryPolicy(rng=random.Random(0), sleep=self.clock.sleep,
+                           clock=self.clock, **kwargs)
+
+    async def test_backoff(self):
+        policy = self.policy(attempts=4, base_delay=1, max_delay=3)
+        flaky = Flaky(status_error(502), status_error(503),
+                      status_error(500))
+        self.assertEqual(await policy.call('claude', flaky.ask, 'hi'),
+                         'answer')
+        self.assertEqual(flaky.calls, 4)
+        # full jitter under the exponential cap
+        for sleep, cap in zip(self.clock.sleeps, [1, 2, 3]):
+            self.assertLessEqual(sleep, cap)
+        metrics = policy.report()['claude']
+        self.assertEqual((metrics['attempts'], metrics['retries'],
+                          metrics['successes']), (4, 3, 1))
+
+    async def test_permanent_error(self):
+        policy = self.policy()
+        flaky = Flaky(status_error(400))
+        with self.assertRaises(openai.APIStatusError):
+            await policy.call('claude', flaky.ask, 'hi')
+        self.assertEqual(flaky.calls, 1)
+        self.assertEqual(policy.metrics['claude'].permanent, 1)
+
+    async def test_retry_after_and_deadline(self):
+        policy = self.policy(attempts=5, deadline=10)
+        flaky = Flaky(status_error(429, {'Retry-After': '4'}),
+                      status_error(429, {'Retry-After': '4'}),
+                      status_error(429, {'Retry-After': '4'}))
+        with self.assertRaises(openai.APIStatusError):
+            await policy.call('claude', flaky.ask, 'hi')
+        # the third wait would end past the deadline
+        self.assertListEqual(self.clock.sleeps, [4.0, 4.0])
+        self.assertEqual(policy.metrics['claude'].exhausted, 1)
+        self.assertEqual(policy.metrics['claude'].failures, 1)
+
+    async def test_stream(self):
+        policy = self.policy()
+        flaky = Flaky(httpx.ReadTimeout('slow', request=request))
+        pieces = [p async for p in policy.stream('claude', flaky.ask_stream,
+                                                 'hi')]
+        self.assertEqual(''.join(pieces), 'answer')
+        self.assertEqual(flaky.calls, 2)
+
+    async def test_router_retries_before_failover(self):
+        claude = Flaky(status_error(503))
+        router = ProviderRouter({'claude': claude},
+                                retry=self.policy(attempts=2))
+        self.assertEqual(await router.ask('claude', 'hi'), 'answer')
+        # one request for the stats of the provider, it succeeded
+        self.assertEqual(router.stats['claude'].error_rate, 0)
+        self.assertEqual(router.report()['claude']['retry']['retries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_router.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the provider router with fake providers
+
+import asyncio
+import unittest
+
+from ai.context import ContextTooLong
+from ai.router import ProviderRouter, ProviderStats, ProvidersFailed
+
+
+class FakeProvider:
+    """answers its name after `delay` seconds, or raises if `fail`"""
+
+    def __init__(self, name, delay=0.0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.asked = 0
+        self.cancelled = 0
+
+    async def ask(self, message, dialog_messages=None, prompt=None):
+        self.asked += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.fail:
+            raise RuntimeError(f'{self.name} is down')
+        return self.name
+
+    async def ask_stream(self, message, dialog_messages=None, prompt=None):
+        self.asked += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(f'{self.name} is down')
+        for piece in self.name:
+            yield piece
+
+
+class TestProviderStats(unittest.TestCase):
+
+    def test_percentiles(self):
+        stats = ProviderStats(window=100)
+        self.assertIsNone(stats.p50)
+        for i in range(1, 101):
+            stats.record(i / 100)
+        self.assertEqual(stats.p50, 0.51)
+        self.assertEqual(stats.p95, 0.96)
+        stats.record(None, error=True)
+        self.assertEqual(stats.error_rate, 0.01)
+        # rolling window
+        self.assertEqual(stats.requests, 100)
+
+
+class TestProviderRouter(unittest.IsolatedAsyncioTestCase):
+
+    def router(self, *providers, **kwargs):
+        return ProviderRouter({p.name: p for p in providers},
+                              fallbacks=[p.name for p in providers[1:]],
+                              **kwargs)
+
+    async def test_route_by_model_name(self):
+        claude, palm = FakeProvider('claude'), FakeProvider('palm2')
+        router = self.router(claude, palm)
+        self.assertEqual(await router.ask('PaLM2', 'hi'), 'palm2')
+        self.assertEqual(await router.ask('Claude-2', 'hi'), 'claude')
+        self.assertIsNone(router.provider_name('ChatGpt'))
+        self.assertEqual(router.report()['claude']['requests'], 1)
+
+    async def test_failover(self):
+        claude = FakeProvider('claude', fail=True)
+        palm = FakeProvider('palm2')
+        router = self.router(claude, palm)
+        self.assertEqual(await router.ask('claude', 'hi'), 'palm2')
+        self.assertEqual(router.stats['claude'].error_rate, 1.0)
+        # no fallback: the error surfaces
+        router = ProviderRouter({'claude': claude})
+        with self.assertRaises(ProvidersFailed):
+            await router.ask('claude', 'hi')
+
+    async def test_context_too_long(self):
+        palm = FakeProvider('palm2')
+
+        async def too_long(message, dialog_messages=None, prompt=None):
+            raise ContextTooLong('Token exceed limit')
+
+        palm.ask = too_long
+        claude = FakeProvider('claude')
+        router = self.router(palm, claude)
+        with self.assertRaises(ProvidersFailed) as cm:
+            await router.ask('palm2', 'hi')
+        self.assertIsInstance(cm.exception.__cause__, ContextTooLong)
+        # not held against the provider, nor asked to the others
+        self.assertEqual(router.stats['palm2'].requests, 0)
+        self.assertEqual(claude.asked, 0)
+
+    async def test_unhealthy_asked_last(self):
+        claude = FakeProvider('claude', fail=True)
+        palm = FakeProvider('palm2')
+        router = self.router(claude, palm, min_requests=2)
+        for _ in range(2):
+            await router.ask('claude', 'hi')
+        self.assertListEqual(router.candidates('claude'),
+                             ['palm2', 'claude'])
+        await router.ask('claude', 'hi')
+        self.assertEqual(claude.asked, 2)
+
+    async def test_fallbacks_by_latency(self):
+        slow = FakeProvider('slow', delay=0.05)
+        fast = FakeProvider('fast', delay=0.0)
+        first = FakeProvider('first')
+        router = self.router(first, slow, fast)
+        await router.ask('slow', 'hi')
+        await router.ask('fast', 'hi')
+        self.assertListEqual(router.candidates('first'),
+                             ['first', 'fast', 'slow'])
+
+    async def test_hedge(self):
+        claude = FakeProvider('claude', delay=1)
+        palm = FakeProvider('palm2', delay=0.01)
+        router = self.router(claude, palm, hedge_delay=0.05)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.assertEqual(await router.ask('claude', 'hi'), 'palm2')
+        self.assertLess(loop.time() - start, 0.5)
+        await asyncio.sleep(0)
+        # the slow request is cancelled, not counted
+        self.assertEqual(claude.cancelled, 1)
+        self.assertEqual(router.stats['claude'].requests, 0)
+        # answers before the delay: not hedged
+        claude.delay = 0
+        self.assertEqual(await router.ask('claude', 'hi'), 'claude')
+        self.assertEqual(palm.asked, 1)
+
+    async def test_stream_failover(self):
+        claude = FakeProvider('claude', fail=True)
+        palm = FakeProvider('palm2')
+        router = self.router(claude, palm)
+        pieces = [p async for p in router.ask_stream('claude', 'hi')]
+        self.assertEqual(''.join(pieces), 'palm2')
+        palm.fail = True
+        with self.assertRaises(ProvidersFailed):
+            [p async for p in router.ask_stream('claude', 'hi')]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_stream.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the streaming interface of the ai services
+
+import asyncio
+import unittest
+
+from ai.stream import or_error, single_chunk
+
+
+class TestStream(unittest.IsolatedAsyncioTestCase):
+
+    async def test_single_chunk(self):
+        pieces = [p async for p in single_chunk(asyncio.sleep(0, 'answer'))]
+        self.assertListEqual(pieces, ['answer'])
+        self.assertListEqual(
+            [p async for p in single_chunk(asyncio.sleep(0, ''))], [])
+
+    async def test_or_error(self):
+        async def broken(pieces):
+            for p in pieces:
+                yield p
+            raise RuntimeError('broken')
+
+        self.assertListEqual(
+            [p async for p in or_error(broken([]), 'error')], ['error'])
+        # an answer half sent is kept as it is
+        self.assertListEqual(
+            [p async for p in or_error(broken(['a', 'b']), 'error')],
+            ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,12 +8,14 @@
 # Description: Test User model
 
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from database.model_view import UserServices
-from database.models import Base, User
+from database.model_view import UserServices, RoleServices, UserCache, \
+    UnitOfWork
+from database.models import Base, User, Role
 
 engine = create_engine('sqlite:///./test.sqlite')
 Base.metadata.drop_all(engine)
@@ -21,6 +23,10 @@ Base.metadata.create_all(engine)
 
 
 class TestUserModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        RoleServices(engine).init_roles()
+
     def setUp(self):
         session = sessionmaker(bind=engine)
         self.session = session()
@@ -87,6 +93,134 @@ class TestUserModel(unittest.TestCase):
         self.user_service.del_user(user_id)
         self.assertFalse(self.user_service.check_if_user_exists(user_id))
 
+    def test_user_cache(self):
+        user_id = 'cache_user'
+        if self.user_service.check_if_user_exists(user_id):
+            self.user_service.del_user(user_id)
+        self.user_service.add_new_user(user_id, 456, 'cache_username')
+
+        self.user_service.get_user_by_user_id(user_id)
+        misses = self.user_service.cache.misses
+        hits = self.user_service.cache.hits
+        self.assertEqual(
+            self.user_service.get_user_attribute(user_id, 'username'),
+            'cache_username')
+        self.assertFalse(self.user_service.is_admin(user_id))
+        self.assertEqual(self.user_service.cache.misses, misses)
+        self.assertEqual(self.user_service.cache.hits, hits + 2)
+
+        # write through: the cached user and the db row are both updated
+        self.user_service.set_user_attribute(user_id, 'username', 'new_name')
+        self.assertTrue(self.user_service.reserve_api_count(user_id))
+        user = self.user_service.get_user_by_user_id(user_id)
+        self.assertEqual(user.username, 'new_name')
+        self.assertEqual(user.api_count, 9)
+        self.assertEqual(self.user_service.cache.misses, misses)
+        db_user = self.session.query(User).filter_by(user_id=user_id).first()
+        self.assertEqual(db_user.username, 'new_name')
+        self.assertEqual(db_user.api_count, 9)
+        self.assertEqual(db_user.total_api_count, 1)
+
+        self.user_service.del_user(user_id)
+        self.assertFalse(self.user_service.check_if_user_exists(user_id))
+
+    def test_user_cache_off(self):
+        # with several workers the user cache can be turned off, the changes
+        # of another worker are seen at once
+        user_id = 'cache_off_user'
+        if self.user_service.check_if_user_exists(user_id):
+            self.user_service.del_user(user_id)
+        self.user_service.add_new_user(user_id, 789, 'name')
+        worker = UserServices(engine)
+        worker.cache = UserCache(maxsize=0)
+        self.assertEqual(worker.get_user_attribute(user_id, 'username'),
+                         'name')
+        self.user_service.set_user_attribute(user_id, 'username', 'new_name')
+        self.assertEqual(worker.get_user_attribute(user_id, 'username'),
+                         'new_name')
+        self.assertEqual(worker.cache.stats()['size'], 0)
+        self.user_service.del_user(user_id)
+
+    def test_api_count(self):
+        user_id = 'quota_user'
+        if self.user_service.check_if_user_exists(user_id):
+            self.user_service.del_user(user_id)
+        self.user_service.add_new_user(user_id, 321, 'quota')
+        self.user_service.set_user_attribute(user_id, 'api_count', 2)
+        # another worker with its own cache takes from the same quota
+        worker = UserServices(engine)
+        worker.get_user_by_user_id(user_id)
+        self.assertTrue(self.user_service.reserve_api_count(user_id))
+        self.assertTrue(worker.reserve_api_count(user_id))
+        self.assertFalse(self.user_service.reserve_api_count(user_id))
+        self.assertFalse(worker.reserve_api_count(user_id))
+        # the cached users got the counts written
+        self.assertEqual(worker.get_user_by_user_id(user_id).api_count, 0)
+        self.assertEqual(
+            worker.get_user_by_user_id(user_id).total_api_count, 2)
+        worker.refund_api_count(user_id)
+        self.assertTrue(self.user_service.reserve_api_count(user_id))
+        db_user = self.session.query(User).filter_by(user_id=user_id).first()
+        self.assertEqual((db_user.api_count, db_user.total_api_count), (0, 2))
+        self.assertFalse(self.user_service.reserve_api_count('no_user'))
+        self.user_service.del_user(user_id)
+
+    def test_admin_api_count(self):
+        user_id = 'quota_admin'
+        if self.user_service.check_if_user_exists(user_id):
+            self.user_service.del_user(user_id)
+        admin_role = self.session.query(Role).filter_by(name='Admin').first()
+        self.user_service.add_new_user(user_id, 654, 'admin',
+                                       role_id=admin_role.id)
+        self.user_service.set_user_attribute(user_id, 'api_count', 0)
+        # admins are not limited, only the total is counted
+        self.assertTrue(self.user_service.reserve_api_count(user_id))
+        user = self.user_service.get_user_by_user_id(user_id)
+        self.assertEqual((user.api_count, user.total_api_count), (0, 1))
+        self.user_service.del_user(user_id)
+
+    def test_concurrent_reserve(self):
+        user_id = 'quota_race'
+        if self.user_service.check_if_user_exists(user_id):
+            self.user_service.del_user(user_id)
+        self.user_service.add_new_user(user_id, 987, 'race')
+        self.user_service.set_user_attribute(user_id, 'api_count', 5)
+        workers = [UserServices(engine) for _ in range(4)]
+        with ThreadPoolExecutor(4) as executor:
+            reserved = list(executor.map(
+                lambda i: workers[i % 4].reserve_api_count(user_id),
+                range(20)))
+        # exactly the quota, nothing overspent or lost
+        self.assertEqual(reserved.count(True), 5)
+        db_user = self.session.query(User).filter_by(user_id=user_id).first()
+        self.assertEqual((db_user.api_count, db_user.total_api_count), (0, 5))
+        self.user_service.del_user(user_id)
+
+    def test_two_writes_in_unit_of_work(self):
+        # the second write misses the cache and finds the user changed by
+        # the first one in the session
+        user_id = 'uow_user'
+        if self.user_service.check_if_user_exists(user_id):
+            self.user_service.del_user(user_id)
+        self.user_service.add_new_user(user_id, 852, 'uow')
+        for cache in (UserCache(maxsize=0), self.user_service.cache):
+            self.user_service.cache = cache
+            with UnitOfWork(engine):
+                self.user_service.set_user_attribute(
+                    user_id, 'current_chat_mode', 'code_assistant')
+                cache.clear()
+                self.user_service.set_user_attribute(user_id, 'username',
+                                                     'uow_name')
+                self.assertEqual(self.user_service.get_user_attribute(
+                    user_id, 'current_chat_mode'), 'code_assistant')
+            self.session.expire_all()
+            db_user = self.session.query(User).filter_by(
+                user_id=user_id).first()
+            self.assertEqual((db_user.current_chat_mode, db_user.username),
+                             ('code_assistant', 'uow_name'))
+            self.user_service.set_user_attribute(user_id, 'username', 'uow')
+        self.user_service.del_user(user_id)
+
     def tearDown(self):
         self.session.rollback()
         self.session.close()
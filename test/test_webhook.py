@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: test_webhook.py
+# Author: Zhou
+# Date: 2026/10/18
+# Copyright: 2026 Zhou
+# License:
+# Description: Test the webhook mode against a fake telegram bot api
+
+import asyncio
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer, unused_port
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+from bot.webhook import SECRET_HEADER, WebhookServer
+from config.config import webhook_secret, webhook_url_path
+
+
+class FakeTelegram:
+    """the bot api methods the test calls, remembers the calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post()) if request.content_type != \
+            'application/json' else await request.json()
+        self.calls.append((method, data))
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bot',
+                      'username': 'test_bot'}
+        elif method == 'sendMessage':
+            result = {'message_id': 2, 'date': 0, 'text': data['text'],
+                      'chat': {'id': int(data['chat_id']), 'type': 'private'}}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def methods(self):
+        return [m for m, _ in self.calls]
+
+
+def message_update(update_id: int, text: str) -> dict:
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': text,
+                        'chat': {'id': 7, 'type': 'private'},
+                        'from': {'id': 7, 'is_bot': False,
+                                 'first_name': 'user'}}}
+
+
+class TestWebhook(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.telegram = FakeTelegram()
+        self.telegram_server = TestServer(self.telegram.app)
+        await self.telegram_server.start_server()
+        base = str(self.telegram_server.make_url('/bot'))
+        self.application = ApplicationBuilder().token('123:abc').base_url(
+            base).build()
+
+        async def echo(update, context):
+            # slow, to check the shutdown waits for it
+            await asyncio.sleep(0.2)
+            await update.message.reply_text(f'echo {update.message.text}')
+
+        self.application.add_handler(MessageHandler(filters.TEXT, echo))
+        self.port = unused_port()
+        self.server = WebhookServer(
+            self.application, url='https://bot.example.com/telegram',
+            listen='127.0.0.1', port=self.port, secret_token='s3cret')
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.telegram_server.close()
+
+    async def post(self, data, token='s3cret'):
+        async with self.session.post(f'{self.base_url}/telegram', json=data,
+                                     headers={SECRET_HEADER: token}) as rsp:
+            return rsp.status
+
+    async def test_updates(self):
+        await self.server.start()
+        set_webhook = dict(self.telegram.calls)['setWebhook']
+        self.assertEqual(set_webhook['url'], 'https://bot.example.com/telegram')
+        self.assertEqual(set_webhook['secret_token'], 's3cret')
+
+        async with self.session.get(f'{self.base_url}/healthz') as rsp:
+            self.assertEqual(rsp.status, 200)
+        self.assertEqual(await self.post(message_update(1, 'hi'),
+                                         token='wrong'), 403)
+        self.assertEqual(await self.post('not an update'), 400)
+        self.assertEqual(await self.post(message_update(2, 'hi')), 200)
+        # stopping handles the update received first
+        await self.server.stop()
+        sent = [d for m, d in self.telegram.calls if m == 'sendMessage']
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['text'], 'echo hi')
+        # no more requests taken
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            await self.session.get(f'{self.base_url}/healthz')
+        self.assertNotIn('deleteWebhook', self.telegram.methods())
+
+    def test_url_path(self):
+        # the route is the path of the url
+        self.assertEqual(self.server.path, '/telegram')
+        self.assertEqual(webhook_url_path('https://bot.example.com/a/b'),
+                         '/a/b')
+        for url in (None, '', 'bot.example.com/telegram',
+                    'http://bot.example.com/telegram',
+                    'https://bot.example.com', 'https://bot.example.com/'):
+            with self.assertRaises(ValueError):
+                webhook_url_path(url)
+
+    def test_secret_token_required(self):
+        for token in (None, ''):
+            with self.assertRaises(ValueError):
+                WebhookServer(self.application, url='https://bot.example.com',
+                              secret_token=token)
+        self.assertEqual(webhook_secret('s3cret-_1'), 's3cret-_1')
+        for token in (None, '', 'not secret', 'a' * 257):
+            with self.assertRaises(ValueError):
+                webhook_secret(token)
+
+
+if __name__ == '__main__':
+    unittest.main()